@@ -41,7 +41,7 @@ __C.LEARNING_RATE = 0.001
 # Learning rate with exponential decay
 # Use learning rate decay
 __C.LR_DECAY = True
-# Decay steps
+# Decay steps, counted in applied updates if GRAD_ACCUM_STEPS is set
 __C.LR_DECAY_STEPS = 2000
 # Exponential decay rate
 __C.LR_DECAY_RATE = 0.96
@@ -52,6 +52,13 @@ __C.EPOCHS = 50
 # Batch size
 __C.BATCH_SIZE = 2048
 
+# Accumulate gradients of n batches (micro-batches) and apply their mean,
+# the effective batch size is BATCH_SIZE * GRAD_ACCUM_STEPS
+# Learning rate decays with applied updates instead of micro-batches
+# Only supported by the normal (single) version, multi-gpu and
+# multi-tasks modes raise ValueError. Set None to not accumulate
+__C.GRAD_ACCUM_STEPS = None
+
 
 # ===========================================
 # #               Preprocessing             #
@@ -188,6 +195,34 @@ __C.TL_MODEL = 'xception'
 # Pooling method: 'avg', None
 __C.BF_POOLING = None
 
+# Batch size of extracting bottleneck features
+__C.BF_BATCH_SIZE = 128
+
+# Number of threads preparing batches (scaling images to 0-255)
+# while the model is running on the previous batch
+# Set None to prepare batches in the main thread
+__C.BF_PREPROCESS_WORKERS = 4
+
+# Maximum number of prepared batches waiting for the model
+__C.BF_PREFETCH_BATCHES = 2
+
+# Maximum number of feature batches waiting to be written
+# Set None to write features synchronously
+__C.BF_WRITER_QUEUE_SIZE = 4
+
+# Number of processes extracting bottleneck features in parallel
+# Each process gets its own cache parts, or shards of a single cache
+# Set None to extract in the main process
+__C.BF_NUM_PROCESSES = None
+
+# Number of threads used by each process
+# Set None to share all cpus evenly between processes
+__C.BF_THREADS_PER_PROCESS = None
+
+# Data type to store bottleneck features: 'float32', 'float16', 'int8'
+# 'int8' is quantized with a scale for each channel of each batch
+__C.BF_STORAGE_DTYPE = 'float32'
+
 
 # ===========================================
 # #         Training Configurations         #
@@ -201,6 +236,28 @@ __C.DISPLAY_STEP = None  # batches
 # Set None to not save summaries
 __C.SAVE_LOG_STEP = 100  # batches
 
+# Number of valid examples sampled once to evaluate while training
+# Rounded to full batches, set None to use the full valid set
+__C.VALID_SLICE_SIZE = 4096
+
+# Evaluate on the valid slice when the last result is older than n steps
+# Set None to evaluate every time logs are displayed or saved
+__C.VALID_EVAL_STEP = 500  # batches
+
+# Save time breakdown of training steps (batch, optimizer, logs, images,
+# checkpoint, eval, test), images/sec and fraction of optimizer time to
+# TensorBoard and timing_log.csv
+# Set None to turn off timing
+__C.TIMING_LOG_STEP = None  # batches
+# Number of recent steps the timing is averaged over
+__C.TIMING_WINDOW = 100  # batches
+
+# Trace steps in [start, end) with RunOptions(FULL_TRACE), e.g. (200, 210)
+# Chrome-trace timelines with memory, and time and memory of ops and name
+# scopes are saved to 'traces' in the train log directory
+# Set None to not trace
+__C.TRACE_STEPS = None
+
 # Save reconstructed images
 # Set None to not save images
 __C.SAVE_IMAGE_STEP = 100  # batches
@@ -208,6 +265,33 @@ __C.SAVE_IMAGE_STEP = 100  # batches
 # Maximum images number in a col
 __C.MAX_IMAGE_IN_COL = 10
 
+# Save reconstructed images in a background thread
+# Maximum number of pending images, training blocks when the queue is full
+# Set None to save images synchronously
+__C.IMAGE_SAVER_QUEUE_SIZE = 4
+
+# Order of training batches
+# None: same order in every epoch (default)
+# Opt-in samplers:
+# 'shuffle': a new permutation of samples in every epoch
+# 'stratified': a new permutation in every epoch, and every batch has
+#               about the same proportion of each class as the train set
+# Not used by the input pipeline, which has its own shuffle buffer
+__C.TRAIN_SAMPLER = None
+# Random seed of the sampler, None for a random seed
+__C.SAMPLER_SEED = None
+
+# Read training batches from a tf.data input pipeline instead of feed_dict
+# Placeholders of inputs are still fed to override it when evaluating
+__C.INPUT_PIPELINE = False
+# Shuffle buffer size of the input pipeline (examples)
+# Set None to not shuffle
+__C.INPUT_SHUFFLE_BUFFER = 10000
+# Number of threads casting batches to float32
+__C.INPUT_MAP_THREADS = 4
+# Number of batches prefetched while the model is running
+__C.INPUT_PREFETCH_BATCHES = 2
+
 # Calculate train loss and valid loss using full data set
 # 'per_epoch': evaluate on full set when n epochs finished
 # 'per_batch': evaluate on full set when n batches finished
@@ -224,6 +308,18 @@ __C.SAVE_MODEL_MODE = 'per_epoch'
 __C.SAVE_MODEL_STEP = 5
 # Maximum number of recent checkpoints to keep.
 __C.MAX_TO_KEEP_CKP = 3
+# Copy variables to host memory and write checkpoints in a background thread
+# Training only waits if the last checkpoint is still being written
+__C.ASYNC_SAVE_MODEL = False
+# Resume training from the latest checkpoint of VERSION, with its step,
+# epoch, learning rate and order of batches, and keep writing logs and
+# summaries to the same directories.
+# With INPUT_PIPELINE, the order of batches is not restored.
+__C.RESUME = False
+
+# Batch size of evaluating on full set and valid slice
+# None: same as BATCH_SIZE
+__C.EVAL_BATCH_SIZE = None
 
 # Calculate the train loss of full data set, which may take lots of time.
 __C.EVAL_WITH_FULL_TRAIN_SET = False
@@ -246,6 +342,10 @@ __C.TEST_MO_MODE = 'per_epoch'
 # Evaluate on Oracles test set after
 __C.TEST_ORACLE_MODE = 'per_epoch'
 
+# Test sets are loaded once before training and shared by every test
+# Load them as read-only memmaps (converted to .npy files once) to save memory
+__C.TEST_DATA_MMAP = False
+
 
 # ===========================================
 # #          Testing Configurations         #
@@ -312,6 +412,10 @@ __C.DPP_DATA_PATH = '../data/preprocessed_data'
 # Oracle labels path
 __C.ORAClE_LABEL_PATH = __C.SOURCE_DATA_PATH + '/recognized_oracles_labels.csv'
 
+# Path of the decoded thumbnail cache of source images
+# Set None to decode source images every time
+__C.THUMBNAIL_CACHE_PATH = '../data/thumbnail_cache'
+
 # Path for saving logs
 __C.TRAIN_LOG_PATH = '../train_logs'
 
@@ -0,0 +1,211 @@
+"""Throughput of bottleneck feature extraction of transfer learning models.
+
+Each backbone is built by GetBottleneckFeatures (keras.applications) and by
+the builders of models/transfer_models.py, and runs on synthetic batches of
+28x28 grayscale and 224x224 RGB images. Every (source, model, threads,
+image size) case runs in a fresh process, so thread settings and peak RSS
+are not shared. Batch sizes of a case run in ascending order, so the peak
+RSS of a batch size is not raised by a larger one.
+
+Run from src/:
+  python benchmarks/bf_extraction.py -o bf_extraction.json
+  python benchmarks/bf_extraction.py -m xception resnet50 -t 4 8 -bs 32 128
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import sys
+import json
+import time
+import resource
+import argparse
+import importlib.util
+import numpy as np
+from os import path
+from multiprocessing import get_context
+
+sys.path.append(path.dirname(path.dirname(path.abspath(__file__))))
+from models import utils
+
+TL_MODELS = ('vgg16', 'vgg19', 'resnet50', 'inceptionv3', 'xception')
+SOURCES = ('get_bf', 'transfer_models')
+IMG_SHAPES = {28: (28, 28, 1), 224: (224, 224, 3)}
+
+# Names of builders in models/transfer_models.py
+BUILDER_NAMES = {'vgg16': 'VGG16',
+                 'vgg19': 'VGG19',
+                 'resnet50': 'ResNet50',
+                 'inceptionv3': 'InceptionV3',
+                 'xception': 'Xception'}
+
+
+def _peak_rss_mb():
+  """Peak resident set size of this process (ru_maxrss is in KB on linux)."""
+  return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def _load_transfer_models():
+  """Load models/transfer_models.py as a module of keras_applications.
+
+  The builders are copied from keras_applications and use its relative
+  imports, so they are loaded in that package.
+  """
+  import keras_applications
+  module_name = keras_applications.__name__ + '.transfer_models'
+  spec = importlib.util.spec_from_file_location(
+      module_name,
+      path.join(path.dirname(path.dirname(path.abspath(__file__))),
+                'models', 'transfer_models.py'))
+  module = importlib.util.module_from_spec(spec)
+  sys.modules[module_name] = module
+  spec.loader.exec_module(module)
+  return module
+
+
+def _build_model(source, model_name, input_shape, weights, pooling):
+  """Build a backbone which takes images with shape of input_shape."""
+  if source == 'get_bf':
+    from models.get_transfer_learning_codes import GetBottleneckFeatures
+    return GetBottleneckFeatures(model_name)._get_model(
+        input_shape, weights=weights, pooling=pooling)
+  elif source == 'transfer_models':
+    import keras
+    from models.get_transfer_learning_codes import get_input_layers
+    builder = getattr(_load_transfer_models(), BUILDER_NAMES[model_name])
+    _, input_tensor = get_input_layers(input_shape, model_name)
+    return builder(include_top=False,
+                   weights=weights,
+                   input_tensor=input_tensor,
+                   pooling=pooling,
+                   backend=keras.backend,
+                   layers=keras.layers,
+                   models=keras.models,
+                   utils=keras.utils)
+  else:
+    raise ValueError('Wrong source: {}! Choose from: {}'.format(
+        source, SOURCES))
+
+
+def _run_case(case):
+  """Benchmark a (source, model, threads, image size) case in a worker."""
+  source, model_name, n_threads, img_size, batch_sizes, \
+      n_batches, weights, pooling, seed = case
+
+  import tensorflow as tf
+  from keras import backend as K
+  K.set_session(tf.Session(config=tf.ConfigProto(
+      device_count={'GPU': 0},
+      intra_op_parallelism_threads=n_threads,
+      inter_op_parallelism_threads=n_threads)))
+
+  rng = np.random.RandomState(seed)
+  records = []
+  input_shape = IMG_SHAPES[img_size]
+  start_time = time.time()
+  model = _build_model(source, model_name, input_shape, weights, pooling)
+  build_time = time.time() - start_time
+
+  for batch_size in sorted(batch_sizes):
+    x = (rng.rand(batch_size, *input_shape) * 255).astype(np.float32)
+    # Warm up
+    features = model.predict_on_batch(x)
+    start_time = time.time()
+    for _ in range(n_batches):
+      model.predict_on_batch(x)
+    using_time = time.time() - start_time
+
+    records.append({
+      'source': source,
+      'model': model_name,
+      'img_shape': list(input_shape),
+      'batch_size': batch_size,
+      'threads': n_threads,
+      'build_time_s': build_time,
+      'images_per_sec': batch_size * n_batches / using_time,
+      'peak_rss_mb': _peak_rss_mb(),
+      'feature_shape': list(features.shape[1:]),
+      'feature_bytes_per_image': int(features[0].nbytes),
+    })
+  K.clear_session()
+
+  return records
+
+
+def run_benchmark(model_names=TL_MODELS,
+                  sources=SOURCES,
+                  img_sizes=(28, 224),
+                  batch_sizes=(16, 64),
+                  threads=(1, 4),
+                  n_batches=5,
+                  weights='imagenet',
+                  pooling='avg',
+                  seed=0):
+  records = []
+  for source in sources:
+    for model_name in model_names:
+      for n_threads in threads:
+        for img_size in img_sizes:
+          case = (source, model_name, n_threads, img_size, batch_sizes,
+                  n_batches, weights, pooling, seed)
+          # Use a fresh process for each case
+          with get_context('spawn').Pool(processes=1) as pool:
+            case_records = pool.apply(_run_case, (case,))
+          for r in case_records:
+            print('{:>15} | {:>11} | {:>13} | bs {:>4} | threads {:>3} | '
+                  '{:>8.1f} img/s | build {:>6.2f}s | rss {:>7.0f}MB'.format(
+                      r['source'], r['model'], str(tuple(r['img_shape'])),
+                      r['batch_size'], r['threads'], r['images_per_sec'],
+                      r['build_time_s'], r['peak_rss_mb']))
+          records.extend(case_records)
+  return records
+
+
+if __name__ == '__main__':
+
+  parser = argparse.ArgumentParser(
+      description='Benchmark of bottleneck feature extraction.'
+  )
+  parser.add_argument('-m', '--models', nargs='+', default=list(TL_MODELS),
+                      choices=TL_MODELS, metavar='',
+                      help='Transfer learning models: {}.'.format(TL_MODELS))
+  parser.add_argument('-s', '--sources', nargs='+', default=list(SOURCES),
+                      choices=SOURCES, metavar='',
+                      help='Where models are built: {}.'.format(SOURCES))
+  parser.add_argument('-is', '--img_sizes', nargs='+', type=int,
+                      default=[28, 224], choices=sorted(IMG_SHAPES),
+                      metavar='', help='Image sizes: 28 (gray), 224 (RGB).')
+  parser.add_argument('-bs', '--batch_sizes', nargs='+', type=int,
+                      default=[16, 64], metavar='', help='Batch sizes.')
+  parser.add_argument('-t', '--threads', nargs='+', type=int,
+                      default=[1, 4], metavar='',
+                      help='Numbers of threads of tensorflow.')
+  parser.add_argument('-n', '--n_batches', type=int, default=5, metavar='',
+                      help='Number of timed batches.')
+  parser.add_argument('-w', '--weights', default='imagenet', metavar='',
+                      help="Weights to load, 'none' for random weights.")
+  parser.add_argument('-p', '--pooling', default='avg', metavar='',
+                      help="Pooling method, 'none' for no pooling.")
+  parser.add_argument('-o', '--output', metavar='',
+                      help='Path to save results as JSON.')
+  args = parser.parse_args()
+
+  utils.thick_line()
+  results = run_benchmark(
+      model_names=args.models,
+      sources=args.sources,
+      img_sizes=args.img_sizes,
+      batch_sizes=args.batch_sizes,
+      threads=args.threads,
+      n_batches=args.n_batches,
+      weights=None if args.weights == 'none' else args.weights,
+      pooling=None if args.pooling == 'none' else args.pooling)
+  utils.thick_line()
+
+  results_json = json.dumps(results, indent=2)
+  if args.output:
+    with open(args.output, 'w') as f:
+      f.write(results_json)
+    print('Results saved to {}'.format(args.output))
+  else:
+    print(results_json)
@@ -0,0 +1,224 @@
+"""Accuracy parity of float16 and int8 bottleneck features.
+
+Bottleneck features are quantized batch by batch in the same way as
+GetBottleneckFeatures.save_bottleneck_features, and compared with the
+float32 features on:
+  - reconstruction errors of features
+  - capsules of Code2CapsLayer and Dense2CapsLayer (identity map), which
+    turn features into capsules without weights
+  - accuracy of a trained model, if a checkpoint is given
+
+Run from src/:
+  python benchmarks/bf_quantization.py -d ../data/preprocessed_data/radical
+  python benchmarks/bf_quantization.py -d ../data/preprocessed_data/radical \
+      -v VERSION -i CKP_IDX
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import sys
+import json
+import argparse
+import numpy as np
+from os import path
+
+sys.path.append(path.dirname(path.dirname(path.abspath(__file__))))
+from models import utils
+from config import config as cfg
+
+
+def _squash(caps, epsilon):
+  """Numpy version of ActivationFunc.squash on the last axis."""
+  vec_squared_norm = np.sum(np.square(caps), axis=-1, keepdims=True)
+  scalar_factor = vec_squared_norm / (0.5 + vec_squared_norm)
+  return scalar_factor * caps / np.sqrt(vec_squared_norm + epsilon)
+
+
+def code2caps(features, vec_dim, epsilon):
+  """Capsules of Code2CapsLayer, shape: (n, num_caps, vec_dim)."""
+  return _squash(features.reshape((len(features), -1, vec_dim)), epsilon)
+
+
+def dense2caps(features, vec_dim, epsilon):
+  """Capsules of Dense2CapsLayer with identity map and GAP."""
+  if features.ndim == 4:
+    features = features.mean(axis=(1, 2))
+  caps = np.repeat(features[:, :, np.newaxis], vec_dim, axis=-1)
+  return _squash(caps, epsilon)
+
+
+def quantize_roundtrip(features, storage_dtype, batch_size):
+  """Quantize features batch by batch and convert them back to float32."""
+  restored = np.empty(features.shape, dtype=np.float32)
+  for start in range(0, len(features), batch_size):
+    end = start + batch_size
+    stored, scales = utils.quantize_features(
+        features[start:end], storage_dtype)
+    utils.dequantize_features(stored, scales, out=restored[start:end])
+  return restored
+
+
+def _feature_errors(features, restored):
+  diff = restored - features
+  norms = np.linalg.norm(features.reshape((len(features), -1)), axis=1)
+  norms_r = np.linalg.norm(restored.reshape((len(restored), -1)), axis=1)
+  cos = np.sum(features.reshape((len(features), -1)) *
+               restored.reshape((len(restored), -1)), axis=1) / \
+      np.maximum(norms * norms_r, 1e-12)
+  return {
+    'max_abs_error': float(np.abs(diff).max()),
+    'relative_rmse': float(np.sqrt(np.mean(np.square(diff))) /
+                           max(np.sqrt(np.mean(np.square(features))), 1e-12)),
+    'min_cosine_similarity': float(cos.min()),
+  }
+
+
+def _caps_errors(caps, caps_restored):
+  lengths = np.linalg.norm(caps, axis=-1)
+  lengths_r = np.linalg.norm(caps_restored, axis=-1)
+  return {
+    'max_abs_error': float(np.abs(caps_restored - caps).max()),
+    'max_length_error': float(np.abs(lengths_r - lengths).max()),
+    'longest_caps_agreement': float(np.mean(
+        np.argmax(lengths, axis=1) == np.argmax(lengths_r, axis=1))),
+  }
+
+
+def _eval_checkpoint(checkpoint_path, variants, y, batch_size,
+                     multi_gpu=False):
+  """Get predictions of a trained model on each variant of features."""
+  import tensorflow as tf
+
+  loaded_graph = tf.Graph()
+  with tf.Session(graph=loaded_graph) as sess:
+    loader = tf.train.import_meta_graph(checkpoint_path + '.meta')
+    loader.restore(sess, checkpoint_path)
+    inputs = loaded_graph.get_tensor_by_name('inputs:0')
+    labels = loaded_graph.get_tensor_by_name('labels:0')
+    is_training = loaded_graph.get_tensor_by_name('is_training:0')
+    preds = loaded_graph.get_tensor_by_name(
+        'total_preds:0' if multi_gpu else 'preds:0')
+
+    # Graphs with a fixed batch size and multi-gpu graphs only take full
+    # batches, so the last batch is dropped for them
+    graph_batch_size = inputs.get_shape().as_list()[0]
+    if graph_batch_size:
+      batch_size = graph_batch_size
+    if graph_batch_size or multi_gpu:
+      n_eval = len(y) // batch_size * batch_size
+    else:
+      n_eval = len(y)
+    preds_vec = {}
+    for name, x in variants.items():
+      preds_vec[name] = np.concatenate([
+          sess.run(preds, feed_dict={inputs: x[i:i + batch_size],
+                                     labels: y[i:i + batch_size],
+                                     is_training: False})
+          for i in range(0, n_eval, batch_size)], axis=0)
+
+  y_true = np.argmax(y[:n_eval], axis=1)
+  preds_ref = np.argmax(preds_vec['float32'], axis=1)
+  results = {}
+  for name, preds_vec_ in preds_vec.items():
+    preds_int = np.argmax(preds_vec_, axis=1)
+    results[name] = {
+      'n_images': int(n_eval),
+      'accuracy': float(np.mean(preds_int == y_true)),
+      'agreement_with_float32': float(np.mean(preds_int == preds_ref)),
+      'max_abs_pred_error': float(
+          np.abs(preds_vec_ - preds_vec['float32']).max()),
+    }
+  return results
+
+
+def run_report(data_dir,
+               file_name='x_test',
+               batch_size=128,
+               vec_dim=8,
+               checkpoint_path=None,
+               multi_gpu=False):
+  features = utils.load_pkls(data_dir, file_name, tl=True, add_n_batch=1)
+  features = features.astype(np.float32, copy=False)
+  n_imgs = len(features)
+  feature_bytes = features[0].size
+
+  variants = {'float32': features}
+  report = {'n_images': n_imgs,
+            'feature_shape': list(features.shape[1:]),
+            'storage': {}}
+  caps_ref = {
+    'code2caps': code2caps(features, vec_dim, cfg.EPSILON),
+    'dense2caps': dense2caps(features, vec_dim, cfg.EPSILON),
+  }
+  n_batches = (n_imgs + batch_size - 1) // batch_size
+
+  for storage_dtype in ('float16', 'int8'):
+    restored = quantize_roundtrip(features, storage_dtype, batch_size)
+    variants[storage_dtype] = restored
+    n_bytes = n_imgs * feature_bytes * np.dtype(storage_dtype).itemsize
+    if storage_dtype == 'int8':
+      n_bytes += n_batches * features.shape[-1] * 4
+    report['storage'][storage_dtype] = {
+      'bytes_per_image': n_bytes / n_imgs,
+      'compression': feature_bytes * 4 * n_imgs / n_bytes,
+      'features': _feature_errors(features, restored),
+      'code2caps': _caps_errors(
+          caps_ref['code2caps'], code2caps(restored, vec_dim, cfg.EPSILON)),
+      'dense2caps': _caps_errors(
+          caps_ref['dense2caps'], dense2caps(restored, vec_dim, cfg.EPSILON)),
+    }
+
+  if checkpoint_path:
+    y = utils.load_pkls(data_dir, file_name.replace('x_', 'y_', 1))
+    report['checkpoint'] = {
+      'path': checkpoint_path,
+      'results': _eval_checkpoint(
+          checkpoint_path, variants, y, batch_size, multi_gpu)}
+
+  return report
+
+
+if __name__ == '__main__':
+
+  parser = argparse.ArgumentParser(
+      description='Accuracy parity of quantized bottleneck features.'
+  )
+  parser.add_argument('-d', '--data_dir', required=True, metavar='',
+                      help='Directory of preprocessed bottleneck features.')
+  parser.add_argument('-f', '--file_name', default='x_test', metavar='',
+                      help='Name of the bottleneck features file.')
+  parser.add_argument('-bs', '--batch_size', type=int,
+                      default=cfg.BF_BATCH_SIZE, metavar='',
+                      help='Batch size used to quantize features.')
+  parser.add_argument('-vd', '--vec_dim', type=int, default=8, metavar='',
+                      help='Dimensions of vectors of capsules.')
+  parser.add_argument('-v', '--version', metavar='',
+                      help='Version of the trained model to evaluate.')
+  parser.add_argument('-i', '--ckp_idx', type=int, metavar='',
+                      help='Index of the checkpoint to evaluate.')
+  parser.add_argument('-mg', '--multi_gpu', action='store_true',
+                      help='The model is trained with multi-gpus.')
+  parser.add_argument('-o', '--output', metavar='',
+                      help='Path to save the report as JSON.')
+  args = parser.parse_args()
+
+  if args.version is not None:
+    ckp_path = path.join(cfg.CHECKPOINT_PATH, '{}/models.ckpt-{}'.format(
+        args.version, args.ckp_idx))
+  else:
+    ckp_path = None
+
+  parity_report = run_report(args.data_dir,
+                             file_name=args.file_name,
+                             batch_size=args.batch_size,
+                             vec_dim=args.vec_dim,
+                             checkpoint_path=ckp_path,
+                             multi_gpu=args.multi_gpu)
+  report_json = json.dumps(parity_report, indent=2)
+  utils.thick_line()
+  print(report_json)
+  utils.thick_line()
+  if args.output:
+    with open(args.output, 'w') as f:
+      f.write(report_json)
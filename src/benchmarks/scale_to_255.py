@@ -0,0 +1,77 @@
+"""Benchmark of utils.imgs_scale_to_255 on 224x224 batches.
+
+Run from src/:
+  python benchmarks/scale_to_255.py
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import sys
+import time
+import argparse
+import numpy as np
+from os import path
+
+sys.path.append(path.dirname(path.dirname(path.abspath(__file__))))
+from models import utils
+
+
+def imgs_scale_to_255_loop(imgs):
+  """The per-image list comprehension implementation, for reference."""
+  return np.array(
+      [np.divide(((i - i.min()) * 255),
+                 (i.max() - i.min())) for i in imgs]).astype(int)
+
+
+def _timeit(fn, n_repeat):
+  fn()
+  start_time = time.time()
+  for _ in range(n_repeat):
+    fn()
+  return (time.time() - start_time) / n_repeat
+
+
+def run_benchmark(batch_sizes, img_shapes, n_repeat=5, seed=0):
+  rng = np.random.RandomState(seed)
+  utils.thick_line()
+  print('{:>6} | {:>14} | {:>8} | {:>10} | {:>10} | {:>10} | {:>7}'.format(
+      'batch', 'shape', 'dtype', 'loop(s)', 'uint8(s)', 'float32(s)',
+      'speedup'))
+  utils.thin_line()
+  for img_shape in img_shapes:
+    for batch_size in batch_sizes:
+      for data_type in (np.float16, np.float32):
+        imgs = rng.rand(batch_size, *img_shape).astype(data_type)
+        out_uint8 = np.empty(imgs.shape, dtype=np.uint8)
+        out_float = np.empty(imgs.shape, dtype=np.float32)
+
+        t_loop = _timeit(lambda: imgs_scale_to_255_loop(imgs), n_repeat)
+        t_uint8 = _timeit(
+            lambda: utils.imgs_scale_to_255(imgs, out=out_uint8), n_repeat)
+        t_float = _timeit(
+            lambda: utils.imgs_scale_to_255(imgs, out=out_float), n_repeat)
+        assert np.abs(imgs_scale_to_255_loop(imgs) - out_uint8).max() <= 1
+
+        print('{:>6} | {:>14} | {:>8} | {:>10.4f} | {:>10.4f} | {:>10.4f} | '
+              '{:>6.1f}x'.format(batch_size, str(img_shape),
+                                 np.dtype(data_type).name, t_loop,
+                                 t_uint8, t_float, t_loop / t_uint8))
+  utils.thick_line()
+
+
+if __name__ == '__main__':
+
+  parser = argparse.ArgumentParser(
+      description='Benchmark of imgs_scale_to_255.'
+  )
+  parser.add_argument('-bs', '--batch_sizes', nargs='+', type=int,
+                      default=[32, 128], metavar='',
+                      help='Batch sizes to benchmark.')
+  parser.add_argument('-n', '--n_repeat', type=int, default=5, metavar='',
+                      help='Number of repeats.')
+  args = parser.parse_args()
+
+  run_benchmark(args.batch_sizes,
+                [(224, 224, 1), (224, 224, 3)],
+                n_repeat=args.n_repeat)
@@ -7,14 +7,18 @@ import numpy as np
 from os import path
 from PIL import Image
 
+from config import config
+from models.thumbnail_cache import ThumbnailCache, letterbox_img
+
 
 class GenerateSheet(object):
 
-  def __init__(self):
+  def __init__(self, cfg):
 
     self.source_data_dir = '../data/radicals/source'
     self.sheet_dir = '../data/sheet_canvas.jpg'
     self.save_img_dir = '../data/sheet'
+    self.thumbnail_cache_dir = cfg.THUMBNAIL_CACHE_PATH
     self.canvas_size = (1240, 1754)
     self.row_num = 10
     self.col_num = 15
@@ -31,25 +35,25 @@ class GenerateSheet(object):
     if not os.path.isdir(self.save_img_dir):
       os.makedirs(self.save_img_dir)
 
+    if self.thumbnail_cache_dir is None:
+      self.thumbnail_cache = None
+    else:
+      self.thumbnail_cache = ThumbnailCache(
+          self.thumbnail_cache_dir,
+          (self.img_size, self.img_size), img_mode='L')
+
   def _select_image(self, class_name):
 
     class_dir = path.join(self.source_data_dir, class_name)
     img_names = os.listdir(class_dir)
     img_dir = path.join(
       class_dir, img_names[np.random.randint(0, len(img_names))])
-    img = Image.open(img_dir).convert('L')
-    img_width, img_height = img.size
-    selected_image = Image.new('L', (self.img_size, self.img_size), 'white')
-    if img_width > img_height:
-      w_s = self.img_size
-      h_s = int(w_s * img_height // img_width)
-      img = img.resize((w_s, h_s), Image.ANTIALIAS)
-      selected_image.paste(img, (0, int((self.img_size - h_s) // 2)))
+    if self.thumbnail_cache is None:
+      selected_image = letterbox_img(
+          Image.open(img_dir).convert('L'), (self.img_size, self.img_size))
     else:
-      h_s = self.img_size
-      w_s = int(h_s * img_width // img_height)
-      img = img.resize((w_s, h_s), Image.ANTIALIAS)
-      selected_image.paste(img, (int((self.img_size - w_s) // 2), 0))
+      selected_image = Image.fromarray(
+          self.thumbnail_cache.get(img_dir), 'L')
     assert selected_image.size == (self.img_size, self.img_size)
     return selected_image
 
@@ -65,6 +69,8 @@ class GenerateSheet(object):
     for class_name in class_names:
       images.append(self._select_image(str(class_name)))
     assert len(images) == 148
+    if self.thumbnail_cache is not None:
+      self.thumbnail_cache.flush()
 
     horizontal_gap = Image.fromarray(
       np.zeros((self.gap, self.img_size + self.gap)), 'L')
@@ -116,6 +122,7 @@ class GenerateSheet(object):
 
 if __name__ == '__main__':
 
+  # Run from src: python -m data_gen.generate_sheet
   for i in range(10):
-    GS = GenerateSheet()
+    GS = GenerateSheet(config)
     GS.save_images(i)
@@ -1,12 +1,16 @@
+import os
 import pickle
+import hashlib
 import numpy as np
-from PIL import Image
 from tqdm import tqdm
+from os.path import join, isfile
 import tensorflow as tf
 from models import utils
+from models.get_transfer_learning_codes import \
+  get_input_layers, TL_CUSTOM_OBJECTS
 from keras.models import load_model
 from keras.models import Model
-from keras.layers import Dense, GlobalAveragePooling2D
+from keras.layers import Input, Dense, GlobalAveragePooling2D
 from keras.preprocessing.image import ImageDataGenerator
 from keras.callbacks import EarlyStopping, ModelCheckpoint
 
@@ -17,25 +21,33 @@ KTF.set_session(tf.Session(config=tf.ConfigProto(device_count={'gpu':0})))
 from config import config
 
 
-def extract_vgg16():
-  from keras.applications.vgg16 import VGG16, preprocess_input
-  return VGG16(weights='imagenet', include_top=False), preprocess_input
+def extract_vgg16(input_shape):
+  from keras.applications.vgg16 import VGG16
+  _, input_tensor = get_input_layers(input_shape, 'vgg16')
+  return VGG16(weights='imagenet', include_top=False, input_tensor=input_tensor)
 
-def extract_vgg19():
-  from keras.applications.vgg19 import VGG19, preprocess_input
-  return VGG19(weights='imagenet', include_top=False), preprocess_input
+def extract_vgg19(input_shape):
+  from keras.applications.vgg19 import VGG19
+  _, input_tensor = get_input_layers(input_shape, 'vgg19')
+  return VGG19(weights='imagenet', include_top=False, input_tensor=input_tensor)
 
-def extract_resnet50():
-  from keras.applications.resnet50 import ResNet50, preprocess_input
-  return ResNet50(weights='imagenet', include_top=False), preprocess_input
+def extract_resnet50(input_shape):
+  from keras.applications.resnet50 import ResNet50
+  _, input_tensor = get_input_layers(input_shape, 'resnet50')
+  return ResNet50(
+    weights='imagenet', include_top=False, input_tensor=input_tensor)
 
-def extract_xception():
-  from keras.applications.xception import Xception, preprocess_input
-  return Xception(weights='imagenet', include_top=False), preprocess_input
+def extract_xception(input_shape):
+  from keras.applications.xception import Xception
+  _, input_tensor = get_input_layers(input_shape, 'xception')
+  return Xception(
+    weights='imagenet', include_top=False, input_tensor=input_tensor)
 
-def extract_inceptionv3():
-  from keras.applications.inception_v3 import InceptionV3, preprocess_input
-  return InceptionV3(weights='imagenet', include_top=False), preprocess_input
+def extract_inceptionv3(input_shape):
+  from keras.applications.inception_v3 import InceptionV3
+  _, input_tensor = get_input_layers(input_shape, 'inceptionv3')
+  return InceptionV3(
+    weights='imagenet', include_top=False, input_tensor=input_tensor)
 
 
 class FineTune(object):
@@ -47,7 +59,6 @@ class FineTune(object):
     self.base_model_name = base_model_name
     self.n_use_layers = n_use_layers
     self.n_freeze_layers = n_freeze_layers
-    self.base_model, self.preprocess_input = self._get_base_model()
 
     if self.cfg.DATABASE_MODE is not None:
       self.preprocessed_path = join(
@@ -59,10 +70,13 @@ class FineTune(object):
     self.x_train, self.y_train, self.x_valid, self.y_valid = \
       self._load_bottleneck_features()
 
+    # Images are resized and replicated to 3 channels in the model
+    self.base_model = self._get_base_model(self.x_train.shape[1:])
+
     if load_pre_model:
       self.model = self._load_model()
       self.bf_model = \
-        Model(input=self.model.input, output=self.model.layers[:-1].output)
+        Model(input=self.model.input, output=self.model.layers[-2].output)
     else:
       self.model = None
       self.bf_model = None
@@ -98,19 +112,20 @@ class FineTune(object):
 
   @staticmethod
   def _load_model():
-    return load_model('saved_models/model-fine-tuned.h5')
+    return load_model('saved_models/model-fine-tuned.h5',
+                      custom_objects=TL_CUSTOM_OBJECTS)
 
-  def _get_base_model(self):
+  def _get_base_model(self, input_shape):
     if self.base_model_name == 'vgg16':
-      return extract_vgg16()
+      return extract_vgg16(input_shape)
     elif self.base_model_name == 'vgg19':
-      return extract_vgg19()
+      return extract_vgg19(input_shape)
     elif self.base_model_name == 'resnet50':
-      return extract_resnet50()
+      return extract_resnet50(input_shape)
     elif self.base_model_name == 'inceptionv3':
-      return extract_inceptionv3()
+      return extract_inceptionv3(input_shape)
     elif self.base_model_name == 'xception':
-      return extract_inceptionv3()
+      return extract_inceptionv3(input_shape)
 
   def _model_arch(self, base_model):
 
@@ -139,11 +154,9 @@ class FineTune(object):
 
     return model
 
-  def train(self, epochs=100, batch_size=32):
-
-    self.model = self._model_arch(self.base_model)
-
-    train_data_gen = ImageDataGenerator(
+  @staticmethod
+  def _get_train_data_gen():
+    return ImageDataGenerator(
       rotation_range=30,
       width_shift_range=0.2,
       height_shift_range=0.2,
@@ -151,6 +164,141 @@ class FineTune(object):
       zoom_range=0.2,
       horizontal_flip=True,
       fill_mode='nearest')
+
+  @staticmethod
+  def _get_data_fingerprint(x, y, n_samples=64):
+    """Hash of the shapes of x and y, y and a strided sample of x."""
+    sha1 = hashlib.sha1()
+    for a in (x, y):
+      sha1.update('{}{}'.format(a.shape, a.dtype).encode())
+    sha1.update(np.ascontiguousarray(y).tobytes())
+    sha1.update(
+      np.ascontiguousarray(x[::max(1, len(x) // n_samples)]).tobytes())
+    return sha1.hexdigest()[:16]
+
+  def _get_feature_cache_path(self, name, x, y, n_augment):
+    """Path of cached features.
+
+    Keyed on model, cut layer, input shape, augments and the data set.
+    """
+    return join(
+      self.preprocessed_path,
+      'ft_features_{}_{}_{}_l{}_aug{}_{}.npy'.format(
+        self.base_model_name, name, 'x'.join(map(str, x.shape[1:])),
+        self.n_use_layers, n_augment, self._get_data_fingerprint(x, y)))
+
+  def _cache_features(self, feature_model, x, y, name,
+                      batch_size=32, n_augment=0):
+    """Run the frozen base model once and cache pooled features in a memmap.
+
+    If n_augment > 0, n_augment augmented copies of x are appended. A cache
+    of the same model, cut layer, input shape, number of augments and data
+    is reused.
+    """
+    n_copies = n_augment + 1
+    shape = (len(x) * n_copies,) + tuple(feature_model.output_shape[1:])
+    cache_path = self._get_feature_cache_path(name, x, y, n_augment)
+    y_copies = np.concatenate([y] * n_copies, axis=0)
+
+    if isfile(cache_path):
+      features = np.load(cache_path, mmap_mode='r')
+      if features.shape == shape:
+        print('Loading cached features of {} set...'.format(name))
+        return features, y_copies
+
+    # Write to a temporary file, so an interrupted run leaves no cache
+    tmp_path = cache_path + '.tmp'
+    features = np.lib.format.open_memmap(
+      tmp_path, mode='w+', dtype=K.floatx(), shape=shape)
+
+    print('Caching features of {} set ({} copies)...'.format(name, n_copies))
+    self._predict_batches(feature_model, x, batch_size, out=features[:len(x)])
+    data_gen = self._get_train_data_gen()
+    for i in range(1, n_copies):
+      generator = data_gen.flow(x, batch_size=batch_size, shuffle=False)
+      for j in tqdm(range(len(generator)), ncols=100, unit='batch'):
+        start = i * len(x) + j * batch_size
+        x_batch = next(generator)
+        features[start:start + len(x_batch)] = \
+          feature_model.predict_on_batch(x_batch)
+    features.flush()
+    del features
+    os.replace(tmp_path, cache_path)
+
+    return np.load(cache_path, mmap_mode='r'), y_copies
+
+  def _train_on_cached_features(self, epochs, batch_size, n_augment):
+    """Train only the dense layer on cached pooled features of the base."""
+    if self.n_use_layers:
+      x = self.base_model.layers[self.n_use_layers].output
+    else:
+      x = self.base_model.output
+    # Global average pooling has no weights, so it is applied before caching
+    feature_model = Model(input=self.base_model.input,
+                          output=GlobalAveragePooling2D()(x))
+
+    train_features, y_train = self._cache_features(
+      feature_model, self.x_train, self.y_train, 'train',
+      batch_size=batch_size, n_augment=n_augment)
+    valid_features, y_valid = self._cache_features(
+      feature_model, self.x_valid, self.y_valid, 'valid',
+      batch_size=batch_size)
+
+    # The same dense layer is used by the top model and the full model
+    dense_layer = Dense(self.n_output, activation='softmax')
+
+    features = Input(shape=feature_model.output_shape[1:])
+    top_model = Model(input=features, output=dense_layer(features))
+    top_model.compile(loss='categorical_crossentropy', optimizer='adam',
+                      metrics=['accuracy'])
+
+    weights_path = 'saved_models/weights.best.{}.top.hdf5'.format(
+      self.base_model_name)
+    checkpointer = ModelCheckpoint(
+      filepath=weights_path, verbose=1, save_best_only=True)
+    early_stopping = EarlyStopping(monitor='val_loss', min_delta=0.001,
+                                  patience=20, verbose=1)
+
+    # Shuffle in batch-sized chunks for memory-mapped features
+    top_model.fit(
+      train_features, y_train,
+      batch_size=batch_size,
+      epochs=epochs,
+      validation_data=(valid_features, y_valid),
+      shuffle='batch',
+      callbacks=[checkpointer, early_stopping])
+
+    # Load the model weights with the best validation loss.
+    top_model.load_weights(weights_path)
+
+    self.model = Model(input=feature_model.input,
+                       output=dense_layer(feature_model.output))
+    self.model.compile(loss='categorical_crossentropy', optimizer='adam',
+                       metrics=['accuracy'])
+
+  def train(self, epochs=100, batch_size=32, cache_features=False,
+            n_augment=0):
+    """Train the model.
+
+    Args:
+      epochs: number of epochs
+      batch_size: batch size
+      cache_features: if the whole base model is frozen, run it only once
+                      and train the top layers on cached features
+      n_augment: number of augmented copies of the train set to cache
+    """
+    if cache_features and not self.n_freeze_layers:
+      for layer in self.base_model.layers:
+        layer.trainable = False
+      self._train_on_cached_features(epochs, batch_size, n_augment)
+      self.bf_model = \
+        Model(input=self.model.input, output=self.model.layers[-2].output)
+      self._save_model(self.model)
+      return
+
+    self.model = self._model_arch(self.base_model)
+
+    train_data_gen = self._get_train_data_gen()
     train_generator = train_data_gen.flow(self.x_train, self.y_train,
                                          batch_size=batch_size)
 
@@ -179,30 +327,32 @@ class FineTune(object):
 
 
     self.bf_model = \
-      Model(input=self.model.input, output=self.model.layers[:-1].output)
+      Model(input=self.model.input, output=self.model.layers[-2].output)
 
     self._save_model(self.model)
 
-  def _extract_features(self, tensor):
-    predicted_list = []
-    for x in tensor:
-      predicted_list.append(self.bf_model.predict(self.preprocess_input(x)))
-    return np.array(predicted_list)
-
-  def predict(self, tensor):
-    predicted_list = []
-    for x in tensor:
-      predicted_list.append(self.model.predict(self.preprocess_input(x)))
-    return np.array(predicted_list)
+  @staticmethod
+  def _predict_batches(model, tensor, batch_size=32, out=None):
+    """Run the model on batches and fill a preallocated output array."""
+    if out is None:
+      out = np.empty((len(tensor),) + tuple(model.output_shape[1:]),
+                     dtype=K.floatx())
+    for start in range(0, len(tensor), batch_size):
+      end = start + batch_size
+      out[start:end] = model.predict_on_batch(tensor[start:end])
+    return out
+
+  def _extract_features(self, tensor, batch_size=32):
+    return self._predict_batches(self.bf_model, tensor, batch_size)
+
+  def predict(self, tensor, batch_size=32):
+    return self._predict_batches(self.model, tensor, batch_size)
 
   def save_bottleneck_features(self,
                                inputs,
                                file_path,
                                batch_size=None,
                                data_type=np.float32):
-    inputs_shape = inputs.shape
-    img_mode = 'L' if inputs_shape[3] == 1 else 'RGB'
-
     with open(file_path, 'wb') as f:
 
       if batch_size:
@@ -216,35 +366,14 @@ class FineTune(object):
 
         for _ in tqdm(range(n_batch), total=n_batch, ncols=100, unit='batch'):
           inputs_batch = next(batch_generator)
-          inputs_batch = utils.imgs_scale_to_255(inputs_batch).astype(
-            data_type)
-
-          if inputs_shape[1:3] != (224, 224):
-            inputs_batch = utils.img_resize(inputs_batch,
-                                            (224, 224),
-                                            img_mode=img_mode,
-                                            resize_filter=Image.ANTIALIAS,
-                                            verbose=False,
-                                            ).astype(data_type)
-          if inputs_shape[3] == 1:
-            inputs_batch = np.concatenate(
-              [inputs_batch, inputs_batch, inputs_batch], axis=-1)
-
-          assert inputs_batch.shape[1:] == (224, 224, 3)
-          bf_batch = self._extract_features(inputs_batch)
+          inputs_batch = utils.imgs_scale_to_255(
+            inputs_batch, dtype=data_type)
+          bf_batch = self._extract_features(
+            inputs_batch, batch_size=batch_size)
           f.write(pickle.dumps(bf_batch))
 
-          # Release memory
-          K.clear_session()
-          tf.reset_default_graph()
-
       else:
-        inputs = utils.imgs_scale_to_255(inputs).astype(data_type)
-
-        if inputs_shape[3] == 1:
-          inputs = np.concatenate([inputs, inputs, inputs], axis=-1)
-
-        assert inputs.shape[1:] == (224, 224, 3)
+        inputs = utils.imgs_scale_to_255(inputs, dtype=data_type)
         bottleneck_features = self._extract_features(inputs)
         f.write(pickle.dumps(bottleneck_features))
 
@@ -259,4 +388,4 @@ if __name__ == '__main__':
       n_freeze_layers=None,
       load_pre_model=False
   )
-  FT.train(epochs=100, batch_size=16)
+  FT.train(epochs=100, batch_size=16, cache_features=True)
@@ -2,11 +2,14 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
+import os
 import time
 import gc
+import pickle
 import argparse
 import numpy as np
 import tensorflow as tf
+from tensorflow.python.client import timeline
 from tqdm import tqdm
 from os import environ
 from os.path import join, isdir
@@ -19,7 +22,7 @@ from models.capsNet_distribute import CapsNetDistribute
 from models.capsNet_multi_tasks import CapsNetMultiTasks
 from baseline_arch import basel_arch
 from capsNet_arch import caps_arch
-from test import Test, TestMultiObjects, TestOracle
+from test import Test, TestMultiObjects, TestOracle, load_test_data
 
 
 class Main(object):
@@ -32,6 +35,13 @@ class Main(object):
     # Config
     self.cfg = cfg
     self.multi_gpu = True
+    self.image_saver = None
+    self.checkpoint_writer = None
+    self.profiler = None
+
+    if cfg.GRAD_ACCUM_STEPS and mode in ('multi-tasks', 'multi-gpu'):
+      raise ValueError(
+          'GRAD_ACCUM_STEPS is not supported in {} mode!'.format(mode))
 
     if mode == 'multi-tasks':
       self.multi_gpu = True
@@ -58,9 +68,20 @@ class Main(object):
     self.x_train, self.y_train, self.imgs_train, \
         self.x_valid, self.y_valid, self.imgs_valid = self._load_data()
 
+    # Load test sets once, which are shared by tests of every epoch
+    self.test_data = self._load_test_data()
+
     # Calculate number of batches
     self.n_batch_train = len(self.y_train) // cfg.BATCH_SIZE
-    self.n_batch_valid = len(self.y_valid) // cfg.BATCH_SIZE
+
+    # Sampler of training batches
+    self.sampler = self._get_sampler()
+
+    # Fixed slice of valid set evaluated while training
+    self.x_valid_slice, self.y_valid_slice, self.imgs_valid_slice = \
+        self._get_valid_slice()
+    self.valid_metrics = None
+    self.valid_metrics_step = None
 
     # Build graph
     utils.thick_line()
@@ -72,7 +93,21 @@ class Main(object):
         self.rec_images, self.preds = model.build_graph(
             input_size=self.x_train.shape[1:],
             image_size=self.imgs_train.shape[1:],
-            num_class=self.y_train.shape[1])
+            num_class=self.y_train.shape[1],
+            data_dtypes=(self.x_train.dtype,
+                         self.y_train.dtype,
+                         self.imgs_train.dtype))
+    self.input_pipeline = model.input_pipeline
+    self.streaming_metrics = model.streaming_metrics
+    self.apply_accum_op = model.apply_accum_op
+    self.n_splits = model.n_splits
+    self.eval_batch_size = cfg.EVAL_BATCH_SIZE or cfg.BATCH_SIZE
+
+    # Snapshot of variables for saving checkpoints in background
+    if cfg.ASYNC_SAVE_MODEL:
+      self.snapshot_init, self.snapshot_op, self.snapshot_saver = \
+          self._get_snapshot_saver()
+    self.meta_graph = None
 
     # Save config
     self.clf_arch_info = model.clf_arch_info
@@ -93,9 +128,10 @@ class Main(object):
       preprocessed_path = join(self.cfg.DPP_DATA_PATH, self.cfg.DATABASE_NAME)
 
     # Get log paths, append information if the directory exist.
+    # Keep writing to the same directories when resuming training.
     train_log_path = train_log_path_
     i_append_info = 0
-    while isdir(train_log_path):
+    while isdir(train_log_path) and not self.cfg.RESUME:
       i_append_info += 1
       train_log_path = train_log_path_ + '({})'.format(i_append_info)
 
@@ -109,6 +145,11 @@ class Main(object):
     # Images saving path
     train_image_path = join(train_log_path, 'images')
 
+    # Traces saving path
+    self.trace_path = join(train_log_path, 'traces')
+    if self.cfg.TRACE_STEPS:
+      utils.check_dir([self.trace_path])
+
     # Check directory of paths
     utils.check_dir([train_log_path, checkpoint_path])
     if self.cfg.WITH_REC:
@@ -158,111 +199,149 @@ class Main(object):
 
     return x_train, y_train, imgs_train, x_valid, y_valid, imgs_valid
 
+  def _get_snapshot_saver(self):
+    """Get ops to snapshot variables in host memory and a saver of them.
+
+    The saver writes the snapshot under the names of the original variables,
+    so checkpoints are the same as the ones saved by self.saver.
+    """
+    with self.train_graph.as_default(), tf.device('/cpu:0'):
+      with tf.variable_scope('snapshot'):
+        var_list = {}
+        assign_ops = []
+        for var in tf.global_variables():
+          snapshot_var = tf.Variable(
+              tf.zeros(var.get_shape(), dtype=var.dtype.base_dtype),
+              trainable=False,
+              collections=[tf.GraphKeys.LOCAL_VARIABLES],
+              name=var.op.name)
+          var_list[var.op.name] = snapshot_var
+          assign_ops.append(tf.assign(snapshot_var, var))
+        snapshot_init = tf.variables_initializer(list(var_list.values()))
+        snapshot_op = tf.group(*assign_ops)
+      snapshot_saver = tf.train.Saver(
+          var_list, max_to_keep=self.cfg.MAX_TO_KEEP_CKP, name='snapshot_saver')
+    return snapshot_init, snapshot_op, snapshot_saver
+
+  def _get_sampler(self):
+    """Get the sampler shuffling train batches in every epoch."""
+    if self.cfg.TRAIN_SAMPLER is None or self.cfg.INPUT_PIPELINE:
+      return None
+    elif self.cfg.TRAIN_SAMPLER == 'shuffle':
+      y = None
+    elif self.cfg.TRAIN_SAMPLER == 'stratified':
+      y = self.y_train
+    else:
+      raise ValueError('Wrong sampler name: {}!'.format(
+          self.cfg.TRAIN_SAMPLER))
+    return utils.EpochSampler(len(self.y_train), self.cfg.BATCH_SIZE,
+                              y=y, seed=self.cfg.SAMPLER_SEED)
+
+  def _get_valid_slice(self):
+    """Sample a fixed slice of valid set to evaluate while training.
+
+    The size of the slice is rounded to full batches.
+    """
+    batch_size = self.cfg.BATCH_SIZE
+    n_valid = len(self.y_valid)
+    n_slice = min(self.cfg.VALID_SLICE_SIZE or n_valid, n_valid)
+    n_slice = max(n_slice // batch_size, 1) * batch_size
+    valid_idx = np.random.RandomState(0).choice(
+        n_valid, n_slice, replace=n_slice > n_valid)
+    valid_idx = np.sort(valid_idx)
+
+    x_valid_slice = self.x_valid[valid_idx]
+    y_valid_slice = self.y_valid[valid_idx]
+    if self.imgs_valid is self.x_valid:
+      imgs_valid_slice = x_valid_slice
+    else:
+      imgs_valid_slice = self.imgs_valid[valid_idx]
+
+    return x_valid_slice, y_valid_slice, imgs_valid_slice
+
+  def _get_metric_tensors(self):
+    """Get tensors of metrics to fetch along with the optimizer."""
+    metrics = {'loss': self.loss, 'accuracy': self.accuracy}
+    if self.cfg.WITH_REC:
+      metrics['clf_loss'] = self.clf_loss
+      metrics['rec_loss'] = self.rec_loss
+    return metrics
+
+  def _eval_on_valid_slice(self, sess):
+    """Calculate metrics of the valid slice."""
+    loss, clf_loss, rec_loss, accuracy = self._eval_on_batches(
+        'valid', sess, self.x_valid_slice, self.y_valid_slice,
+        self.imgs_valid_slice, silent=True)
+    metrics = {'loss': loss, 'accuracy': accuracy}
+    if self.cfg.WITH_REC:
+      metrics['clf_loss'] = clf_loss
+      metrics['rec_loss'] = rec_loss
+    return metrics
+
+  def _get_valid_metrics(self, sess, step):
+    """Get metrics of the valid slice, reevaluated every VALID_EVAL_STEP."""
+    if (self.valid_metrics is None) or (not self.cfg.VALID_EVAL_STEP) or \
+        (step - self.valid_metrics_step >= self.cfg.VALID_EVAL_STEP):
+      self.valid_metrics = self._eval_on_valid_slice(sess)
+      self.valid_metrics_step = step
+    return self.valid_metrics
+
+  def _load_test_data(self):
+    """Load test sets which will be tested while training."""
+    test_data = {}
+    if self.cfg.TEST_SO_MODE:
+      test_data['single'] = load_test_data(
+          self.cfg, '', mmap=self.cfg.TEST_DATA_MMAP)
+    if self.cfg.TEST_MO_MODE:
+      test_data['multi_obj'] = load_test_data(
+          self.cfg, '_multi_obj', mmap=self.cfg.TEST_DATA_MMAP)
+    if utils.is_radical_database(self.cfg.DATABASE_NAME):
+      if self.cfg.TEST_ORACLE_MODE:
+        test_data['oracle'] = load_test_data(
+            self.cfg, '_oracle', mmap=self.cfg.TEST_DATA_MMAP)
+    return test_data
+
   def _display_status(self,
                       sess,
-                      x_batch,
-                      y_batch,
-                      imgs_batch,
+                      train_metrics,
                       epoch_i,
                       step):
     """Display information during training."""
-    valid_batch_idx = np.random.choice(
-        range(len(self.x_valid)), self.cfg.BATCH_SIZE).tolist()
-    x_valid_batch = self.x_valid[valid_batch_idx]
-    y_valid_batch = self.y_valid[valid_batch_idx]
-    imgs_valid_batch = self.imgs_valid[valid_batch_idx]
-
-    if self.cfg.WITH_REC:
-      loss_train, clf_loss_train, rec_loss_train, acc_train = \
-          sess.run([self.loss, self.clf_loss,
-                    self.rec_loss, self.accuracy],
-                   feed_dict={self.inputs: x_batch,
-                              self.labels: y_batch,
-                              self.input_imgs: imgs_batch,
-                              self.is_training: False})
-      loss_valid, clf_loss_valid, rec_loss_valid, acc_valid = \
-          sess.run([self.loss, self.clf_loss,
-                    self.rec_loss, self.accuracy],
-                   feed_dict={self.inputs: x_valid_batch,
-                              self.labels: y_valid_batch,
-                              self.input_imgs: imgs_valid_batch,
-                              self.is_training: False})
-    else:
-      loss_train, acc_train = \
-          sess.run([self.loss, self.accuracy],
-                   feed_dict={self.inputs: x_batch,
-                              self.labels: y_batch,
-                              self.input_imgs: imgs_batch,
-                              self.is_training: False})
-      loss_valid, acc_valid = \
-          sess.run([self.loss, self.accuracy],
-                   feed_dict={self.inputs: x_valid_batch,
-                              self.labels: y_valid_batch,
-                              self.input_imgs: imgs_valid_batch,
-                              self.is_training: False})
-      clf_loss_train, rec_loss_train, clf_loss_valid, rec_loss_valid = \
-          None, None, None, None
+    valid_metrics = self._get_valid_metrics(sess, step)
 
     utils.print_status(
         epoch_i, self.cfg.EPOCHS, step, self.start_time,
-        loss_train, clf_loss_train, rec_loss_train, acc_train,
-        loss_valid, clf_loss_valid, rec_loss_valid, acc_valid,
+        train_metrics['loss'], train_metrics.get('clf_loss'),
+        train_metrics.get('rec_loss'), train_metrics['accuracy'],
+        valid_metrics['loss'], valid_metrics.get('clf_loss'),
+        valid_metrics.get('rec_loss'), valid_metrics['accuracy'],
         self.cfg.WITH_REC)
 
   def _save_logs(self,
                  sess,
                  train_writer,
                  valid_writer,
-                 x_batch,
-                 y_batch,
-                 imgs_batch,
+                 summary_train,
+                 train_metrics,
                  epoch_i,
                  step):
-    """Save logs and ddd summaries to TensorBoard while training."""
-    valid_batch_idx = np.random.choice(
-        range(len(self.x_valid)), self.cfg.BATCH_SIZE).tolist()
-    x_valid_batch = self.x_valid[valid_batch_idx]
-    y_valid_batch = self.y_valid[valid_batch_idx]
-    imgs_valid_batch = self.imgs_valid[valid_batch_idx]
+    """Save logs and add summaries to TensorBoard while training."""
+    valid_metrics = self._get_valid_metrics(sess, step)
 
-    if self.cfg.WITH_REC:
-      summary_train, loss_train, clf_loss_train, rec_loss_train, acc_train = \
-          sess.run([self.summary, self.loss, self.clf_loss,
-                    self.rec_loss, self.accuracy],
-                   feed_dict={self.inputs: x_batch,
-                              self.labels: y_batch,
-                              self.input_imgs: imgs_batch,
-                              self.is_training: False})
-      summary_valid, loss_valid, clf_loss_valid, rec_loss_valid, acc_valid = \
-          sess.run([self.summary, self.loss, self.clf_loss,
-                    self.rec_loss, self.accuracy],
-                   feed_dict={self.inputs: x_valid_batch,
-                              self.labels: y_valid_batch,
-                              self.input_imgs: imgs_valid_batch,
-                              self.is_training: False})
-    else:
-      summary_train, loss_train, acc_train = \
-          sess.run([self.summary, self.loss, self.accuracy],
-                   feed_dict={self.inputs: x_batch,
-                              self.labels: y_batch,
-                              self.input_imgs: imgs_batch,
-                              self.is_training: False})
-      summary_valid, loss_valid, acc_valid = \
-          sess.run([self.summary, self.loss, self.accuracy],
-                   feed_dict={self.inputs: x_valid_batch,
-                              self.labels: y_valid_batch,
-                              self.input_imgs: imgs_valid_batch,
-                              self.is_training: False})
-      clf_loss_train, rec_loss_train, clf_loss_valid, rec_loss_valid = \
-          None, None, None, None
+    # Summaries of valid set are made of the accumulated metrics
+    summary_valid = tf.Summary(value=[
+        tf.Summary.Value(tag=name, simple_value=value)
+        for name, value in valid_metrics.items()])
 
     train_writer.add_summary(summary_train, step)
     valid_writer.add_summary(summary_valid, step)
     utils.save_log(
         join(self.train_log_path, 'train_log.csv'), epoch_i + 1, step,
-        time.time() - self.start_time, loss_train, clf_loss_train,
-        rec_loss_train, acc_train, loss_valid, clf_loss_valid, rec_loss_valid,
-        acc_valid, self.cfg.WITH_REC)
+        time.time() - self.start_time, train_metrics['loss'],
+        train_metrics.get('clf_loss'), train_metrics.get('rec_loss'),
+        train_metrics['accuracy'], valid_metrics['loss'],
+        valid_metrics.get('clf_loss'), valid_metrics.get('rec_loss'),
+        valid_metrics['accuracy'], self.cfg.WITH_REC)
 
   def _eval_on_batches(self,
                        mode,
@@ -270,63 +349,41 @@ class Main(object):
                        x,
                        y,
                        imgs,
-                       n_batch,
                        silent=False):
-    """Calculate losses and accuracies of full train set."""
-    loss_all = []
-    acc_all = []
-    clf_loss_all = []
-    rec_loss_all = []
-
-    batch_generator = utils.get_batches(
-        x=x,
-        y=y,
-        imgs=imgs,
-        batch_size=self.cfg.BATCH_SIZE)
-
+    """Calculate losses and accuracies of a full set.
+
+    Metrics are accumulated in the graph, weighted by the number of examples
+    of each batch, and fetched once after all batches. If the graph splits
+    batches into towers, the examples of a batch which can not be split
+    equally are fed to every tower, see utils.split_for_towers.
+    """
+    update_op, metrics, reset_op, eval_weight = self.streaming_metrics
+    batch_size = self.eval_batch_size
+    sess.run(reset_op)
+
+    starts = range(0, len(y), batch_size)
     if not silent:
       utils.thin_line()
       print('Calculating loss and accuracy of full {} set...'.format(mode))
-      iterator = tqdm(range(n_batch), total=n_batch, ncols=100, unit=' batches')
-    else:
-      iterator = range(n_batch)
+      starts = tqdm(starts, ncols=100, unit=' batches')
 
-    if self.cfg.WITH_REC:
-      for _ in iterator:
-
-        x_batch, y_batch, imgs_batch = next(batch_generator)
-
-        loss_i, clf_loss_i, rec_loss_i, acc_i = sess.run(
-            [self.loss, self.clf_loss, self.rec_loss, self.accuracy],
-            feed_dict={self.inputs: x_batch,
-                       self.labels: y_batch,
-                       self.input_imgs: imgs_batch,
-                       self.is_training: False})
-        loss_all.append(loss_i)
-        clf_loss_all.append(clf_loss_i)
-        rec_loss_all.append(rec_loss_i)
-        acc_all.append(acc_i)
-      clf_loss = sum(clf_loss_all) / len(clf_loss_all)
-      rec_loss = sum(rec_loss_all) / len(rec_loss_all)
-    else:
-      for _ in iterator:
+    for start in starts:
+      x_batch = x[start:start + batch_size]
+      y_batch = y[start:start + batch_size]
+      imgs_batch = imgs[start:start + batch_size]
 
-        x_batch, y_batch, imgs_batch = next(batch_generator)
+      for idx, n_examples in utils.split_for_towers(
+            len(y_batch), self.n_splits):
+        sess.run(update_op, feed_dict={self.inputs: x_batch[idx],
+                                       self.labels: y_batch[idx],
+                                       self.input_imgs: imgs_batch[idx],
+                                       self.is_training: False,
+                                       eval_weight: n_examples})
 
-        loss_i, acc_i = sess.run(
-            [self.loss, self.accuracy],
-            feed_dict={self.inputs: x_batch,
-                       self.labels: y_batch,
-                       self.input_imgs: imgs_batch,
-                       self.is_training: False})
-        loss_all.append(loss_i)
-        acc_all.append(acc_i)
-      clf_loss, rec_loss = None, None
+    metrics_ = sess.run(metrics)
 
-    loss = sum(loss_all) / len(loss_all)
-    accuracy = sum(acc_all) / len(acc_all)
-
-    return loss, clf_loss, rec_loss, accuracy
+    return metrics_['loss'], metrics_.get('clf_loss'), \
+        metrics_.get('rec_loss'), metrics_['accuracy']
 
   def _eval_on_full_set(self,
                         sess,
@@ -345,7 +402,7 @@ class Main(object):
       loss_train, clf_loss_train, rec_loss_train, acc_train = \
           self._eval_on_batches(
               'train', sess, self.x_train, self.y_train,
-              self.imgs_train, self.n_batch_train, silent=silent)
+              self.imgs_train, silent=silent)
     else:
       loss_train, clf_loss_train, rec_loss_train, acc_train = \
           None, None, None, None
@@ -354,7 +411,7 @@ class Main(object):
     loss_valid, clf_loss_valid, rec_loss_valid, acc_valid = \
         self._eval_on_batches(
             'valid', sess, self.x_valid, self.y_valid,
-            self.imgs_valid, self.n_batch_valid, silent=silent)
+            self.imgs_valid, silent=silent)
 
     if not silent:
       utils.print_full_set_eval(
@@ -395,7 +452,8 @@ class Main(object):
                                     self.is_training: False})
 
     # rec_images_ shape: [128, 28, 28, 1] for mnist
-    utils.save_imgs(
+    self.image_saver.submit(
+        utils.save_imgs,
         real_imgs=imgs,
         rec_imgs=rec_images_,
         img_path=img_path,
@@ -406,17 +464,114 @@ class Main(object):
         epoch_i=epoch_i,
         test_flag=test_flag)
 
+  def _get_train_state(self, step, epoch_i, batch_i, sampler_state):
+    """Get the state to resume training from.
+
+    Args:
+      step: number of trained batches, which also sets the learning rate
+      epoch_i: index of the epoch to resume
+      batch_i: number of trained batches in that epoch
+      sampler_state: state of the sampler when the epoch started
+    """
+    return {'step': step,
+            'epoch': epoch_i,
+            'batch': batch_i,
+            'sampler_state': sampler_state,
+            'train_time': time.time() - self.start_time}
+
+  def _save_train_state(self, saver, ckp_path, train_state):
+    """Save the train state next to a checkpoint, remove old states."""
+    with open(ckp_path + '.state', 'wb') as f:
+      pickle.dump(train_state, f)
+    for f_name in os.listdir(self.checkpoint_path):
+      state_path = join(self.checkpoint_path, f_name)
+      if f_name.endswith('.state') and \
+          state_path[:-len('.state')] not in saver.last_checkpoints:
+        os.remove(state_path)
+
   def _save_model(self,
                   sess,
                   saver,
                   step,
-                  silent=False):
+                  silent=False,
+                  train_state=None):
     """Save models."""
     save_path = join(self.checkpoint_path, 'models.ckpt')
     if not silent:
       utils.thin_line()
       print('Saving models to {}...'.format(save_path))
-    saver.save(sess, save_path, global_step=step)
+    if self.cfg.ASYNC_SAVE_MODEL:
+      # The meta graph is the same for all checkpoints
+      if self.meta_graph is None:
+        self.meta_graph = saver.export_meta_graph().SerializeToString()
+      # Wait for the last snapshot to be written before overwriting it
+      self.checkpoint_writer.join()
+      sess.run(self.snapshot_op)
+      self.checkpoint_writer.submit(
+          self._write_snapshot, sess, save_path, step, train_state)
+    else:
+      ckp_path = saver.save(sess, save_path, global_step=step)
+      if train_state is not None:
+        self._save_train_state(saver, ckp_path, train_state)
+
+  def _write_snapshot(self, sess, save_path, step, train_state=None):
+    """Write the snapshot of variables to a checkpoint."""
+    ckp_path = self.snapshot_saver.save(
+        sess, save_path, global_step=step, write_meta_graph=False)
+    with open(ckp_path + '.meta', 'wb') as f:
+      f.write(self.meta_graph)
+    if train_state is not None:
+      self._save_train_state(self.snapshot_saver, ckp_path, train_state)
+
+  def _restore_checkpoint(self, sess):
+    """Restore the latest checkpoint and the train state saved with it.
+
+    Returns:
+      tuple of (step, epoch_i, batch_i) to resume from
+    """
+    ckp_state = tf.train.get_checkpoint_state(self.checkpoint_path)
+    if ckp_state is None:
+      utils.thin_line()
+      print('[W] No checkpoint in {}, training from scratch.'.format(
+          self.checkpoint_path))
+      return 0, 0, 0
+
+    # Use the same form of paths as the saver
+    ckp_paths = [join(self.checkpoint_path, os.path.basename(p))
+                 for p in ckp_state.all_model_checkpoint_paths]
+    ckp_path = join(self.checkpoint_path,
+                    os.path.basename(ckp_state.model_checkpoint_path))
+    utils.thin_line()
+    print('Resuming from {}...'.format(ckp_path))
+    self.saver.restore(sess, ckp_path)
+
+    # Old checkpoints are still deleted according to MAX_TO_KEEP_CKP
+    saver = self.snapshot_saver if self.cfg.ASYNC_SAVE_MODEL else self.saver
+    saver.recover_last_checkpoints(ckp_paths)
+
+    if not os.path.isfile(ckp_path + '.state'):
+      print('[W] No train state of the checkpoint, '
+            'training from the first epoch.')
+      return 0, 0, 0
+    with open(ckp_path + '.state', 'rb') as f:
+      train_state = pickle.load(f)
+    if self.sampler is not None:
+      self.sampler.set_state(train_state['sampler_state'])
+    self.start_time -= train_state['train_time']
+    print('Epoch: {} | Batch: {} | Step: {}'.format(
+        train_state['epoch'] + 1, train_state['batch'], train_state['step']))
+
+    return train_state['step'], train_state['epoch'], train_state['batch']
+
+  def _truncate_logs(self, step):
+    """Remove rows logged after the restored step from training logs.
+
+    Rows are logged with step - 1, so rows of steps which are trained again
+    after resuming are removed.
+    """
+    for log_name in ['train_log.csv', 'full_set_eval_log.csv',
+                     'timing_log.csv']:
+      utils.truncate_log(join(self.train_log_path, log_name), step)
 
   def _test(self,
             sess,
@@ -436,7 +591,9 @@ class Main(object):
         epoch_train=epoch,
         step_train=step,
         clf_arch_info=self.clf_arch_info,
-        rec_arch_info=self.rec_arch_info
+        rec_arch_info=self.rec_arch_info,
+        image_saver=self.image_saver,
+        test_data=self.test_data.get(mode)
     )
 
     if mode == 'single':
@@ -456,6 +613,74 @@ class Main(object):
         self.is_training, self.preds, self.rec_images, start_time_test,
         self.loss, self.accuracy, self.clf_loss, self.rec_loss)
 
+  def _init_input_pipeline(self, sess):
+    """Feed train set to the input pipeline and initialize its iterator."""
+    utils.thin_line()
+    print('Initializing input pipeline...')
+    initializer, x_data, y_data, imgs_data = self.input_pipeline
+    feed_dict = {x_data: self.x_train, y_data: self.y_train}
+    if self.imgs_train is not self.x_train:
+      feed_dict[imgs_data] = self.imgs_train
+    sess.run(initializer, feed_dict=feed_dict)
+
+  def _get_step_timer(self):
+    """Get the timer of training steps, which does nothing if turned off."""
+    if self.cfg.TIMING_LOG_STEP:
+      return utils.StepTimer(
+          ('batch', 'optimizer', 'logs', 'images',
+           'checkpoint', 'eval', 'test', 'trace'),
+          self.cfg.BATCH_SIZE, window=self.cfg.TIMING_WINDOW)
+    else:
+      return utils.NullStepTimer()
+
+  def _save_timing(self, train_writer, epoch_i, step):
+    """Save time breakdown of recent steps to TensorBoard and a csv file."""
+    stats = self.step_timer.get_stats()
+    if not stats:
+      return
+    train_writer.add_summary(tf.Summary(value=[
+        tf.Summary.Value(tag='timing/' + name, simple_value=value)
+        for name, value in stats.items()]), step)
+    utils.save_timing_log(
+        join(self.train_log_path, 'timing_log.csv'), epoch_i + 1, step, stats)
+
+  def _is_trace_step(self, step):
+    """Check if the step is in the window of TRACE_STEPS."""
+    if self.cfg.TRACE_STEPS:
+      start, end = self.cfg.TRACE_STEPS
+      return start <= step < end
+    return False
+
+  def _save_trace(self, sess, train_writer, run_metadata, step):
+    """Save the timeline of a traced step, and add it to the profiler."""
+    train_writer.add_run_metadata(run_metadata, 'step_{}'.format(step), step)
+
+    file_path = join(self.trace_path, 'timeline_step_{}.json'.format(step))
+    trace = timeline.Timeline(run_metadata.step_stats, graph=sess.graph)
+    with open(file_path, 'w') as f:
+      f.write(trace.generate_chrome_trace_format(show_memory=True))
+
+    if self.profiler is None:
+      self.profiler = tf.profiler.Profiler(sess.graph)
+    self.profiler.add_step(step, run_metadata)
+
+  def _save_trace_summary(self):
+    """Save time and memory of ops and name scopes of all traced steps."""
+    utils.thin_line()
+    print('Saving op costs of traced steps to {}...'.format(self.trace_path))
+    options = tf.profiler.ProfileOptionBuilder(
+        tf.profiler.ProfileOptionBuilder.time_and_memory()).select(
+            ['micros', 'bytes', 'peak_bytes', 'occurrence']).order_by(
+                'micros')
+
+    # Cost of each op type
+    self.profiler.profile_operations(options.with_file_output(
+        join(self.trace_path, 'op_cost.txt')).build())
+    # Cost of each name scope, e.g. dynamic_routing of capsule layers
+    self.profiler.profile_name_scope(options.with_file_output(
+        join(self.trace_path, 'scope_cost.txt')).build())
+    self.profiler = None
+
   def _trainer(self, sess):
 
     utils.thick_line()
@@ -472,103 +697,205 @@ class Main(object):
     valid_writer = tf.summary.FileWriter(valid_summary_path)
 
     sess.run(tf.global_variables_initializer())
-    step = 0
+    if self.cfg.ASYNC_SAVE_MODEL:
+      sess.run(self.snapshot_init)
+    if self.cfg.INPUT_PIPELINE:
+      self._init_input_pipeline(sess)
+
+    if self.cfg.RESUME:
+      step, start_epoch, start_batch = self._restore_checkpoint(sess)
+      self._truncate_logs(step)
+    else:
+      step, start_epoch, start_batch = 0, 0, 0
+
+    # Timer of phases of training steps
+    self.step_timer = timer = self._get_step_timer()
 
-    for epoch_i in range(self.cfg.EPOCHS):
+    for epoch_i in range(start_epoch, self.cfg.EPOCHS):
 
       epoch_start_time = time.time()
       utils.thick_line()
       print('Training on epoch: {}/{}'.format(epoch_i + 1, self.cfg.EPOCHS))
 
+      # The first epoch may be resumed from the middle
+      if epoch_i > start_epoch:
+        start_batch = 0
+
       utils.thin_line()
-      train_batch_generator = utils.get_batches(
-          x=self.x_train,
-          y=self.y_train,
-          imgs=self.imgs_train,
-          batch_size=self.cfg.BATCH_SIZE)
+      if self.sampler is not None:
+        epoch_sampler_state = self.sampler.get_state()
+        train_batch_generator = self.sampler.get_batches(
+            x=self.x_train,
+            y=self.y_train,
+            imgs=self.imgs_train,
+            start_batch=start_batch)
+      else:
+        epoch_sampler_state = None
+        if not self.cfg.INPUT_PIPELINE:
+          start = start_batch * self.cfg.BATCH_SIZE
+          train_batch_generator = utils.get_batches(
+              x=self.x_train[start:],
+              y=self.y_train[start:],
+              imgs=self.imgs_train[start:],
+              batch_size=self.cfg.BATCH_SIZE)
 
       if self.cfg.DISPLAY_STEP:
-        iterator = range(self.n_batch_train)
+        iterator = range(start_batch, self.n_batch_train)
         silent = False
       else:
-        iterator = tqdm(range(self.n_batch_train),
-                        total=self.n_batch_train,
+        iterator = tqdm(range(start_batch, self.n_batch_train),
+                        total=self.n_batch_train, initial=start_batch,
                         ncols=100, unit=' batch')
         silent = True
 
-      for _ in iterator:
+      for batch_i in iterator:
 
         step += 1
-        x_batch, y_batch, imgs_batch = next(train_batch_generator)
+        display_step = bool(self.cfg.DISPLAY_STEP) and \
+            step % self.cfg.DISPLAY_STEP == 0
+        log_step = bool(self.cfg.SAVE_LOG_STEP) and \
+            step % self.cfg.SAVE_LOG_STEP == 0
+        image_step = bool(self.cfg.SAVE_IMAGE_STEP) and \
+            self.cfg.WITH_REC and step % self.cfg.SAVE_IMAGE_STEP == 0
+
+        # Metrics and summaries of the train batch are fetched
+        # in the same run as the optimizer
+        fetches = {'train_op': self.optimizer}
+        if display_step or log_step:
+          fetches['metrics'] = self._get_metric_tensors()
+        if log_step:
+          fetches['summary'] = self.summary
+        feed_dict = {self.step: step-1, self.is_training: True}
+
+        # Collect the full trace of the step
+        trace_step = self._is_trace_step(step-1)
+        if trace_step:
+          run_metadata = tf.RunMetadata()
+          run_kwargs = dict(
+              options=tf.RunOptions(trace_level=tf.RunOptions.FULL_TRACE),
+              run_metadata=run_metadata)
+        else:
+          run_kwargs = {}
 
         # Training optimizer
-        sess.run(self.optimizer, feed_dict={self.inputs: x_batch,
-                                            self.labels: y_batch,
-                                            self.input_imgs: imgs_batch,
-                                            self.step: step-1,
-                                            self.is_training: True})
+        # With feed_dict, the optimizer time includes copying the batch
+        if self.cfg.INPUT_PIPELINE:
+          # Fetch the train batch only if it is needed for images
+          if image_step:
+            fetches['batch'] = [self.inputs, self.labels, self.input_imgs]
+          with timer.phase('optimizer'):
+            results = sess.run(fetches, feed_dict=feed_dict, **run_kwargs)
+          if image_step:
+            x_batch, y_batch, imgs_batch = results['batch']
+        else:
+          with timer.phase('batch'):
+            x_batch, y_batch, imgs_batch = next(train_batch_generator)
+          feed_dict.update({self.inputs: x_batch,
+                            self.labels: y_batch,
+                            self.input_imgs: imgs_batch})
+          with timer.phase('optimizer'):
+            results = sess.run(fetches, feed_dict=feed_dict, **run_kwargs)
+
+        # Apply accumulated gradients of GRAD_ACCUM_STEPS micro-batches,
+        # learning rate decays with the number of applied updates
+        if self.apply_accum_op is not None:
+          if step % self.cfg.GRAD_ACCUM_STEPS == 0:
+            with timer.phase('optimizer'):
+              sess.run(self.apply_accum_op, feed_dict={
+                self.step: step // self.cfg.GRAD_ACCUM_STEPS - 1})
+
+        # Save traces
+        if trace_step:
+          with timer.phase('trace'):
+            self._save_trace(sess, train_writer, run_metadata, step-1)
+            if step == self.cfg.TRACE_STEPS[1]:
+              self._save_trace_summary()
 
         # Display training information
-        if self.cfg.DISPLAY_STEP:
-          if step % self.cfg.DISPLAY_STEP == 0:
-            self._display_status(sess, x_batch, y_batch,
-                                 imgs_batch, epoch_i, step-1)
+        if display_step:
+          with timer.phase('logs'):
+            self._display_status(sess, results['metrics'], epoch_i, step-1)
 
         # Save training logs
-        if self.cfg.SAVE_LOG_STEP:
-          if step % self.cfg.SAVE_LOG_STEP == 0:
+        if log_step:
+          with timer.phase('logs'):
             self._save_logs(sess, train_writer, valid_writer,
-                            x_batch, y_batch, imgs_batch, epoch_i, step-1)
+                            results['summary'], results['metrics'],
+                            epoch_i, step-1)
 
         # Save reconstruction images
-        if self.cfg.SAVE_IMAGE_STEP:
-          if self.cfg.WITH_REC:
-            if step % self.cfg.SAVE_IMAGE_STEP == 0:
-              self._save_images(
-                  sess, self.train_image_path, x_batch, y_batch, imgs_batch,
-                  step-1, epoch_i=epoch_i, silent=silent)
+        if image_step:
+          with timer.phase('images'):
+            self._save_images(
+                sess, self.train_image_path, x_batch, y_batch, imgs_batch,
+                step-1, epoch_i=epoch_i, silent=silent)
 
         # Save models
         if self.cfg.SAVE_MODEL_MODE == 'per_batch':
           if step % self.cfg.SAVE_MODEL_STEP == 0:
-            self._save_model(sess, self.saver, step-1, silent=silent)
+            with timer.phase('checkpoint'):
+              self._save_model(
+                  sess, self.saver, step-1, silent=silent,
+                  train_state=self._get_train_state(
+                      step, epoch_i, batch_i + 1, epoch_sampler_state))
 
         # Evaluate on full set
         if self.cfg.FULL_SET_EVAL_MODE == 'per_batch':
           if step % self.cfg.FULL_SET_EVAL_STEP == 0:
-            self._eval_on_full_set(sess, epoch_i, step-1, silent=silent)
+            with timer.phase('eval'):
+              self._eval_on_full_set(sess, epoch_i, step-1, silent=silent)
+
+        timer.end_step()
+
+        # Save time breakdown of steps
+        if self.cfg.TIMING_LOG_STEP:
+          if step % self.cfg.TIMING_LOG_STEP == 0:
+            self._save_timing(train_writer, epoch_i, step-1)
 
       # Save model per epoch
       if self.cfg.SAVE_MODEL_MODE == 'per_epoch':
         if (epoch_i + 1) % self.cfg.SAVE_MODEL_STEP == 0:
-          self._save_model(sess, self.saver, epoch_i)
+          with timer.phase('checkpoint'):
+            self._save_model(
+                sess, self.saver, epoch_i,
+                train_state=self._get_train_state(
+                    step, epoch_i + 1, 0,
+                    self.sampler and self.sampler.get_state()))
 
       # Evaluate on valid set per epoch
       if self.cfg.FULL_SET_EVAL_MODE == 'per_epoch':
         if (epoch_i + 1) % self.cfg.FULL_SET_EVAL_STEP == 0:
-          self._eval_on_full_set(sess, epoch_i, step-1)
+          with timer.phase('eval'):
+            self._eval_on_full_set(sess, epoch_i, step-1)
 
       # Evaluate on test set per epoch
       if self.cfg.TEST_SO_MODE == 'per_epoch':
-        self._test(sess, during_training=True,
-                   epoch=epoch_i, step=step, mode='single')
+        with timer.phase('test'):
+          self._test(sess, during_training=True,
+                     epoch=epoch_i, step=step, mode='single')
 
       # Evaluate on multi-objects test set per epoch
       if self.cfg.TEST_MO_MODE == 'per_epoch':
-        self._test(sess, during_training=True,
-                   epoch=epoch_i, step=step, mode='multi_obj')
+        with timer.phase('test'):
+          self._test(sess, during_training=True,
+                     epoch=epoch_i, step=step, mode='multi_obj')
 
       # Evaluate on Oracles test set per epoch
       if utils.is_radical_database(self.cfg.DATABASE_NAME):
         if self.cfg.TEST_ORACLE_MODE == 'per_epoch':
-          self._test(sess, during_training=True,
-                     epoch=epoch_i, step=step, mode='oracle')
+          with timer.phase('test'):
+            self._test(sess, during_training=True,
+                       epoch=epoch_i, step=step, mode='oracle')
 
       utils.thin_line()
       print('Epoch {}/{} done! Using time: {:.2f}'
             .format(epoch_i + 1, self.cfg.EPOCHS,
                     time.time() - epoch_start_time))
 
+    # Save op costs if training finished inside the window of traces
+    if self.profiler is not None:
+      self._save_trace_summary()
+
     utils.thick_line()
     print('Training finished! Using time: {:.2f}'
           .format(time.time() - self.start_time))
@@ -592,18 +919,39 @@ class Main(object):
           .format(time.time() - self.start_time))
     utils.thick_line()
 
+  def _run_trainer(self, sess):
+    """Run the trainer, wait for pending checkpoints before closing sess."""
+    try:
+      self._trainer(sess)
+    finally:
+      if self.checkpoint_writer is not None:
+        self.checkpoint_writer.close()
+
   def train(self):
     """Training models."""
     session_cfg = tf.ConfigProto(allow_soft_placement=True)
     session_cfg.gpu_options.allow_growth = True
 
-    if self.cfg.VAR_ON_CPU:
-      with tf.Session(graph=self.train_graph, config=session_cfg) as sess:
-        with tf.device('/cpu:0'):
-          self._trainer(sess)
-    else:
-      with tf.Session(graph=self.train_graph, config=session_cfg) as sess:
-        self._trainer(sess)
+    # Save reconstructed images in background
+    self.image_saver = utils.BackgroundWorker(
+        max_queue_size=self.cfg.IMAGE_SAVER_QUEUE_SIZE, name='image_saver')
+
+    # Write checkpoints in background
+    if self.cfg.ASYNC_SAVE_MODEL:
+      self.checkpoint_writer = utils.BackgroundWorker(
+          max_queue_size=1, name='checkpoint_writer')
+
+    try:
+      if self.cfg.VAR_ON_CPU:
+        with tf.Session(graph=self.train_graph, config=session_cfg) as sess:
+          with tf.device('/cpu:0'):
+            self._run_trainer(sess)
+      else:
+        with tf.Session(graph=self.train_graph, config=session_cfg) as sess:
+          self._run_trainer(sess)
+    finally:
+      # Wait for pending images to be written
+      self.image_saver.close()
 
 
 if __name__ == '__main__':
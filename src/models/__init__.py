@@ -1,10 +1,3 @@
 from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
-
-from models import utils
-from models import layers
-from models import caps_activate_fn
-from models import capsule_layers
-from models import capsNet
-from models import capsNet_distribute
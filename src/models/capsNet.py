@@ -14,31 +14,105 @@ class CapsNet(object):
                model_arch):
 
     self.cfg = cfg
-    self.batch_size = cfg.BATCH_SIZE
+    # Number of equal parts a batch is split into, which the batch size
+    # of inputs should be divisible by
+    self.n_splits = 1
     self.classifier = model_arch['classifier']
     self.decoder = model_arch['decoder']
     self.clf_arch_info = None
     self.rec_arch_info = None
+    self.input_pipeline = None
+    self.streaming_metrics = None
+    self.apply_accum_op = None
+
+  def _get_input_pipeline(self,
+                          input_size,
+                          num_class,
+                          image_size,
+                          data_dtypes=None):
+    """Get the next batch of a tf.data input pipeline.
+
+    The pipeline reads the full train arrays, which are fed to the data
+    placeholders once when the iterator is initialized. If images are the
+    inputs themselves, imgs_data defaults to x_data and need not be fed.
+
+    Args:
+      input_size: the size of input tensor
+      num_class: number of class of label
+      image_size: the size of ground truth images, should be 3 dimensional
+      data_dtypes: data types of (x, y, imgs) arrays, float32 if None
+    Returns:
+      tensors of the next batch (inputs, labels, input_imgs)
+    """
+    x_dtype, y_dtype, imgs_dtype = data_dtypes or (tf.float32,) * 3
+
+    with tf.name_scope('input_pipeline'):
+      x_data = tf.placeholder(
+          x_dtype, shape=[None, *input_size], name='x_data')
+      y_data = tf.placeholder(
+          y_dtype, shape=[None, num_class], name='y_data')
+      if tuple(image_size) == tuple(input_size) and imgs_dtype == x_dtype:
+        imgs_data = tf.placeholder_with_default(
+            x_data, shape=[None, *image_size], name='imgs_data')
+      else:
+        imgs_data = tf.placeholder(
+            imgs_dtype, shape=[None, *image_size], name='imgs_data')
+
+      dataset = tf.data.Dataset.from_tensor_slices((x_data, y_data, imgs_data))
+      if self.cfg.INPUT_SHUFFLE_BUFFER:
+        dataset = dataset.shuffle(self.cfg.INPUT_SHUFFLE_BUFFER)
+      # Repeat after batching, so batches never cross epochs
+      dataset = dataset.batch(self.cfg.BATCH_SIZE, drop_remainder=True)
+      dataset = dataset.repeat()
+      # Cast whole batches to float32
+      dataset = dataset.map(
+          lambda x, y, imgs: (tf.cast(x, tf.float32),
+                              tf.cast(y, tf.float32),
+                              tf.cast(imgs, tf.float32)),
+          num_parallel_calls=self.cfg.INPUT_MAP_THREADS)
+      dataset = dataset.prefetch(self.cfg.INPUT_PREFETCH_BATCHES)
+      iterator = dataset.make_initializable_iterator()
+
+    self.input_pipeline = (iterator.initializer, x_data, y_data, imgs_data)
+
+    return iterator.get_next()
 
   def _get_inputs(self,
                   input_size,
                   num_class,
-                  image_size=None):
+                  image_size=None,
+                  data_dtypes=None):
     """Get input tensors.
 
+    If cfg.INPUT_PIPELINE is True, inputs, labels and input_imgs read from
+    the input pipeline by default, and feeding them overrides the pipeline.
+
     Args:
       input_size: the size of input tensor
       num_class: number of class of label
       image_size: the size of ground truth images, should be 3 dimensional
+      data_dtypes: data types of (x, y, imgs) arrays of the input pipeline
     Returns:
       input tensors
     """
-    _inputs = tf.placeholder(
-        tf.float32, shape=[self.cfg.BATCH_SIZE, *input_size], name='inputs')
-    _labels = tf.placeholder(
-        tf.float32, shape=[self.cfg.BATCH_SIZE, num_class], name='labels')
-    _input_imgs = tf.placeholder(
-        tf.float32, shape=[self.cfg.BATCH_SIZE, *image_size], name='input_imgs')
+    inputs_shape = [None, *input_size]
+    labels_shape = [None, num_class]
+    imgs_shape = [None, *image_size]
+
+    if self.cfg.INPUT_PIPELINE:
+      x_next, y_next, imgs_next = self._get_input_pipeline(
+          input_size, num_class, image_size, data_dtypes=data_dtypes)
+      _inputs = tf.placeholder_with_default(
+          x_next, shape=inputs_shape, name='inputs')
+      _labels = tf.placeholder_with_default(
+          y_next, shape=labels_shape, name='labels')
+      _input_imgs = tf.placeholder_with_default(
+          imgs_next, shape=imgs_shape, name='input_imgs')
+    else:
+      _inputs = tf.placeholder(tf.float32, shape=inputs_shape, name='inputs')
+      _labels = tf.placeholder(tf.float32, shape=labels_shape, name='labels')
+      _input_imgs = tf.placeholder(
+          tf.float32, shape=imgs_shape, name='input_imgs')
     _is_training = tf.placeholder(tf.bool, name='is_training')
 
     return _inputs, _labels, _input_imgs, _is_training
@@ -65,8 +139,11 @@ class CapsNet(object):
     elif opt_name == 'momentum':
       n_batches_per_epoch = \
           n_train_samples // self.cfg.GPU_BATCH_SIZE * self.cfg.GPU_NUMBER
+      # global_step is the number of applied updates
+      if self.cfg.GRAD_ACCUM_STEPS and self.cfg.GRAD_ACCUM_STEPS > 1:
+        n_batches_per_epoch /= self.cfg.GRAD_ACCUM_STEPS
       boundaries = [
-          n_batches_per_epoch * x
+          np.int64(n_batches_per_epoch * x)
           for x in np.array(self.cfg.LR_BOUNDARIES, dtype=np.int64)]
       staged_lr = [self.cfg.LEARNING_RATE * x
                    for x in self.cfg.LR_STAGE]
@@ -110,12 +187,12 @@ class CapsNet(object):
 
     max_square_plus = tf.square(tf.maximum(
         0., m_plus - utils.get_vec_length(
-            logits, self.batch_size, self.cfg.EPSILON)))
+            logits, None, self.cfg.EPSILON)))
     max_square_minus = tf.square(tf.maximum(
         0., utils.get_vec_length(
-            logits, self.batch_size, self.cfg.EPSILON) - m_minus))
+            logits, None, self.cfg.EPSILON) - m_minus))
     # max_square_plus & max_plus shape: (batch_size, num_caps)
-    assert max_square_plus.get_shape() == (self.batch_size, num_caps)
+    assert max_square_plus.get_shape().is_compatible_with((None, num_caps))
 
     loss_c = tf.multiply(labels, max_square_plus) + \
         lambda_ * tf.multiply((1 - labels), max_square_minus)
@@ -145,8 +222,7 @@ class CapsNet(object):
     Returns:
       A scalar with cost for all data point.
     """
-    logits = utils.get_vec_length(
-        logits, self.batch_size, self.cfg.EPSILON) - 0.5
+    logits = utils.get_vec_length(logits, None, self.cfg.EPSILON) - 0.5
     positive_cost = labels * tf.cast(tf.less(logits, margin),
                                      tf.float32) * tf.pow(logits - margin, 2)
     negative_cost = (1 - labels) * tf.cast(
@@ -179,8 +255,7 @@ class CapsNet(object):
     with tf.variable_scope('decoder'):
       # _reconstructed shape: (batch_size, image_size*image_size)
       _reconstructed, self.rec_arch_info = self.decoder(
-          _masked, self.cfg, batch_size=self.batch_size,
-          is_training=is_training)
+          _masked, self.cfg, is_training=is_training)
 
     return _reconstructed
 
@@ -316,16 +391,16 @@ class CapsNet(object):
         - shape: (batch_size, num_caps, vec_dim)
     """
     logits, self.clf_arch_info = self.classifier(
-        inputs, self.cfg, self.batch_size, is_training=is_training)
+        inputs, self.cfg, is_training=is_training)
 
     # Logits shape: (batch_size, num_caps, vec_dim, 1)
-    logits = tf.squeeze(logits, name='logits')
+    logits = tf.squeeze(logits, axis=-1, name='logits')
     if self.cfg.SHOW_TRAINING_DETAILS:
       logits = tf.Print(logits, [tf.constant(3)],
                         message="\nCAPSULE layers passed...")
 
     # Predictions
-    preds = utils.get_vec_length(logits, self.batch_size, self.cfg.EPSILON)
+    preds = utils.get_vec_length(logits, None, self.cfg.EPSILON)
     preds = tf.identity(preds, name='preds')
 
     # Accuracy
@@ -335,11 +410,93 @@ class CapsNet(object):
 
     return logits, accuracy, preds
 
+  def _get_streaming_metrics(self,
+                             loss,
+                             accuracy,
+                             classifier_loss=None,
+                             reconstruct_loss=None):
+    """Get accumulators of metrics to evaluate a full set batch by batch.
+
+    Each update adds metrics of a batch multiplied by eval_weight, which is
+    the number of examples in the batch.
+
+    Returns:
+      tuple of (update_op, dict of accumulated means, reset_op, eval_weight)
+    """
+    metrics = {'loss': loss, 'accuracy': accuracy}
+    if self.cfg.WITH_REC:
+      metrics['clf_loss'] = classifier_loss
+      metrics['rec_loss'] = reconstruct_loss
+
+    with tf.variable_scope('streaming_metrics'):
+      eval_weight = tf.placeholder_with_default(
+          float(self.cfg.BATCH_SIZE), shape=(), name='eval_weight')
+
+      def _accumulator(name):
+        return tf.get_variable(
+            name, shape=(), dtype=tf.float32,
+            initializer=tf.zeros_initializer(), trainable=False,
+            collections=[tf.GraphKeys.LOCAL_VARIABLES])
+
+      n_examples = _accumulator('n_examples')
+      update_ops = [tf.assign_add(n_examples, eval_weight)]
+      means = {}
+      for name, value in metrics.items():
+        total = _accumulator('total_' + name)
+        update_ops.append(tf.assign_add(total, value * eval_weight))
+        means[name] = tf.divide(total, n_examples, name=name)
+
+      update_op = tf.group(*update_ops, name='update_op')
+      reset_op = tf.variables_initializer(
+          tf.get_collection(tf.GraphKeys.LOCAL_VARIABLES,
+                            scope=tf.get_variable_scope().name),
+          name='reset_op')
+
+    self.streaming_metrics = (update_op, means, reset_op, eval_weight)
+
+  def _accumulate_gradients(self, optimizer, loss):
+    """Accumulate gradients of micro-batches.
+
+    The accumulated gradients are averaged and applied by self.apply_accum_op,
+    which should be run every GRAD_ACCUM_STEPS micro-batches, with the
+    global step fed as the number of applied updates.
+
+    Returns:
+      op accumulating gradients of a micro-batch
+    """
+    n_accum = self.cfg.GRAD_ACCUM_STEPS
+    grads_and_vars = [(grad, var) for grad, var
+                      in optimizer.compute_gradients(loss)
+                      if grad is not None]
+
+    with tf.variable_scope('grad_accum'):
+      accum_vars = [tf.get_variable(
+          var.op.name, shape=var.get_shape(), dtype=var.dtype.base_dtype,
+          initializer=tf.zeros_initializer(), trainable=False)
+                    for _, var in grads_and_vars]
+
+      accum_op = tf.group(
+          *[tf.assign_add(accum_var, grad) for accum_var, (grad, _)
+            in zip(accum_vars, grads_and_vars)],
+          name='accum_op')
+
+      apply_op = optimizer.apply_gradients(
+          [(accum_var / n_accum, var) for accum_var, (_, var)
+           in zip(accum_vars, grads_and_vars)])
+      with tf.control_dependencies([apply_op]):
+        self.apply_accum_op = tf.group(
+            *[tf.assign(accum_var, tf.zeros_like(accum_var))
+              for accum_var in accum_vars],
+            name='apply_accum_op')
+
+    return accum_op
+
   def build_graph(self,
                   input_size=(None, None, None),
                   image_size=(None, None, None),
                   num_class=None,
-                  n_train_samples=None):
+                  n_train_samples=None,
+                  data_dtypes=None):
     """Build the graph of CapsNet.
 
     Args:
@@ -347,6 +504,7 @@ class CapsNet(object):
       image_size: the size of ground truth images, should be 3 dimensional
       num_class: number of class of label
       n_train_samples: number of train samples
+      data_dtypes: data types of (x, y, imgs) arrays of the input pipeline
 
     Returns:
       tuple of (global_step, train_graph, inputs, labels, train_op,
@@ -360,7 +518,8 @@ class CapsNet(object):
 
       # Get input placeholders
       inputs, labels, input_imgs, is_training = \
-          self._get_inputs(input_size, num_class, image_size=image_size)
+          self._get_inputs(input_size, num_class, image_size=image_size,
+                           data_dtypes=data_dtypes)
 
       # Global step
       global_step = tf.placeholder(tf.int16, name='global_step')
@@ -383,7 +542,14 @@ class CapsNet(object):
       if self.cfg.SHOW_TRAINING_DETAILS:
         loss = tf.Print(loss, [tf.constant(6)],
                         message="\nUpdating gradients...")
-      train_op = optimizer.minimize(loss)
+      if self.cfg.GRAD_ACCUM_STEPS and self.cfg.GRAD_ACCUM_STEPS > 1:
+        train_op = self._accumulate_gradients(optimizer, loss)
+      else:
+        train_op = optimizer.minimize(loss)
+
+      # Accumulators of metrics for evaluation
+      self._get_streaming_metrics(
+          loss, accuracy, classifier_loss, reconstruct_loss)
 
       # Create a saver.
       saver = tf.train.Saver(tf.global_variables(),
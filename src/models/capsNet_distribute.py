@@ -13,7 +13,7 @@ class CapsNetDistribute(CapsNet):
     super(CapsNetDistribute, self).__init__(cfg, model_arch)
     self.clf_arch_info = None
     self.rec_arch_info = None
-    self.batch_size = cfg.BATCH_SIZE // cfg.GPU_NUMBER
+    self.n_splits = cfg.GPU_NUMBER
 
   def _get_loss(self, inputs, labels, imgs_tower, image_size, is_training=None):
     """Calculate the loss running the models.
@@ -111,7 +111,8 @@ class CapsNetDistribute(CapsNet):
     assert accuracy.get_shape() == ()
 
     preds = tf.concat(preds_all, axis=0, name='total_preds')
-    assert preds.get_shape()[0] == self.cfg.BATCH_SIZE
+    assert preds.get_shape().as_list()[1:] == \
+        preds_all[0].get_shape().as_list()[1:]
 
     if self.cfg.WITH_REC:
       classifier_loss = tf.divide(
@@ -124,8 +125,8 @@ class CapsNetDistribute(CapsNet):
 
       reconstructed_images = tf.concat(
           rec_images_all, axis=0, name='total_rec_images')
-      assert reconstructed_images.get_shape() == (
-        self.cfg.BATCH_SIZE, *rec_images_all[0].get_shape().as_list()[1:])
+      assert reconstructed_images.get_shape().as_list()[1:] == \
+          rec_images_all[0].get_shape().as_list()[1:]
     else:
       classifier_loss, reconstruct_loss, \
           reconstructed_images = None, None, None
@@ -151,7 +152,8 @@ class CapsNetDistribute(CapsNet):
                   input_size=(None, None, None),
                   image_size=(None, None, None),
                   num_class=None,
-                  n_train_samples=None):
+                  n_train_samples=None,
+                  data_dtypes=None):
     """Build the graph of CapsNet.
 
     Args:
@@ -159,6 +161,7 @@ class CapsNetDistribute(CapsNet):
       image_size: the size of ground truth images, should be 3 dimensional
       num_class: number of class of label
       n_train_samples: number of train samples
+      data_dtypes: data types of (x, y, imgs) arrays of the input pipeline
 
     Returns:
       tuple of (global_step, train_graph, inputs, labels, train_op,
@@ -172,7 +175,8 @@ class CapsNetDistribute(CapsNet):
 
       # Get inputs tensor
       inputs, labels, input_imgs, is_training = \
-          self._get_inputs(input_size, num_class, image_size=image_size)
+          self._get_inputs(input_size, num_class, image_size=image_size,
+                           data_dtypes=data_dtypes)
 
       # Global step
       global_step = tf.placeholder(tf.int16, name='global_step')
@@ -244,6 +248,10 @@ class CapsNetDistribute(CapsNet):
       else:
         train_op = apply_gradient_op
 
+      # Accumulators of metrics for evaluation
+      self._get_streaming_metrics(
+          loss, accuracy, classifier_loss, reconstruct_loss)
+
       # Create a saver.
       saver = tf.train.Saver(tf.global_variables(),
                              max_to_keep=self.cfg.MAX_TO_KEEP_CKP)
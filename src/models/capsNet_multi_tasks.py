@@ -15,7 +15,7 @@ class CapsNetMultiTasks(CapsNetDistribute):
     super(CapsNetMultiTasks, self).__init__(cfg, model_arch)
     self.clf_arch_info = None
     self.rec_arch_info = None
-    self.batch_size = cfg.BATCH_SIZE // cfg.GPU_NUMBER // cfg.TASK_NUMBER
+    self.n_splits = cfg.GPU_NUMBER * cfg.TASK_NUMBER
 
   @staticmethod
   def _sum_gradients(tower_grads):
@@ -103,8 +103,8 @@ class CapsNetMultiTasks(CapsNetDistribute):
     assert acc_tower.get_shape() == ()
 
     preds_tower = tf.concat(preds_tower, axis=0, name='preds_tower')
-    assert preds_tower.get_shape()[0] == \
-        self.cfg.BATCH_SIZE // self.cfg.GPU_NUMBER
+    # Batch size of a tower is only known when running
+    assert preds_tower.get_shape().ndims == 2
 
     if self.cfg.WITH_REC:
       clf_loss_tower = tf.divide(
@@ -117,8 +117,7 @@ class CapsNetMultiTasks(CapsNetDistribute):
 
       rec_images_tower = tf.concat(
           rec_images_tower, axis=0, name='rec_images_tower')
-      assert rec_images_tower.get_shape().as_list()[0] == \
-          self.cfg.BATCH_SIZE // self.cfg.GPU_NUMBER
+      assert rec_images_tower.get_shape().ndims == 4
     else:
       clf_loss_tower, rec_loss_tower, rec_images_tower = None, None, None
 
@@ -192,7 +191,8 @@ class CapsNetMultiTasks(CapsNetDistribute):
                   input_size=(None, None, None),
                   image_size=(None, None, None),
                   num_class=None,
-                  n_train_samples=None):
+                  n_train_samples=None,
+                  data_dtypes=None):
     """Build the graph of CapsNet.
 
     Args:
@@ -200,6 +200,7 @@ class CapsNetMultiTasks(CapsNetDistribute):
       image_size: the size of ground truth images, should be 3 dimensional
       num_class: number of class of label
       n_train_samples: number of train samples
+      data_dtypes: data types of (x, y, imgs) arrays of the input pipeline
 
     Returns:
       tuple of (global_step, train_graph, inputs, labels, train_op,
@@ -213,7 +214,8 @@ class CapsNetMultiTasks(CapsNetDistribute):
 
       # Get inputs tensor
       inputs, labels, input_imgs, is_training = \
-          self._get_inputs(input_size, num_class, image_size=image_size)
+          self._get_inputs(input_size, num_class, image_size=image_size,
+                           data_dtypes=data_dtypes)
 
       # Global step
       global_step = tf.placeholder(tf.int16, name='global_step')
@@ -294,6 +296,10 @@ class CapsNetMultiTasks(CapsNetDistribute):
       else:
         train_op = apply_gradient_op
 
+      # Accumulators of metrics for evaluation
+      self._get_streaming_metrics(
+          loss, accuracy, classifier_loss, reconstruct_loss)
+
       # Create a saver.
       saver = tf.train.Saver(tf.global_variables(),
                              max_to_keep=self.cfg.MAX_TO_KEEP_CKP)
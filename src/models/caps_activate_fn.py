@@ -13,7 +13,7 @@ class ActivationFunc(object):
 
     Args:
       x: A tensor with shape: (batch_size, num_caps, vec_dim, 1).
-      batch_size: Batch size
+      batch_size: Batch size, None if the batch size is dynamic
       epsilon: Add epsilon(a very small number) to zeros
 
     Returns:
@@ -25,16 +25,20 @@ class ActivationFunc(object):
     vec_dim = vec_shape[2]
 
     vec_squared_norm = tf.reduce_sum(tf.square(x), -2, keep_dims=True)
-    assert vec_squared_norm.get_shape() == (batch_size, num_caps, 1, 1)
+    assert vec_squared_norm.get_shape().is_compatible_with(
+        (batch_size, num_caps, 1, 1))
 
     # scalar_factor = tf.div(vec_squared_norm, 1 + vec_squared_norm)
     scalar_factor = tf.div(vec_squared_norm, 0.5 + vec_squared_norm)
-    assert scalar_factor.get_shape() == (batch_size, num_caps, 1, 1)
+    assert scalar_factor.get_shape().is_compatible_with(
+        (batch_size, num_caps, 1, 1))
 
     unit_vec = tf.div(x, tf.sqrt(vec_squared_norm + epsilon))
-    assert unit_vec.get_shape() == (batch_size, num_caps, vec_dim, 1)
+    assert unit_vec.get_shape().is_compatible_with(
+        (batch_size, num_caps, vec_dim, 1))
 
     squashed_vec = tf.multiply(scalar_factor, unit_vec)
-    assert squashed_vec.get_shape() == (batch_size, num_caps, vec_dim, 1)
+    assert squashed_vec.get_shape().is_compatible_with(
+        (batch_size, num_caps, vec_dim, 1))
 
     return squashed_vec
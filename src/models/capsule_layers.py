@@ -30,7 +30,8 @@ class CapsLayer(object):
       num_caps: number of capsules of this layer
       vec_dim: dimensions of vectors of capsules
       route_epoch: number of dynamic routing iteration
-      batch_size: number of samples per batch
+      batch_size: number of samples per batch, only used to check shapes,
+                  None for a dynamic batch size
       idx: index of layer
     """
     self.cfg = cfg
@@ -83,7 +84,7 @@ class CapsLayer(object):
       num_caps_j: number of capsules of upper layer
       vec_dim_j: dimensions of vectors of upper layer
       route_epoch: number of dynamic routing iteration
-      batch_size: number of samples per batch
+      batch_size: number of samples per batch, None if it is dynamic
 
     Returns:
       output tensor
@@ -94,13 +95,16 @@ class CapsLayer(object):
     vec_dim_i = inputs_shape[2]
     v_j = None
 
+    # Batch size of inputs, which may be unknown until running
+    n_batch = tf.shape(inputs)[0]
+
     # Reshape input tensor
-    inputs_shape_new = [batch_size, num_caps_i, 1, vec_dim_i, 1]
+    inputs_shape_new = [-1, num_caps_i, 1, vec_dim_i, 1]
     inputs = tf.reshape(inputs, shape=inputs_shape_new)
     inputs = tf.tile(inputs, [1, 1, num_caps_j, 1, 1], name='input_tensor')
     # inputs shape: (batch_size, num_caps_i, num_caps_j, vec_dim_i, 1)
-    assert inputs.get_shape() == (
-        batch_size, num_caps_i, num_caps_j, vec_dim_i, 1)
+    assert inputs.get_shape().is_compatible_with((
+        batch_size, num_caps_i, num_caps_j, vec_dim_i, 1))
 
     # Initializing weights
     if self.share_weights:
@@ -122,43 +126,31 @@ class CapsLayer(object):
           initializer=tf.truncated_normal_initializer(
               stddev=self.cfg.WEIGHTS_STDDEV, dtype=tf.float32),
           dtype=tf.float32)
-    weights = tf.tile(weights, [batch_size, 1, 1, 1, 1])
+    weights = tf.tile(weights, [n_batch, 1, 1, 1, 1])
     if self.share_weights:
       weights = tf.tile(weights, [1, num_caps_i, 1, 1, 1])
     # weights shape: (batch_size, num_caps_i, num_caps_j, vec_dim_j, vec_dim_i)
-    assert weights.get_shape() == (
-        batch_size, num_caps_i, num_caps_j, vec_dim_j, vec_dim_i)
+    assert weights.get_shape().is_compatible_with((
+        batch_size, num_caps_i, num_caps_j, vec_dim_j, vec_dim_i))
 
     # Calculating u_hat
     # ( , , , vec_dim_j, vec_dim_i) x ( , , , vec_dim_i, 1)
     # -> ( , , , vec_dim_j, 1) -> squeeze -> ( , , , vec_dim_j)
     u_hat = tf.matmul(weights, inputs, name='u_hat')
     # u_hat shape: (batch_size, num_caps_i, num_caps_j, vec_dim_j, 1)
-    assert u_hat.get_shape() == (
-        batch_size, num_caps_i, num_caps_j, vec_dim_j, 1)
+    assert u_hat.get_shape().is_compatible_with((
+        batch_size, num_caps_i, num_caps_j, vec_dim_j, 1))
 
     # u_hat_stop
     # Do not transfer the gradient of u_hat_stop during back-propagation
     u_hat_stop = tf.stop_gradient(u_hat, name='u_hat_stop')
 
     # Initializing b_ij
-    if self.cfg.VAR_ON_CPU:
-      b_ij = variable_on_cpu(
-          name='b_ij',
-          shape=[batch_size, num_caps_i, num_caps_j, 1, 1],
-          initializer=tf.zeros_initializer(),
-          dtype=tf.float32,
-          trainable=False)
-    else:
-      b_ij = tf.get_variable(
-          name='b_ij',
-          shape=[batch_size, num_caps_i, num_caps_j, 1, 1],
-          initializer=tf.zeros_initializer(),
-          dtype=tf.float32,
-          trainable=False)
+    # b_ij starts from zeros for every batch, so it is not a variable
+    b_ij = tf.zeros([n_batch, num_caps_i, num_caps_j, 1, 1], name='b_ij')
     # b_ij shape: (batch_size, num_caps_i, num_caps_j, 1, 1)
-    assert b_ij.get_shape() == (
-        batch_size, num_caps_i, num_caps_j, 1, 1)
+    assert b_ij.get_shape().is_compatible_with((
+        batch_size, num_caps_i, num_caps_j, 1, 1))
 
     def _sum_and_activate(_u_hat, _c_ij, cfg_, name=None):
       """Get sum of vectors and apply activation function."""
@@ -166,14 +158,14 @@ class CapsLayer(object):
       # Using u_hat but not u_hat_stop in order to transfer gradients.
       _s_j = tf.reduce_sum(tf.multiply(_u_hat, _c_ij), axis=1)
       # _s_j shape: (batch_size, num_caps_j, vec_dim_j, 1)
-      assert _s_j.get_shape() == (
-          batch_size, num_caps_j, vec_dim_j, 1)
+      assert _s_j.get_shape().is_compatible_with((
+          batch_size, num_caps_j, vec_dim_j, 1))
 
       # Applying Squashing
       _v_j = ActivationFunc.squash(_s_j, batch_size, cfg_.EPSILON)
       # _v_j shape: (batch_size, num_caps_j, vec_dim_j, 1)
-      assert _v_j.get_shape() == (
-          batch_size, num_caps_j, vec_dim_j, 1)
+      assert _v_j.get_shape().is_compatible_with((
+          batch_size, num_caps_j, vec_dim_j, 1))
 
       _v_j = tf.identity(_v_j, name=name)
 
@@ -187,8 +179,8 @@ class CapsLayer(object):
         c_ij = tf.nn.softmax(b_ij, dim=2)
 
         # c_ij shape: (batch_size, num_caps_i, num_caps_j, 1, 1)
-        assert c_ij.get_shape() == (
-            batch_size, num_caps_i, num_caps_j, 1, 1)
+        assert c_ij.get_shape().is_compatible_with((
+            batch_size, num_caps_i, num_caps_j, 1, 1))
 
         # Applying back-propagation at last epoch.
         if iter_route == route_epoch - 1:
@@ -218,25 +210,25 @@ class CapsLayer(object):
               name='v_j_reshaped')
           # v_j_reshaped shape:
           # (batch_size, num_caps_i, num_caps_j, 1, vec_dim_j)
-          assert v_j_reshaped.get_shape() == (
-              batch_size, num_caps_i, num_caps_j, 1, vec_dim_j)
+          assert v_j_reshaped.get_shape().is_compatible_with((
+              batch_size, num_caps_i, num_caps_j, 1, vec_dim_j))
 
           # ( , , , 1, vec_dim_j) x ( , , , vec_dim_j, 1)
           # -> squeeze -> (batch_size, num_caps_i, num_caps_j, 1, 1)
           delta_b_ij = tf.matmul(
               v_j_reshaped, u_hat_stop, name='delta_b_ij')
           # delta_b_ij shape: (batch_size, num_caps_i, num_caps_j, 1)
-          assert delta_b_ij.get_shape() == (
-              batch_size, num_caps_i, num_caps_j, 1, 1)
+          assert delta_b_ij.get_shape().is_compatible_with((
+              batch_size, num_caps_i, num_caps_j, 1, 1))
 
           b_ij = tf.add(b_ij, delta_b_ij, name='b_ij')
           # b_ij shape: (batch_size, num_caps_i, num_caps_j, 1, 1)
-          assert b_ij.get_shape() == (
-              batch_size, num_caps_i, num_caps_j, 1, 1)
+          assert b_ij.get_shape().is_compatible_with((
+              batch_size, num_caps_i, num_caps_j, 1, 1))
 
     # v_j_out shape: (batch_size, num_caps_j, vec_dim_j, 1)
-    assert v_j.get_shape() == (
-        batch_size, num_caps_j, vec_dim_j, 1)
+    assert v_j.get_shape().is_compatible_with((
+        batch_size, num_caps_j, vec_dim_j, 1))
 
     return v_j
 
@@ -266,7 +258,8 @@ class Conv2CapsLayer(object):
       vec_dim: dimensions of vectors of capsule
       w_init_fn: weights initializer of convolution layer
       use_bias: add biases
-      batch_size: number of samples per batch
+      batch_size: number of samples per batch, only used to check shapes,
+                  None for a dynamic batch size
     """
     self.cfg = cfg
     self.kernel_size = kernel_size
@@ -352,17 +345,17 @@ class Conv2CapsLayer(object):
       # (batch_size, img_height, img_width, self.n_kernel * self.vec_dim)
       caps_shape = caps.get_shape().as_list()
       num_capsule = caps_shape[1] * caps_shape[2] * self.n_kernel
-      caps = tf.reshape(caps, [self.batch_size, -1, self.vec_dim, 1])
+      caps = tf.reshape(caps, [-1, num_capsule, self.vec_dim, 1])
       # caps shape: (batch_size, num_caps_j, vec_dim_j, 1)
-      assert caps.get_shape() == (
-        self.batch_size, num_capsule, self.vec_dim, 1)
+      assert caps.get_shape().is_compatible_with((
+        self.batch_size, num_capsule, self.vec_dim, 1))
 
       # Applying activation function
       caps_activated = ActivationFunc.squash(
           caps, self.batch_size, self.cfg.EPSILON)
       # caps_activated shape: (batch_size, num_caps_j, vec_dim_j, 1)
-      assert caps_activated.get_shape() == (
-        self.batch_size, num_capsule, self.vec_dim, 1)
+      assert caps_activated.get_shape().is_compatible_with((
+        self.batch_size, num_capsule, self.vec_dim, 1))
 
       self.tensor_shape = caps_activated.get_shape().as_list()
       return caps_activated
@@ -1217,7 +1210,8 @@ class Dense2CapsLayer(object):
               identity_map is False
       num_caps: number of output capsules, needed if identity_map is False
       vec_dim: dimensions of vectors of capsule
-      batch_size: number of samples per batch
+      batch_size: number of samples per batch, only used to check shapes,
+                  None for a dynamic batch size
       reshape_mode: 'FLATTEN' or 'GAP'
     """
     self.cfg = cfg
@@ -1316,7 +1310,8 @@ class Dense2CapsLayer(object):
           inputs_flatten = tf.reduce_mean(inputs, axis=[1, 2])
         else:
           raise ValueError('Wrong reshape_mode!')
-        assert inputs_flatten.get_shape() == (inputs_shape[0], inputs_shape[3])
+        assert inputs_flatten.get_shape().is_compatible_with(
+            (inputs_shape[0], inputs_shape[3]))
       else:
         inputs_flatten = inputs
 
@@ -1337,17 +1332,17 @@ class Dense2CapsLayer(object):
         caps = tf.concat(caps_, axis=-1)
 
       # Reshape and generating a capsule layer
-      caps = tf.reshape(caps, [self.batch_size, -1, self.vec_dim, 1])
+      caps = tf.reshape(caps, [-1, self.num_caps, self.vec_dim, 1])
       # caps shape: (batch_size, num_caps_j, vec_dim_j, 1)
-      assert caps.get_shape() == (
-        self.batch_size, self.num_caps, self.vec_dim, 1)
+      assert caps.get_shape().is_compatible_with((
+        self.batch_size, self.num_caps, self.vec_dim, 1))
 
       # Applying activation function
       caps_activated = ActivationFunc.squash(
           caps, self.batch_size, self.cfg.EPSILON)
       # caps_activated shape: (batch_size, num_caps_j, vec_dim_j, 1)
-      assert caps_activated.get_shape() == (
-        self.batch_size, self.num_caps, self.vec_dim, 1)
+      assert caps_activated.get_shape().is_compatible_with((
+        self.batch_size, self.num_caps, self.vec_dim, 1))
 
       self.tensor_shape = caps_activated.get_shape().as_list()
       return caps_activated
@@ -1365,7 +1360,8 @@ class Code2CapsLayer(object):
     Args:
       cfg: configuration
       vec_dim: dimensions of vectors of capsule
-      batch_size: number of samples per batch
+      batch_size: number of samples per batch, only used to check shapes,
+                  None for a dynamic batch size
     """
     self.cfg = cfg
     self.vec_dim = vec_dim
@@ -1406,17 +1402,17 @@ class Code2CapsLayer(object):
       else:
         num_caps_j = inputs_shape[1] // self.vec_dim
 
-      caps = tf.reshape(inputs, [self.batch_size, -1, self.vec_dim, 1])
+      caps = tf.reshape(inputs, [-1, num_caps_j, self.vec_dim, 1])
       # caps shape: (batch_size, num_caps_j, vec_dim_j, 1)
-      assert caps.get_shape() == (
-        self.batch_size, num_caps_j, self.vec_dim, 1)
+      assert caps.get_shape().is_compatible_with((
+        self.batch_size, num_caps_j, self.vec_dim, 1))
 
       # Applying activation function
       caps_activated = ActivationFunc.squash(
           caps, self.batch_size, self.cfg.EPSILON)
       # caps_activated shape: (batch_size, num_caps_j, vec_dim_j, 1)
-      assert caps_activated.get_shape() == (
-        self.batch_size, num_caps_j, self.vec_dim, 1)
+      assert caps_activated.get_shape().is_compatible_with((
+        self.batch_size, num_caps_j, self.vec_dim, 1))
 
       self.tensor_shape = caps_activated.get_shape().as_list()
       return caps_activated
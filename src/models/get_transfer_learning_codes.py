@@ -1,12 +1,77 @@
 import pickle
 import numpy as np
-from PIL import Image
 from models import utils
 from tqdm import tqdm
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 
 import os
+import shutil
+import hashlib
+from os.path import isfile, getsize
 import tensorflow as tf
 from keras import backend as K
+from keras.layers import Input, Lambda
+
+
+# Transfer learning models built in this process, shared by all instances:
+# {(model_name, input_shape, weights, include_top, pooling): model}
+_MODEL_CACHE = {}
+
+
+def clear_model_cache():
+  """Release cached transfer learning models and the keras session."""
+  _MODEL_CACHE.clear()
+  K.clear_session()
+  tf.reset_default_graph()
+
+
+def get_preprocess_input(model_name):
+  """Get the preprocess_input function of a transfer learning model."""
+  if model_name == 'vgg16':
+    from keras.applications.vgg16 import preprocess_input
+  elif model_name == 'vgg19':
+    from keras.applications.vgg19 import preprocess_input
+  elif model_name == 'resnet50':
+    from keras.applications.resnet50 import preprocess_input
+  elif model_name == 'inceptionv3':
+    from keras.applications.inception_v3 import preprocess_input
+  elif model_name == 'xception':
+    from keras.applications.xception import preprocess_input
+  else:
+    raise ValueError('Wrong transfer learning model name!')
+  return preprocess_input
+
+
+def get_input_layers(input_shape, model_name):
+  """Get layers adapting source images to a transfer learning model.
+
+  Images are resized to 224x224, grayscale images are replicated to 3
+  channels and then preprocessed for the model in the graph, so the arrays
+  fed from the host keep the size of source images.
+
+  Args:
+    input_shape: shape of source images, (height, width, channels)
+    model_name: name of the transfer learning model
+
+  Returns:
+    the input tensor and the tensor to build the model on
+  """
+  inputs = Input(shape=input_shape)
+  x = inputs
+  if tuple(input_shape[:2]) != (224, 224):
+    x = Lambda(lambda t: tf.image.resize_images(t, (224, 224)),
+               name='resize_224')(x)
+  if input_shape[2] == 1:
+    x = Lambda(lambda t: tf.tile(t, [1, 1, 1, 3]), name='gray_to_rgb')(x)
+  x = Lambda(lambda t, name: get_preprocess_input(name)(t),
+             arguments={'name': model_name},
+             name='preprocess_input')(x)
+  return inputs, x
+
+
+# Needed by load_model() to load models with input layers
+TL_CUSTOM_OBJECTS = {'tf': tf, 'get_preprocess_input': get_preprocess_input}
 
 
 class GetBottleneckFeatures(object):
@@ -17,41 +82,71 @@ class GetBottleneckFeatures(object):
     # Only shows Errors
     os.environ["TF_CPP_MIN_LOG_LEVEL"] = '3'
 
-  def _extract_features(self,
-                        tensor,
-                        weights='imagenet',
-                        include_top=False,
-                        pooling=None):
-    """Extract bottleneck features from transfer learning models."""
+  def _get_model(self,
+                 input_shape,
+                 weights='imagenet',
+                 include_top=False,
+                 pooling=None):
+    """Get transfer learning model for images with shape of input_shape.
+
+    The model is built and its weights are loaded only once in a process,
+    then it is reused by all batches until clear_model_cache() is called.
+    """
+    input_shape = tuple(input_shape)
+    model_key = (self.model_name, input_shape, weights, include_top, pooling)
+    if model_key in _MODEL_CACHE:
+      return _MODEL_CACHE[model_key]
+
+    _, input_tensor = get_input_layers(input_shape, self.model_name)
+
     if self.model_name == 'vgg16':
-      from keras.applications.vgg16 import VGG16, preprocess_input
-      return VGG16(weights=weights,
-                   include_top=include_top,
-                   pooling=pooling).predict(preprocess_input(tensor))
+      from keras.applications.vgg16 import VGG16
+      model = VGG16(weights=weights,
+                    include_top=include_top,
+                    input_tensor=input_tensor,
+                    pooling=pooling)
     elif self.model_name == 'vgg19':
-      from keras.applications.vgg19 import VGG19, preprocess_input
-      return VGG19(weights=weights,
-                   include_top=include_top,
-                   pooling=pooling).predict(preprocess_input(tensor))
+      from keras.applications.vgg19 import VGG19
+      model = VGG19(weights=weights,
+                    include_top=include_top,
+                    input_tensor=input_tensor,
+                    pooling=pooling)
     elif self.model_name == 'resnet50':
-      from keras.applications.resnet50 import ResNet50, preprocess_input
-      return ResNet50(weights=weights,
-                      include_top=include_top,
-                      pooling=pooling).predict(preprocess_input(tensor))
+      from keras.applications.resnet50 import ResNet50
+      model = ResNet50(weights=weights,
+                       include_top=include_top,
+                       input_tensor=input_tensor,
+                       pooling=pooling)
     elif self.model_name == 'inceptionv3':
-      from keras.applications.inception_v3 import \
-        InceptionV3, preprocess_input
-      return InceptionV3(weights=weights,
-                         include_top=include_top,
-                         pooling=pooling).predict(preprocess_input(tensor))
+      from keras.applications.inception_v3 import InceptionV3
+      model = InceptionV3(weights=weights,
+                          include_top=include_top,
+                          input_tensor=input_tensor,
+                          pooling=pooling)
     elif self.model_name == 'xception':
-      from keras.applications.xception import Xception, preprocess_input
-      return Xception(weights=weights,
-                      include_top=include_top,
-                      pooling=pooling).predict(preprocess_input(tensor))
+      from keras.applications.xception import Xception
+      model = Xception(weights=weights,
+                       include_top=include_top,
+                       input_tensor=input_tensor,
+                       pooling=pooling)
     else:
       raise ValueError('Wrong transfer learning model name!')
 
+    _MODEL_CACHE[model_key] = model
+    return model
+
+  def _extract_features(self,
+                        tensor,
+                        weights='imagenet',
+                        include_top=False,
+                        pooling=None):
+    """Extract bottleneck features from transfer learning models."""
+    model = self._get_model(tensor.shape[1:],
+                            weights=weights,
+                            include_top=include_top,
+                            pooling=pooling)
+    return model.predict(tensor)
+
   def _get_bottleneck_feature_shape(self, pooling=None):
     """Get bottleneck feature shapes."""
     if self.model_name == 'vgg16':
@@ -74,10 +169,6 @@ class GetBottleneckFeatures(object):
                               batch_size=None,
                               data_type=np.float32,
                               pooling='avg'):
-    # Check image size for transfer learning models
-    inputs_shape = inputs.shape
-    assert inputs_shape[1:3] == (224, 224)
-
     # Scale to 0-255 and extract features
     if batch_size:
       batch_generator = utils.get_batches(
@@ -87,25 +178,13 @@ class GetBottleneckFeatures(object):
       for _ in tqdm(range(n_batch), total=n_batch, ncols=100, unit='batch'):
 
         inputs_batch = next(batch_generator)
-        inputs_batch = utils.imgs_scale_to_255(inputs_batch).astype(data_type)
-
-        if inputs_shape[3] == 1:
-          inputs_batch = np.concatenate(
-              [inputs_batch, inputs_batch, inputs_batch], axis=-1)
-
-        assert inputs_batch.shape[1:] == (224, 224, 3)
+        inputs_batch = utils.imgs_scale_to_255(inputs_batch, dtype=data_type)
         bf_batch = self._extract_features(inputs_batch, pooling=pooling)
         bottleneck_features.append(bf_batch)
 
-        # Release memory
-        K.clear_session()
-        tf.reset_default_graph()
-
       bottleneck_features = np.concatenate(bottleneck_features, axis=0)
     else:
-      inputs = utils.imgs_scale_to_255(inputs).astype(data_type)
-      if inputs_shape[3] == 1:
-        inputs = np.concatenate([inputs, inputs, inputs], axis=-1)
+      inputs = utils.imgs_scale_to_255(inputs, dtype=data_type)
       bottleneck_features = self._extract_features(inputs, pooling=pooling)
 
     # Check data shape
@@ -115,59 +194,262 @@ class GetBottleneckFeatures(object):
 
     return bottleneck_features
 
+  @staticmethod
+  def _prepare_batch(inputs_batch, data_type):
+    """Scale a batch of images to 0-255.
+
+    Resizing and replicating channels are done by the model.
+    """
+    return utils.imgs_scale_to_255(inputs_batch, dtype=data_type)
+
+  def _get_prepared_batches(self,
+                            inputs,
+                            batch_size,
+                            data_type,
+                            n_workers=None,
+                            n_prefetch=2):
+    """Generate prepared batches, prefetched by a thread pool.
+
+    While the model is running on batch k, batches k+1 to k+n_prefetch are
+    prepared in worker threads.
+    """
+    batch_generator = utils.get_batches(
+        inputs, batch_size=batch_size, keep_last=True)
+
+    if not n_workers:
+      for inputs_batch in batch_generator:
+        yield self._prepare_batch(inputs_batch, data_type)
+      return
+
+    with ThreadPoolExecutor(max_workers=n_workers) as executor:
+      futures = deque()
+      for inputs_batch in batch_generator:
+        futures.append(executor.submit(
+            self._prepare_batch, inputs_batch, data_type))
+        if len(futures) > n_prefetch:
+          yield futures.popleft().result()
+      while futures:
+        yield futures.popleft().result()
+
+  @staticmethod
+  def _get_journal_header(inputs, batch_size, storage_dtype, bf_shape):
+    """Get the first line of a journal, which identifies an extraction.
+
+    Inputs are fingerprinted by their shape, data type and a hash of up to
+    16 evenly spaced images, so hashing does not read all images.
+    """
+    inputs_hash = hashlib.sha1(
+        '{}{}'.format(inputs.shape, inputs.dtype).encode())
+    for i in np.linspace(0, len(inputs) - 1, min(len(inputs), 16), dtype=int):
+      inputs_hash.update(np.ascontiguousarray(inputs[i]).tobytes())
+    return '# n_imgs={},inputs={},batch_size={},storage_dtype={},' \
+        'bf_shape={}\n'.format(len(inputs), inputs_hash.hexdigest(),
+                               batch_size, storage_dtype,
+                               'x'.join(map(str, bf_shape)))
+
+  @staticmethod
+  def _load_journal(journal_path, header):
+    """Load the journal of finished batches.
+
+    The first line of the journal is the header of the extraction, and each
+    following line is 'start,end,offset' of a batch whose features have
+    been written, offset is the size of the output file after writing.
+
+    Returns:
+      list of (start, end, offset) of finished batches, or None if the
+      journal belongs to another extraction
+    """
+    batches = []
+    if isfile(journal_path):
+      with open(journal_path, 'r') as f:
+        if f.readline() != header:
+          return None
+        for line in f:
+          try:
+            start, end, offset = (int(x) for x in line.split(','))
+          except ValueError:
+            # Incomplete line written when interrupted
+            break
+          if start != (batches[-1][1] if batches else 0):
+            break
+          batches.append((start, end, offset))
+    return batches
+
+  @staticmethod
+  def _write_batch(bf_batch, f, f_scales, f_journal,
+                   start, end, storage_dtype):
+    """Write features of a batch and record it in the journal."""
+    stored, scales = utils.quantize_features(bf_batch, storage_dtype)
+    pickle.dump(stored, f)
+    f.flush()
+    if scales is not None:
+      f_scales.write(scales.tobytes())
+      f_scales.flush()
+    f_journal.write('{},{},{}\n'.format(start, end, f.tell()))
+    f_journal.flush()
+
+  @staticmethod
+  def _load_manifest(file_path):
+    manifest_path = utils.get_bf_manifest_path(file_path)
+    if not isfile(manifest_path):
+      return None
+    with open(manifest_path, 'rb') as f:
+      return pickle.load(f)
+
+  @staticmethod
+  def _save_manifest(file_path, manifest):
+    manifest_path = utils.get_bf_manifest_path(file_path)
+    with open(manifest_path + '.tmp', 'wb') as f:
+      pickle.dump(manifest, f)
+    os.replace(manifest_path + '.tmp', manifest_path)
+
+  def verify_bottleneck_features(self, file_path, n_imgs, pooling='avg'):
+    """Check if a file holds bottleneck features of all n_imgs images.
+
+    The file is checked against its manifest and its size, so the features
+    are not loaded.
+    """
+    if not isfile(file_path):
+      return False
+    manifest = self._load_manifest(file_path)
+    if manifest is None or 'n_bytes' not in manifest:
+      return False
+    bf_shape = self._get_bottleneck_feature_shape(pooling=pooling)
+    if tuple(manifest['feature_shape']) != bf_shape or \
+        manifest['n_imgs'] != n_imgs or \
+        manifest['n_bytes'] != getsize(file_path):
+      return False
+    if (manifest['scales'] is None) != (manifest['storage_dtype'] != 'int8'):
+      return False
+    if manifest['scales'] is not None and \
+        len(manifest['scales']) != manifest['n_batches']:
+      return False
+    return True
+
+  def merge_bottleneck_features(self, shard_paths, file_path):
+    """Concatenate features and manifests of shards into file_path."""
+    manifests = [self._load_manifest(p) for p in shard_paths]
+    tmp_path = file_path + '.tmp'
+    with open(tmp_path, 'wb') as f_out:
+      for shard_path in shard_paths:
+        with open(shard_path, 'rb') as f_in:
+          shutil.copyfileobj(f_in, f_out)
+
+    if manifests[0]['scales'] is None:
+      scales = None
+    else:
+      scales = np.concatenate([m['scales'] for m in manifests], axis=0)
+    manifest = dict(manifests[0],
+                    n_imgs=sum(m['n_imgs'] for m in manifests),
+                    n_batches=sum(m['n_batches'] for m in manifests),
+                    n_bytes=sum(m['n_bytes'] for m in manifests),
+                    scales=scales)
+    self._save_manifest(file_path, manifest)
+    os.replace(tmp_path, file_path)
+
   def save_bottleneck_features(self,
                                inputs,
                                file_path,
                                batch_size=None,
                                pooling='avg',
-                               data_type=np.float32):
-    inputs_shape = inputs.shape
-    img_mode = 'L' if inputs_shape[3] == 1 else 'RGB'
-
-    with open(file_path, 'wb') as f:
-
-      if batch_size:
-
-        batch_generator = utils.get_batches(
-            inputs, batch_size=batch_size, keep_last=True)
-        if len(inputs) % batch_size == 0:
-          n_batch = len(inputs) // batch_size
-        else:
-          n_batch = len(inputs) // batch_size + 1
-
-        for _ in tqdm(range(n_batch), total=n_batch, ncols=100, unit='batch'):
-          inputs_batch = next(batch_generator)
-          inputs_batch = utils.imgs_scale_to_255(inputs_batch).astype(data_type)
-
-          if inputs_shape[1:3] != (224, 224):
-            inputs_batch = utils.img_resize(inputs_batch,
-                                            (224, 224),
-                                            img_mode=img_mode,
-                                            resize_filter=Image.ANTIALIAS,
-                                            verbose=False,
-                                            ).astype(data_type)
-          if inputs_shape[3] == 1:
-            inputs_batch = np.concatenate(
-                [inputs_batch, inputs_batch, inputs_batch], axis=-1)
-
-          assert inputs_batch.shape[1:] == (224, 224, 3)
-          bf_batch = self._extract_features(inputs_batch, pooling=pooling)
-          assert bf_batch.shape[1:] == \
-              self._get_bottleneck_feature_shape(pooling=pooling)
-          f.write(pickle.dumps(bf_batch))
+                               data_type=np.float32,
+                               n_workers=None,
+                               n_prefetch=2,
+                               writer_queue_size=4,
+                               storage_dtype='float32'):
+    """Extract bottleneck features and save them to file_path.
 
-          # Release memory
-          K.clear_session()
-          tf.reset_default_graph()
+    Preparing batches, running the model and writing features are
+    overlapped. Features are written to a temporary file, which is renamed
+    to file_path when all batches are finished. Finished batches are
+    recorded in a journal, so an interrupted extraction is resumed from the
+    first unfinished batch when this is called again.
 
+    Features are stored as float32, float16 or int8 with a scale for each
+    channel of each batch. The data type, shape and scales are saved in a
+    manifest next to file_path, which is used by utils.load_data_tl() to
+    dequantize features while loading.
+
+    Args:
+      inputs: images with shape (n, height, width, channels)
+      file_path: path of the pickle file to save features
+      batch_size: number of images in a batch, use all images if None
+      pooling: pooling method of the model
+      data_type: data type of prepared images
+      n_workers: number of threads preparing batches,
+                 prepare batches in the main thread if None
+      n_prefetch: number of prepared batches waiting for the model
+      writer_queue_size: number of feature batches waiting to be written,
+                         write features synchronously if None
+      storage_dtype: 'float32', 'float16' or 'int8'
+    """
+    bf_shape = self._get_bottleneck_feature_shape(pooling=pooling)
+    batch_size = batch_size or len(inputs)
+
+    tmp_path = file_path + '.tmp'
+    scales_path = file_path + '.scales.tmp'
+    journal_path = file_path + '.journal'
+    header = self._get_journal_header(
+        inputs, batch_size, storage_dtype, bf_shape)
+    journal = self._load_journal(journal_path, header) \
+        if isfile(tmp_path) else None
+    if journal is None:
+      # Also refuse to resume batches of another batch_size or storage_dtype
+      if isfile(tmp_path):
+        print('Partial features belong to another extraction, discard them.')
+      journal = []
+    n_done, n_bytes = journal[-1][1:] if journal else (0, 0)
+    n_batches_done = len(journal)
+    if n_done:
+      print('Resuming from image {}/{}...'.format(n_done, len(inputs)))
+
+    n_batch = (len(inputs) - n_done + batch_size - 1) // batch_size
+    batches = self._get_prepared_batches(
+        inputs[n_done:], batch_size, data_type,
+        n_workers=n_workers, n_prefetch=n_prefetch)
+
+    with open(tmp_path, 'ab') as f, open(scales_path, 'ab') as f_scales, \
+        open(journal_path, 'w') as f_journal:
+      # Drop features written after the last finished batch
+      f.truncate(n_bytes)
+      if storage_dtype == 'int8':
+        f_scales.truncate(n_batches_done * bf_shape[-1] * 4)
       else:
-        inputs = utils.imgs_scale_to_255(inputs).astype(data_type)
+        f_scales.truncate(0)
+      # Keep a line for each finished batch, which has a row of scales
+      f_journal.write(header)
+      for batch in journal:
+        f_journal.write('{},{},{}\n'.format(*batch))
+      f_journal.flush()
 
-        if inputs_shape[3] == 1:
-          inputs = np.concatenate([inputs, inputs, inputs], axis=-1)
+      with utils.BackgroundWorker(
+            max_queue_size=writer_queue_size, name='bf_writer') as writer:
+        start = n_done
+        for inputs_batch in tqdm(
+              batches, total=n_batch, ncols=100, unit='batch'):
+          bf_batch = self._extract_features(inputs_batch, pooling=pooling)
+          assert bf_batch.shape[1:] == bf_shape
+          end = start + len(bf_batch)
+          writer.submit(self._write_batch, bf_batch, f, f_scales,
+                        f_journal, start, end, storage_dtype)
+          start = end
+
+      f.flush()
+      os.fsync(f.fileno())
+      n_bytes = f.tell()
 
-        assert inputs.shape[1:] == (224, 224, 3)
-        bottleneck_features = self._extract_features(inputs, pooling=pooling)
-        assert bottleneck_features.shape[1:] == \
-            self._get_bottleneck_feature_shape(pooling=pooling)
-        f.write(pickle.dumps(bottleneck_features))
+    if storage_dtype == 'int8':
+      scales = np.fromfile(scales_path, dtype=np.float32).reshape(
+          (-1, bf_shape[-1]))
+    else:
+      scales = None
+    self._save_manifest(file_path, dict(storage_dtype=storage_dtype,
+                                        feature_shape=bf_shape,
+                                        n_imgs=len(inputs),
+                                        n_batches=n_batches_done + n_batch,
+                                        batch_size=batch_size,
+                                        n_bytes=n_bytes,
+                                        scales=scales))
+    os.replace(tmp_path, file_path)
+    os.remove(scales_path)
+    os.remove(journal_path)
@@ -297,7 +297,8 @@ class ConvTLayer(object):
       n_kernel: number of convolution kernels
       padding: padding type of convolution kernel
       act_fn: activation function
-      output_shape: output shape of deconvolution layer
+      output_shape: output shape of deconvolution layer, the batch size
+                    of inputs is used if the first dimension is None
       w_init_fn: weights initializer of convolution layer
       use_bias: use bias
       idx: index of layer
@@ -349,10 +350,13 @@ class ConvTLayer(object):
                    self.n_kernel, inputs.get_shape().as_list()[3]],
             initializer=self.w_init_fn,
             dtype=tf.float32)
+        output_shape = self.output_shape
+        if output_shape[0] is None:
+          output_shape = [tf.shape(inputs)[0], *output_shape[1:]]
         conv_t = tf.nn.conv2d_transpose(
             value=inputs,
             filter=kernels,
-            output_shape=self.output_shape,
+            output_shape=output_shape,
             strides=[1, self.stride, self.stride, 1],
             padding=self.padding)
 
@@ -571,7 +575,8 @@ class Reshape(object):
     """Reshape a tensor.
 
     Args:
-      shape: shape of output tensor
+      shape: shape of output tensor, the batch size of inputs is used if
+             the first dimension is None
       name: name of output tensor
     """
     self.shape = shape
@@ -593,7 +598,10 @@ class Reshape(object):
     Returns:
       reshaped tensor
     """
-    rs = tf.reshape(inputs, shape=self.shape, name=self.name)
+    shape = self.shape
+    if shape[0] is None:
+      shape = [tf.shape(inputs)[0], *shape[1:]]
+    rs = tf.reshape(inputs, shape=shape, name=self.name)
     self.tensor_shape = rs.get_shape().as_list()
     return rs
 
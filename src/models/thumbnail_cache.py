@@ -0,0 +1,216 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import os
+import hashlib
+import pickle
+import numpy as np
+from os.path import join, isfile, abspath, getmtime, getsize
+from PIL import Image
+
+
+def letterbox_img(img, img_size, img_mode='L', bg_color='white'):
+  """Resize an image to img_size keeping its aspect ratio.
+
+  The resized image is pasted in the middle of a new image filled with
+  bg_color, which is the same as _resize_oracle_img in preprocess.py.
+
+  Args:
+    img: PIL image
+    img_size: (width, height) of the new image
+    img_mode: mode of the new image
+    bg_color: background color
+
+  Returns:
+    PIL image with size of img_size
+  """
+  reshaped_image = Image.new(img_mode, img_size, bg_color)
+  img_width, img_height = img.size
+
+  if img_width > img_height:
+    w_s = img_size[0]
+    h_s = int(w_s * img_height // img_width)
+    img = img.resize((w_s, h_s), Image.LANCZOS)
+    reshaped_image.paste(img, (0, int((img_size[1] - h_s) // 2)))
+  else:
+    h_s = img_size[1]
+    w_s = int(h_s * img_width // img_height)
+    img = img.resize((w_s, h_s), Image.LANCZOS)
+    reshaped_image.paste(img, (int((img_size[0] - w_s) // 2), 0))
+
+  return reshaped_image
+
+
+class ThumbnailCache(object):
+  """On-disk cache of decoded and resized source images.
+
+  Thumbnails of one size are stored in a single memory-mapped uint8 tensor
+  with shape (capacity, height, width[, channels]). An index file maps the
+  sha1 of the source file content to the row of the tensor, so the same
+  image is only decoded once no matter which tool or path loads it.
+
+  Only one process may write to a cache. Worker processes should open it
+  with read_only=True, images missing in a read-only cache are decoded but
+  not inserted.
+  """
+
+  def __init__(self,
+               cache_dir,
+               img_size,
+               img_mode='L',
+               bg_color='white',
+               init_capacity=4096,
+               read_only=False):
+    """
+    Args:
+      cache_dir: directory of cache files
+      img_size: (width, height) of thumbnails
+      img_mode: 'L' or 'RGB'
+      bg_color: background color of letterbox
+      init_capacity: number of rows allocated for a new cache file
+      read_only: open the cache without writing to it
+    """
+    self.cache_dir = cache_dir
+    self.img_size = tuple(img_size)
+    self.img_mode = img_mode
+    self.bg_color = bg_color
+    self.read_only = read_only
+
+    if not os.path.isdir(cache_dir):
+      os.makedirs(cache_dir)
+
+    cache_name = 'thumbs_{}x{}_{}'.format(
+        self.img_size[0], self.img_size[1], img_mode)
+    self.data_path = join(cache_dir, cache_name + '.dat')
+    self.index_path = join(cache_dir, cache_name + '_index.p')
+
+    if img_mode == 'L':
+      self.row_shape = (self.img_size[1], self.img_size[0])
+    else:
+      self.row_shape = (self.img_size[1], self.img_size[0], 3)
+
+    # hashes: {content_hash: row}
+    # files: {abs_path: (mtime, file_size, content_hash)}
+    if isfile(self.index_path) and isfile(self.data_path):
+      with open(self.index_path, 'rb') as f:
+        index = pickle.load(f)
+      self.hashes = index['hashes']
+      self.files = index['files']
+      self.n_rows = index['n_rows']
+      self.capacity = index['capacity']
+      self.data = np.memmap(self.data_path, dtype=np.uint8,
+                            mode='r' if read_only else 'r+',
+                            shape=(self.capacity, *self.row_shape))
+    elif read_only:
+      self.hashes = {}
+      self.files = {}
+      self.n_rows = 0
+      self.capacity = 0
+      self.data = None
+    else:
+      self.hashes = {}
+      self.files = {}
+      self.n_rows = 0
+      self.capacity = 0
+      self.data = None
+      self._grow(init_capacity)
+
+    self._dirty = False
+
+  def __len__(self):
+    return self.n_rows
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, exc_type, exc_val, exc_tb):
+    self.flush()
+
+  def _grow(self, min_capacity):
+    """Enlarge the memory-mapped tensor to hold min_capacity rows."""
+    new_capacity = max(min_capacity, self.capacity * 2)
+    if self.data is not None:
+      self.data.flush()
+      del self.data
+    with open(self.data_path, 'ab') as f:
+      f.truncate(new_capacity * int(np.prod(self.row_shape)))
+    self.capacity = new_capacity
+    self.data = np.memmap(self.data_path, dtype=np.uint8, mode='r+',
+                          shape=(self.capacity, *self.row_shape))
+
+  def _content_hash(self, file_path):
+    """Get content hash of a file, reuse it if the file is not modified."""
+    file_path = abspath(file_path)
+    stat_key = (getmtime(file_path), getsize(file_path))
+    cached = self.files.get(file_path)
+    if cached is not None and cached[:2] == stat_key:
+      return cached[2]
+
+    with open(file_path, 'rb') as f:
+      content_hash = hashlib.sha1(f.read()).hexdigest()
+    if not self.read_only:
+      self.files[file_path] = (*stat_key, content_hash)
+      self._dirty = True
+    return content_hash
+
+  def _decode(self, file_path):
+    """Decode and resize a source image."""
+    img = Image.open(file_path).convert(self.img_mode)
+    img = letterbox_img(img, self.img_size, self.img_mode, self.bg_color)
+    return np.array(img, dtype=np.uint8)
+
+  def _get_row(self, file_path):
+    """Get the row of a file in the tensor, decode it if missing."""
+    content_hash = self._content_hash(file_path)
+    row = self.hashes.get(content_hash)
+    if row is None:
+      if self.n_rows >= self.capacity:
+        self._grow(self.n_rows + 1)
+      row = self.n_rows
+      self.data[row] = self._decode(file_path)
+      self.hashes[content_hash] = row
+      self.n_rows += 1
+      self._dirty = True
+    return row
+
+  def get(self, file_path):
+    """Get the thumbnail of a source image.
+
+    Returns:
+      uint8 array with shape (height, width) or (height, width, 3)
+    """
+    if self.read_only:
+      row = self.hashes.get(self._content_hash(file_path))
+      if row is None:
+        return self._decode(file_path)
+      return np.array(self.data[row])
+    return np.array(self.data[self._get_row(file_path)])
+
+  def get_many(self, file_paths):
+    """Get thumbnails of a list of source images.
+
+    New thumbnails are not written to the index until flush() is called.
+
+    Returns:
+      uint8 array with shape (n_images, height, width[, 3])
+    """
+    if self.read_only:
+      return np.array([self.get(p) for p in file_paths], dtype=np.uint8)
+    rows = [self._get_row(p) for p in file_paths]
+    return self.data[rows]
+
+  def flush(self):
+    """Write the tensor and the index to disk."""
+    if self.read_only or not self._dirty:
+      return
+    self.data.flush()
+    index = dict(hashes=self.hashes,
+                 files=self.files,
+                 n_rows=self.n_rows,
+                 capacity=self.capacity)
+    tmp_path = self.index_path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+      pickle.dump(index, f)
+    os.replace(tmp_path, self.index_path)
+    self._dirty = False
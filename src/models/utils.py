@@ -11,16 +11,18 @@ import math
 import time
 import gzip
 import shutil
+import queue
 import pickle
 import tarfile
+import threading
 from os import listdir
+from collections import deque
+from contextlib import contextmanager
 
 import numpy as np
-import tensorflow as tf
-from os.path import join, isdir
+from os.path import join, isdir, isfile
 from tqdm import tqdm
 from PIL import Image
-from matplotlib import pyplot as plt
 from urllib.request import urlretrieve
 
 
@@ -84,11 +86,12 @@ def load_pkls(dir_path,
               tl=False,
               add_n_batch=0):
   """Load data from pickle file or files."""
-  indices = []
+  # Manifests, journals and shards of parts have the same prefix
+  indices = set()
   for f_name in listdir(dir_path):
-    m = re.match(file_name + '_(\d*).p', f_name)
+    m = re.match(re.escape(file_name) + r'_(\d+)\.p$', f_name)
     if m:
-      indices.append(int(m.group(1)))
+      indices.add(int(m.group(1)))
   if indices:
     return load_large_data_from_pkl(
         '{}/{}'.format(dir_path, file_name),
@@ -104,6 +107,39 @@ def load_pkls(dir_path,
         add_n_batch=add_n_batch)
 
 
+def load_pkls_mmap(dir_path,
+                   file_name,
+                   verbose=True,
+                   tl=False,
+                   add_n_batch=0):
+  """Load data from pickle file or files as a read-only memmap.
+
+  Data is converted to a .npy file next to the pickle files once, which is
+  reused as long as it is newer than the pickle files.
+  """
+  npy_path = join(dir_path, file_name + '.npy')
+  src_mtime = max(
+      os.path.getmtime(join(dir_path, f_name))
+      for f_name in listdir(dir_path)
+      if re.match(file_name + r'(_\d*)?\.p$', f_name))
+
+  if (not isfile(npy_path)) or os.path.getmtime(npy_path) < src_mtime:
+    data = load_pkls(
+        dir_path, file_name, verbose=verbose, tl=tl, add_n_batch=add_n_batch)
+    if verbose:
+      print('Saving {}...'.format(npy_path))
+    tmp_path = npy_path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+      np.save(f, data)
+    os.replace(tmp_path, npy_path)
+    del data
+    gc.collect()
+
+  if verbose:
+    print('Loading {} as memmap...'.format(npy_path))
+  return np.load(npy_path, mmap_mode='r')
+
+
 def load_data_from_pkl(data_path,
                        verbose=True,
                        tl=False,
@@ -144,16 +180,92 @@ def load_large_data_from_pkl(data_path,
   assert concat.shape[1:] == data[0].shape[1:]
 
   if verbose:
-    print('Total Size: {:.4}Gb'.format(concat / (10**9)))
+    print('Total Size: {:.4}Gb'.format(concat.nbytes / (10**9)))
     print('Data Shape: ', concat.shape)
 
   return concat
 
 
+BF_STORAGE_DTYPES = ('float32', 'float16', 'int8')
+
+
+def get_bf_manifest_path(file_path):
+  """Get the path of the manifest of a bottleneck features file."""
+  return file_path + '.manifest'
+
+
+def quantize_features(features, storage_dtype='float32'):
+  """Convert features to the data type to store.
+
+  For 'int8', features are quantized symmetrically with a scale for each
+  channel (the last axis): features ~= stored * scales.
+
+  Returns:
+    stored features and scales of channels (None if not quantized)
+  """
+  if storage_dtype == 'float32':
+    return features.astype(np.float32, copy=False), None
+  elif storage_dtype == 'float16':
+    return features.astype(np.float16), None
+  elif storage_dtype == 'int8':
+    features = features.astype(np.float32, copy=False)
+    scales = np.abs(features).max(axis=tuple(range(features.ndim - 1))) / 127.
+    scales[scales == 0] = 1.
+    stored = np.clip(np.rint(features / scales), -127, 127).astype(np.int8)
+    return stored, scales.astype(np.float32)
+  else:
+    raise ValueError('Wrong storage data type: {}! Choose from: {}'.format(
+        storage_dtype, BF_STORAGE_DTYPES))
+
+
+def dequantize_features(stored, scales=None, out=None):
+  """Convert stored features back to float32."""
+  if out is None:
+    out = np.empty(stored.shape, dtype=np.float32)
+  if scales is None:
+    out[...] = stored
+  else:
+    np.multiply(stored, scales, out=out)
+  return out
+
+
+def load_data_tl_quantized(file_path, manifest, verbose=True):
+  """Load bottleneck features described by a manifest.
+
+  Batches are dequantized one by one into a preallocated float32 array.
+  """
+  if verbose:
+    print('Loading bottleneck features: {} ({})...'.format(
+        file_path, manifest['storage_dtype']))
+    print('N_Images: ', manifest['n_imgs'])
+
+  scales = manifest['scales']
+  features = np.empty(
+      (manifest['n_imgs'],) + tuple(manifest['feature_shape']),
+      dtype=np.float32)
+  start = 0
+  with open(file_path, 'rb') as f:
+    for i in range(manifest['n_batches']):
+      stored = pickle.load(f)
+      dequantize_features(
+          stored,
+          scales=None if scales is None else scales[i],
+          out=features[start:start + len(stored)])
+      start += len(stored)
+  assert start == manifest['n_imgs']
+  return features
+
+
 def load_data_tl(file_path,
                  size_batch=1048737,
                  verbose=True,
                  add_n_batch=0):
+  manifest_path = get_bf_manifest_path(file_path)
+  if isfile(manifest_path):
+    with open(manifest_path, 'rb') as f:
+      manifest = pickle.load(f)
+    return load_data_tl_quantized(file_path, manifest, verbose=verbose)
+
   with open(file_path, 'rb') as f:
     size_total = sys.getsizeof(f.read())
     if verbose:
@@ -173,18 +285,22 @@ def load_data_tl(file_path,
 
 
 def get_vec_length(vec, batch_size, epsilon):
-  """Get the length of a vector."""
+  """Get the length of a vector.
+
+  batch_size is only used to check shapes, and None is for a dynamic one.
+  """
+  import tensorflow as tf
   vec_shape = vec.get_shape().as_list()
   num_caps = vec_shape[1]
   vec_dim = vec_shape[2]
 
   # vec shape: (batch_size, num_caps, vec_dim)
-  assert vec.get_shape() == (batch_size, num_caps, vec_dim)
+  assert vec.get_shape().is_compatible_with((batch_size, num_caps, vec_dim))
 
   vec_length = tf.reduce_sum(tf.square(vec), axis=2, keep_dims=True) + epsilon
-  vec_length = tf.sqrt(tf.squeeze(vec_length))
+  vec_length = tf.sqrt(tf.squeeze(vec_length, axis=2))
   # vec_length shape: (batch_size, num_caps)
-  assert vec_length.get_shape() == (batch_size, num_caps)
+  assert vec_length.get_shape().is_compatible_with((batch_size, num_caps))
 
   return vec_length
 
@@ -204,6 +320,32 @@ def thick_line():
   print('=' * 55)
 
 
+def pad_batch(batch, batch_size):
+  """Pad a batch to batch_size with copies of its first example."""
+  return np.concatenate(
+      [batch, np.repeat(batch[:1], batch_size - len(batch), axis=0)])
+
+
+def split_for_towers(n_examples, n_splits):
+  """Split a batch into parts which can be split equally into towers.
+
+  The first part holds the most examples which can be split equally. The
+  remaining examples are tiled n_splits times, so every tower gets all of
+  them and the metrics of the towers are the metrics of these examples.
+
+  Returns:
+    list of (indices, number of examples) of parts
+  """
+  n_even = n_examples - n_examples % n_splits
+  parts = []
+  if n_even:
+    parts.append((slice(0, n_even), n_even))
+  if n_even < n_examples:
+    parts.append((np.tile(np.arange(n_even, n_examples), n_splits),
+                  n_examples - n_even))
+  return parts
+
+
 def get_batches(x, y=None, imgs=None, batch_size=None, keep_last=False):
   """Split features and labels into batches."""
   if keep_last:
@@ -367,6 +509,39 @@ def save_log(file_path, epoch_i, step, using_time,
       writer.writerow(log)
 
 
+def save_timing_log(file_path, epoch_i, step, stats):
+  """Save time breakdown of training steps."""
+  if not os.path.isfile(file_path):
+    with open(file_path, 'w') as f:
+      writer = csv.writer(f)
+      writer.writerow(['Local_Time', 'Epoch', 'Batch', *stats.keys()])
+
+  with open(file_path, 'a') as f:
+    local_time = time.strftime(
+        '%Y/%m/%d-%H:%M:%S', time.localtime(time.time()))
+    writer = csv.writer(f)
+    writer.writerow([local_time, epoch_i, step, *stats.values()])
+
+
+def truncate_log(file_path, step):
+  """Remove rows of a training log which are logged at or after step.
+
+  The third column of the log is the step. The log is rewritten only if
+  some rows are removed.
+  """
+  if not os.path.isfile(file_path):
+    return
+  with open(file_path, 'r', newline='') as f:
+    rows = list(csv.reader(f))
+  kept_rows = rows[:1] + [r for r in rows[1:] if int(r[2]) < step]
+  if len(kept_rows) == len(rows):
+    return
+  tmp_path = file_path + '.tmp'
+  with open(tmp_path, 'w', newline='') as f:
+    csv.writer(f).writerows(kept_rows)
+  os.replace(tmp_path, file_path)
+
+
 def save_test_log(file_path, loss_test, acc_test,
                   clf_loss_test, rec_loss_test, with_rec,
                   top_n_list, acc_top_n_list):
@@ -868,11 +1043,115 @@ def img_black_to_color(imgs, same=False):
   return np.array(imgs_)
 
 
-def imgs_scale_to_255(imgs):
+def imgs_min_max_scale(imgs,
+                       scale=1.,
+                       out=None,
+                       dtype=np.float32,
+                       truncate=False,
+                       max_chunk_bytes=2**26):
+  """Scale each sample to [0, scale] by its own minimum and maximum.
+
+  The minimum and maximum are reduced over all non-batch axes at once and
+  results are written into a preallocated output. Samples with zero range are
+  set to 0.
+
+  Args:
+    imgs: array with shape (batch_size, ...)
+    scale: maximum of scaled samples
+    out: preallocated output array with the same shape as imgs
+    dtype: dtype of output if out is None, e.g. np.uint8 or np.float32
+    truncate: truncate scaled values to integers
+    max_chunk_bytes: maximum size of float32 temporary array
+
+  Returns:
+    scaled array
+  """
+  imgs = np.asarray(imgs)
+  if out is None:
+    out = np.empty(imgs.shape, dtype=dtype)
+  assert out.shape == imgs.shape, (out.shape, imgs.shape)
+  if imgs.size == 0:
+    return out
+
+  reduce_axes = tuple(range(1, imgs.ndim))
+  sample_size = int(np.prod(imgs.shape[1:]))
+  chunk_size = max(1, max_chunk_bytes // (sample_size * 4))
+  write_direct = out.dtype == np.float32 and not truncate
+
+  for start in range(0, len(imgs), chunk_size):
+    end = start + chunk_size
+    chunk = imgs[start:end]
+    mins = chunk.min(axis=reduce_axes, keepdims=True).astype(np.float32)
+    ranges = chunk.max(axis=reduce_axes, keepdims=True) - mins
+    ranges[ranges == 0] = np.inf
+
+    # (x - min) * scale / (max - min)
+    buf = out[start:end] if write_direct else np.empty(
+        chunk.shape, dtype=np.float32)
+    np.subtract(chunk, mins, out=buf, dtype=np.float32)
+    np.multiply(buf, scale, out=buf)
+    np.divide(buf, ranges, out=buf)
+    if truncate:
+      np.trunc(buf, out=buf)
+    if not write_direct:
+      out[start:end] = buf
+
+  return out
+
+
+def imgs_scale_to_255(imgs, out=None, dtype=np.uint8):
   """Scale images to 0-255"""
-  return np.array(
-      [np.divide(((i - i.min()) * 255),
-                 (i.max() - i.min())) for i in imgs]).astype(int)
+  return imgs_min_max_scale(
+      imgs, scale=255., out=out, dtype=dtype, truncate=True)
+
+
+def tile_imgs(imgs, col_gap=0, bottom_gap=0, bg_color=255):
+  """Tile a grid of images into rows of one array.
+
+  Each image is padded with col_gap columns on the right and bottom_gap rows
+  at the bottom, filled with bg_color.
+
+  Args:
+    imgs: array with shape (n_rows, n_cols, height, width, channels)
+    col_gap: gap between columns
+    bottom_gap: gap below each row
+    bg_color: color of gaps
+
+  Returns:
+    array with shape
+      (n_rows, height + bottom_gap, n_cols * (width + col_gap), channels)
+  """
+  n_rows, n_cols, height, width, channels = imgs.shape
+  imgs = np.pad(imgs, ((0, 0), (0, 0), (0, bottom_gap), (0, col_gap), (0, 0)),
+                mode='constant', constant_values=bg_color)
+  # (n_rows, n_cols, h, w, c) -> (n_rows, h, n_cols, w, c)
+  imgs = imgs.transpose((0, 2, 1, 3, 4))
+  return imgs.reshape(
+      (n_rows, height + bottom_gap, n_cols * (width + col_gap), channels))
+
+
+def compose_comparison_grid(real_imgs, rec_imgs, thin_gap=1, thick_gap=3):
+  """Compose real and reconstructed images into one grid image.
+
+  Rows of real images and rows of reconstructed images alternate. Images are
+  separated by thin gaps, and each (real, reconstructed) pair of rows is
+  separated from the next one by a thick gap, with a thick margin around.
+
+  Args:
+    real_imgs: uint8 array with shape (n_rows, n_cols, height, width, channels)
+    rec_imgs: uint8 array with the same shape as real_imgs
+    thin_gap: gap between images
+    thick_gap: gap between pairs of rows and margin
+
+  Returns:
+    uint8 array with shape (grid_height, grid_width, channels)
+  """
+  real_rows = tile_imgs(real_imgs, col_gap=thin_gap, bottom_gap=thin_gap)
+  rec_rows = tile_imgs(rec_imgs, col_gap=thin_gap, bottom_gap=thick_gap)
+  pairs = np.concatenate([real_rows, rec_rows], axis=1)
+  grid = pairs.reshape((-1, *pairs.shape[2:]))
+  margin = ((thick_gap, 0), (thick_gap, thick_gap - thin_gap), (0, 0))
+  return np.pad(grid, margin, mode='constant', constant_values=255)
 
 
 def save_imgs(real_imgs,
@@ -895,56 +1174,29 @@ def save_imgs(real_imgs,
   if save_col_size > max_img_in_col:
     save_col_size = max_img_in_col
   save_row_size = save_col_size // 2
+  n_save = save_row_size * save_col_size
 
   # Scale to 0-255
-  rec_images_ = imgs_scale_to_255(rec_imgs)
-  real_images_ = imgs_scale_to_255(real_imgs)
+  rec_images_ = imgs_scale_to_255(rec_imgs[:n_save])
+  real_images_ = imgs_scale_to_255(real_imgs[:n_save])
 
   # Put images in a square arrangement
   rec_images_in_square = np.reshape(
-      rec_images_[: save_row_size * save_col_size],
-      (save_row_size, save_col_size, *img_shape)).astype(np.uint8)
+      rec_images_, (save_row_size, save_col_size, *img_shape))
   real_images_in_square = np.reshape(
-      real_images_[: save_row_size * save_col_size],
-      (save_row_size, save_col_size, *img_shape)).astype(np.uint8)
+      real_images_, (save_row_size, save_col_size, *img_shape))
 
   mode = 'RGB'
   if database_name == 'mnist' or database_name == 'radical':
     if not colorful:
       mode = 'L'
-      rec_images_in_square = np.squeeze(rec_images_in_square, 4)
-      real_images_in_square = np.squeeze(real_images_in_square, 4)
 
   # Combine images to grid image
-  thin_gap = 1
-  thick_gap = 3
-  avg_gap = (thin_gap + thick_gap) / 2
-  new_im = Image.new(mode, (
-    int((img_shape[1] + thin_gap) *
-        save_col_size - thin_gap + thick_gap * 2),
-    int((img_shape[0] + avg_gap) *
-        save_row_size * 2 + thick_gap)), 'white')
-
-  for row_i in range(save_row_size * 2):
-    for col_i in range(save_col_size):
-      if (row_i + 1) % 2 == 0:  # Odd
-        if mode == 'L':
-          image = rec_images_in_square[(row_i + 1) // 2 - 1, col_i, :, :]
-        else:
-          image = rec_images_in_square[(row_i + 1) // 2 - 1, col_i, :, :, :]
-        im = Image.fromarray(image, mode)
-        new_im.paste(im, (
-          int(col_i * (img_shape[1] + thin_gap) + thick_gap),
-          int(row_i * img_shape[0] + (row_i + 1) * avg_gap)))
-      else:  # Even
-        if mode == 'L':
-          image = real_images_in_square[int((row_i + 1) // 2), col_i, :, :]
-        else:
-          image = real_images_in_square[int((row_i + 1) // 2), col_i, :, :, :]
-        im = Image.fromarray(image, mode)
-        new_im.paste(im, (
-          int(col_i * (img_shape[1] + thin_gap) + thick_gap),
-          int(row_i * (img_shape[0] + avg_gap) + thick_gap)))
+  grid = compose_comparison_grid(
+      real_images_in_square, rec_images_in_square, thin_gap=1, thick_gap=3)
+  if mode == 'L':
+    grid = np.squeeze(grid, axis=-1)
+  new_im = Image.fromarray(grid, mode)
 
   if test_flag:
     if step:
@@ -986,21 +1238,18 @@ def square_grid_show_imgs(images, mode=None):
 
   # images_in_square.shape = (5, 5, 28, 28, 1)
 
+  # Combine images to grid image
+  new_im = tile_imgs(images_in_square)
+  new_im = new_im.reshape((-1, *new_im.shape[2:]))
+
   if mode == 'L':
     cmap = 'gray'
-    images_in_square = np.squeeze(images_in_square, 4)
+    new_im = np.squeeze(new_im, axis=-1)
   else:
     cmap = None
 
-  # Combine images to grid image
-  new_im = Image.new(mode,
-                     (images.shape[1] * img_size, images.shape[2] * img_size))
-  for row_i, row_images in enumerate(images_in_square):
-    for col_i, image in enumerate(row_images):
-      im = Image.fromarray(image, mode)
-      new_im.paste(im, (col_i * images.shape[1], row_i * images.shape[2]))
-
-  plt.imshow(np.array(new_im), cmap=cmap)
+  from matplotlib import pyplot as plt
+  plt.imshow(new_im, cmap=cmap)
   plt.show()
 
 
@@ -1011,6 +1260,232 @@ def is_radical_database(name):
     return False
 
 
+class BackgroundWorker(object):
+  """Run functions in a background thread.
+
+  Jobs are put into a bounded queue, so submit() blocks while the queue is
+  full instead of letting pending jobs grow without limit. Exceptions raised
+  in the background thread are raised again in the next submit(), join() or
+  close().
+  """
+
+  def __init__(self, max_queue_size=4, name='background_worker'):
+    """
+    Args:
+      max_queue_size: maximum number of pending jobs.
+                      If None, run jobs synchronously in submit().
+      name: name of the thread
+    """
+    self.synchronous = max_queue_size is None
+    self._error = None
+    if not self.synchronous:
+      self._queue = queue.Queue(maxsize=max_queue_size)
+      self._thread = threading.Thread(target=self._run, name=name)
+      self._thread.daemon = True
+      self._thread.start()
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, exc_type, exc_val, exc_tb):
+    self.close()
+
+  def _run(self):
+    while True:
+      job = self._queue.get()
+      try:
+        if job is None:
+          return
+        fn, args, kwargs = job
+        # Skip remaining jobs after an error
+        if self._error is None:
+          fn(*args, **kwargs)
+      except Exception as err:
+        self._error = err
+      finally:
+        self._queue.task_done()
+
+  def _raise_error(self):
+    if self._error is not None:
+      err, self._error = self._error, None
+      raise err
+
+  def submit(self, fn, *args, **kwargs):
+    """Add a job to the queue, block if the queue is full."""
+    if self.synchronous:
+      fn(*args, **kwargs)
+    else:
+      self._raise_error()
+      self._queue.put((fn, args, kwargs))
+
+  def join(self):
+    """Wait until all pending jobs are done."""
+    if not self.synchronous:
+      self._queue.join()
+      self._raise_error()
+
+  def close(self):
+    """Finish all pending jobs and stop the thread."""
+    if not self.synchronous and self._thread.is_alive():
+      self._queue.put(None)
+      self._thread.join()
+    self._raise_error()
+
+
+class EpochSampler(object):
+  """Sample batches with a new permutation of indices in every epoch.
+
+  Only indices are shuffled, batches are gathered from the arrays by index,
+  so the data set (which can be a memmap) is never copied as a whole.
+  Indices of each batch are sorted to keep reads of memmaps sequential.
+  """
+
+  def __init__(self, n_samples, batch_size, y=None, seed=None):
+    """
+    Args:
+      n_samples: number of samples in the data set
+      batch_size: number of samples in a batch
+      y: one-hot labels. If given, every batch is stratified by class,
+         i.e. each class has about the same proportion as in the data set.
+      seed: random seed
+    """
+    self.n_samples = n_samples
+    self.batch_size = batch_size
+    self.n_batch = n_samples // batch_size
+    self.rng = np.random.RandomState(seed)
+    if y is not None:
+      classes = np.argmax(y, axis=1)
+      self._class_indices = [
+          np.flatnonzero(classes == c) for c in np.unique(classes)]
+    else:
+      self._class_indices = None
+
+  def _stratified_permutation(self):
+    """Spread samples of each class evenly over the epoch."""
+    positions = np.empty(self.n_samples, dtype=np.float64)
+    for indices in self._class_indices:
+      n = len(indices)
+      # Relative position of each sample in the epoch, jittered
+      positions[self.rng.permutation(indices)] = \
+          (np.arange(n) + self.rng.rand(n)) / n
+    return np.argsort(positions, kind='stable')
+
+  def permutation(self):
+    """Get the order of indices of a new epoch."""
+    if self._class_indices is not None:
+      return self._stratified_permutation()
+    else:
+      return self.rng.permutation(self.n_samples)
+
+  def get_batches(self, x, y=None, imgs=None, start_batch=0):
+    """Gather batches of a new epoch, the last incomplete batch is dropped.
+
+    The permutation is drawn when this is called, not at the first batch.
+
+    Args:
+      x, y, imgs: arrays of the data set
+      start_batch: index of the first batch, used to resume an epoch
+    """
+    return self._gather_batches(self.permutation(), x, y, imgs, start_batch)
+
+  def _gather_batches(self, order, x, y, imgs, start_batch):
+    for i in range(start_batch, self.n_batch):
+      idx = np.sort(order[i * self.batch_size:(i + 1) * self.batch_size])
+      x_batch = x[idx]
+      if (y is not None) and (imgs is not None):
+        imgs_batch = x_batch if imgs is x else imgs[idx]
+        yield x_batch, y[idx], imgs_batch
+      elif (y is not None) and (imgs is None):
+        yield x_batch, y[idx]
+      else:
+        yield x_batch
+
+  def get_state(self):
+    """Get the state of the random generator."""
+    return self.rng.get_state()
+
+  def set_state(self, state):
+    """Restore the state of the random generator."""
+    self.rng.set_state(state)
+
+
+class StepTimer(object):
+  """Time phases of training steps.
+
+  The time of a step is the time between two end_step() calls, so work done
+  between steps (e.g. at the end of an epoch) is counted in the next step.
+  Statistics are averaged over the last window steps.
+  """
+
+  def __init__(self, phases, batch_size, window=100, main_phase='optimizer'):
+    """
+    Args:
+      phases: names of timed phases
+      batch_size: number of images of a step
+      window: number of recent steps to average over
+      main_phase: phase whose fraction of the total time is reported
+    """
+    self.phases = phases
+    self.batch_size = batch_size
+    self.main_phase = main_phase
+    self._history = deque(maxlen=window)
+    self._step_times = dict.fromkeys(phases, 0.)
+    self._last_time = time.perf_counter()
+
+  @contextmanager
+  def phase(self, name):
+    """Time a phase of the current step."""
+    start_time = time.perf_counter()
+    try:
+      yield
+    finally:
+      self._step_times[name] += time.perf_counter() - start_time
+
+  def end_step(self):
+    now = time.perf_counter()
+    self._history.append((now - self._last_time, self._step_times))
+    self._step_times = dict.fromkeys(self.phases, 0.)
+    self._last_time = now
+
+  def get_stats(self):
+    """Get images/sec, fraction of the main phase and ms/step of phases.
+
+    Returns an empty dict if no step has ended or no time has passed.
+    """
+    n_steps = len(self._history)
+    total_time = sum(t for t, _ in self._history)
+    if n_steps == 0 or total_time == 0:
+      return {}
+    phase_times = {name: sum(times[name] for _, times in self._history)
+                   for name in self.phases}
+    stats = {
+      'images_per_sec': n_steps * self.batch_size / total_time,
+      '{}_fraction'.format(self.main_phase):
+        phase_times[self.main_phase] / total_time,
+    }
+    for name in self.phases:
+      stats['{}_ms'.format(name)] = 1000 * phase_times[name] / n_steps
+    stats['other_ms'] = \
+        1000 * (total_time - sum(phase_times.values())) / n_steps
+    return stats
+
+
+class NullStepTimer(object):
+  """A StepTimer doing nothing, used when timing is turned off."""
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, exc_type, exc_val, exc_tb):
+    return False
+
+  def phase(self, name):
+    return self
+
+  def end_step(self):
+    pass
+
+
 class DLProgress(tqdm):
   """Handle Progress Bar while Downloading."""
   last_block = 0
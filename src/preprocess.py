@@ -16,19 +16,22 @@ import sklearn.utils
 from copy import copy
 from tqdm import tqdm
 from os import listdir
-from os.path import join
+from os.path import join, isfile, getmtime
+from multiprocessing import get_context, cpu_count
 from sklearn.preprocessing import LabelBinarizer
 from sklearn.model_selection import train_test_split
 
 from models import utils
+from models.thumbnail_cache import ThumbnailCache, letterbox_img
 from config import config as cfg
 from baseline_config import config as basel_cfg
-from models.get_transfer_learning_codes import GetBottleneckFeatures
+from models.get_transfer_learning_codes import \
+    GetBottleneckFeatures, clear_model_cache
 
 from keras.preprocessing.image import ImageDataGenerator
 import keras.backend.tensorflow_backend as KTF
 import tensorflow as tf
-KTF.set_session(tf.Session(config=tf.ConfigProto(device_count={'gpu': 0})))
+KTF.set_session(tf.Session(config=tf.ConfigProto(device_count={'GPU': 0})))
 
 
 class DataPreProcess(object):
@@ -81,6 +84,7 @@ class DataPreProcess(object):
 
     self.x_test = None
     self.y_test = None
+    self.thumbnail_cache = None
 
   def _change_pose(self, tensor_x, tensor_y, num_imgs=1, grid_size=4):
     """Change position of images."""
@@ -175,16 +179,11 @@ class DataPreProcess(object):
       cls_name = str(cls_)
       class_dir = join(self.source_data_path, cls_name)
       images = os.listdir(class_dir)
-      x_tensor = []
-      for img_name in images:
-        # Load image
-        img = Image.open(join(class_dir, img_name)).convert('L')
-        # Resize image
-        reshaped_img = self._resize_oracle_img(img, self.input_size)
-        # Change background
-        reshaped_img = 255 - reshaped_img
-        # Save image to array
-        x_tensor.append(reshaped_img)
+      # Load and resize images
+      x_tensor = self._load_source_imgs(
+          [join(class_dir, img_name) for img_name in images])
+      # Change background
+      x_tensor = list(255 - x_tensor)
 
       # Data augment
       if self.cfg.USE_DATA_AUG:
@@ -195,6 +194,9 @@ class DataPreProcess(object):
       self.x.append(x_tensor)
       self.y.extend([int(cls_name) for _ in range(len(x_tensor))])
 
+    if self.thumbnail_cache is not None:
+      self.thumbnail_cache.flush()
+
     self.x = np.array(
         self.x, dtype=self.data_type).reshape((-1, *self.x[0][0].shape))
     self.y = np.array(self.y, dtype=np.int)
@@ -211,7 +213,7 @@ class DataPreProcess(object):
     utils.thin_line()
     print('Loading oracles data set...')
 
-    x_test_oracle = []
+    img_paths = []
     y_test_oracle = []
     df = pd.read_csv(join(self.cfg.SOURCE_DATA_PATH,
                           'recognized_oracles_labels.csv'))
@@ -219,21 +221,19 @@ class DataPreProcess(object):
                        total=len(df),
                        ncols=100,
                        unit=' images'):
-      img_path = row['file_path']
+      img_paths.append(join(self.cfg.SOURCE_DATA_PATH, row['file_path']))
       label = pd.eval(row['label'])
-
-      # Load image
-      img = Image.open(join(self.cfg.SOURCE_DATA_PATH, img_path)).convert('L')
-      # Resize image
-      reshaped_img = self._resize_oracle_img(img, self.input_size)
-      # Change background
-      reshaped_img = 255 - reshaped_img
-      # Scaling
-      reshaped_img = np.divide(reshaped_img, 255.)
-
-      x_test_oracle.append(reshaped_img)
       y_test_oracle.append(label[:self.cfg.NUM_RADICALS])
 
+    # Load and resize images
+    x_test_oracle = self._load_source_imgs(img_paths)
+    if self.thumbnail_cache is not None:
+      self.thumbnail_cache.flush()
+    # Change background
+    x_test_oracle = 255 - x_test_oracle
+    # Scaling
+    x_test_oracle = np.divide(x_test_oracle, 255.)
+
     self.x_test_oracle = np.array(x_test_oracle)
     self.y_test_oracle = np.array(y_test_oracle, dtype=np.int64)
 
@@ -254,25 +254,29 @@ class DataPreProcess(object):
 
   def _resize_oracle_img(self, img, img_size):
     """Resizing an image to img_size"""
-    reshaped_image = Image.new(self.img_mode, img_size, 'white')
-    img_width, img_height = img.size
-
-    if img_width > img_height:
-      w_s = img_size[0]
-      h_s = int(w_s * img_height // img_width)
-      img = img.resize((w_s, h_s), Image.ANTIALIAS)
-      reshaped_image.paste(img, (0, int((img_size[1] - h_s) // 2)))
-    else:
-      h_s = img_size[1]
-      w_s = int(h_s * img_width // img_height)
-      img = img.resize((w_s, h_s), Image.ANTIALIAS)
-      reshaped_image.paste(img, (int((img_size[0] - w_s) // 2), 0))
-
+    reshaped_image = letterbox_img(img, img_size, self.img_mode, 'white')
     reshaped_image = np.array(reshaped_image, dtype=self.data_type)
     reshaped_image = reshaped_image.reshape((*reshaped_image.shape, 1))
     assert reshaped_image.shape == (*img_size, 1)
     return reshaped_image
 
+  def _load_source_imgs(self, img_paths):
+    """Load source images and resize them to input_size.
+
+    Thumbnails are read from the thumbnail cache if THUMBNAIL_CACHE_PATH is
+    set, only the images missing in the cache are decoded.
+    """
+    if self.cfg.THUMBNAIL_CACHE_PATH is None:
+      return np.array(
+          [self._resize_oracle_img(Image.open(p).convert('L'), self.input_size)
+           for p in img_paths], dtype=self.data_type)
+
+    if self.thumbnail_cache is None:
+      self.thumbnail_cache = ThumbnailCache(
+          self.cfg.THUMBNAIL_CACHE_PATH, self.input_size, img_mode='L')
+    imgs = self.thumbnail_cache.get_many(img_paths)
+    return imgs.astype(self.data_type).reshape((-1, *self.input_size, 1))
+
   def _augment_data(self, tensor, data_aug_param, img_num, add_self=True):
     """Augment data set and add noises."""
     data_generator = ImageDataGenerator(**data_aug_param)
@@ -712,51 +716,236 @@ class DataPreProcess(object):
     utils.thick_line()
 
 
+def _init_bf_worker(n_threads):
+  """Pin the number of threads used by a bottleneck features worker.
+
+  OMP_NUM_THREADS is set by the parent process before workers are spawned,
+  since it must be in the environment before numpy and tensorflow load.
+  """
+  if n_threads:
+    KTF.set_session(tf.Session(config=tf.ConfigProto(
+        device_count={'GPU': 0},
+        intra_op_parallelism_threads=n_threads,
+        inter_op_parallelism_threads=2)))
+
+
+def _get_bf_part(bf_getter, data_part, file_path, bf_params):
+  """Get bottleneck features of a part of images and verify the output.
+
+  Outputs which are already complete are skipped, and interrupted ones are
+  resumed from their journals.
+
+  Returns:
+    True if the output holds features of all images
+  """
+  pooling = bf_params['pooling']
+  if bf_getter.verify_bottleneck_features(file_path, len(data_part), pooling):
+    print('Bottleneck features are up to date: {}'.format(file_path))
+    return True
+  bf_getter.save_bottleneck_features(
+      data_part, file_path=file_path, **bf_params)
+  return bf_getter.verify_bottleneck_features(
+      file_path, len(data_part), pooling)
+
+
+def _remove_verified_caches(cache_paths, verified):
+  """Remove caches only if their bottleneck features are verified."""
+  if verified:
+    for cache_path in cache_paths:
+      os.remove(cache_path)
+  else:
+    print('Bottleneck features are incomplete, keep caches: {}'.format(
+        cache_paths))
+
+
+def _get_bf_shard(task):
+  """Get bottleneck features of a cache part or a shard in a worker."""
+  model_name, data_path, start, end, file_path, bf_params = task
+  if data_path.endswith('.npy'):
+    data_part = np.load(data_path, mmap_mode='r')[start:end]
+  else:
+    with open(data_path, 'rb') as f:
+      data_part = pickle.load(f)
+  verified = _get_bf_part(
+      GetBottleneckFeatures(model_name), data_part, file_path, bf_params)
+  return file_path, verified
+
+
+def _get_bf_in_processes(config,
+                         dir_path,
+                         cache_file_name,
+                         file_name,
+                         indices,
+                         bf_params):
+  """Get bottleneck features using a pool of processes.
+
+  Each cache part is sent to a worker as a task. If the cache is not split
+  into parts, it is split into shards of whole batches, and features of
+  shards are concatenated into a single file in order. Caches are removed
+  only after the outputs are verified.
+  """
+  n_processes = config.BF_NUM_PROCESSES
+  n_threads = config.BF_THREADS_PER_PROCESS or \
+      max(1, cpu_count() // n_processes)
+  print('Using {} processes with {} threads each...'.format(
+      n_processes, n_threads))
+
+  shard_paths = []
+  if indices:
+    cache_paths = [join(dir_path, '{}_{}.p'.format(cache_file_name, i))
+                   for i in indices]
+    tasks = [(config.TL_MODEL, cache_path, None, None,
+              join(dir_path, '{}_{}.p'.format(file_name, i)), bf_params)
+             for i, cache_path in zip(indices, cache_paths)]
+  else:
+    cache_paths = [join(dir_path, cache_file_name + '.p')]
+    # Workers read their shards from a memory-mapped copy of the cache,
+    # which is reused if it is not older than the cache
+    data_path = join(dir_path, cache_file_name + '.npy')
+    npy_saved = isfile(data_path) and \
+        getmtime(data_path) >= getmtime(cache_paths[0])
+    if npy_saved:
+      data = np.load(data_path, mmap_mode='r')
+    else:
+      with open(cache_paths[0], 'rb') as f:
+        data = pickle.load(f)
+    print('Data cache shape: ', data.shape)
+    n_imgs = len(data)
+
+    # Features may have been merged and verified before caches are removed
+    file_path = join(dir_path, '{}.p'.format(file_name))
+    bf_getter = GetBottleneckFeatures(config.TL_MODEL)
+    if bf_getter.verify_bottleneck_features(
+          file_path, n_imgs, bf_params['pooling']):
+      print('Bottleneck features are up to date: {}'.format(file_path))
+      if isfile(data_path):
+        cache_paths.insert(0, data_path)
+      _remove_verified_caches(cache_paths, True)
+      return
+
+    # The copy is removed before the cache
+    if not npy_saved:
+      tmp_path = data_path + '.tmp'
+      with open(tmp_path, 'wb') as f:
+        np.save(f, data)
+      os.replace(tmp_path, data_path)
+    cache_paths.insert(0, data_path)
+    del data
+    gc.collect()
+
+    # Only the last batch of the merged file could be smaller than batch size
+    batch_size = bf_params['batch_size'] or n_imgs
+    n_batch = math.ceil(n_imgs / batch_size)
+    shard_size = math.ceil(n_batch / n_processes) * batch_size
+    tasks = []
+    for start in range(0, n_imgs, shard_size):
+      end = min(start + shard_size, n_imgs)
+      # Name shards by ranges, so shards of other splits are not resumed
+      shard_path = join(dir_path, '{}.p.shard_{}-{}'.format(
+          file_name, start, end))
+      shard_paths.append(shard_path)
+      tasks.append((config.TL_MODEL, data_path, start, end,
+                    shard_path, bf_params))
+
+  # Use spawn to start workers with fresh tensorflow runtimes, which
+  # inherit OMP_NUM_THREADS from the environment of this process
+  verified = {}
+  omp_num_threads = os.environ.get('OMP_NUM_THREADS')
+  os.environ['OMP_NUM_THREADS'] = str(n_threads)
+  try:
+    with get_context('spawn').Pool(processes=n_processes,
+                                   initializer=_init_bf_worker,
+                                   initargs=(n_threads,)) as pool:
+      for out_path, verified_ in pool.imap_unordered(_get_bf_shard, tasks):
+        print('Saved bottleneck features: {}'.format(out_path))
+        verified[out_path] = verified_
+  finally:
+    if omp_num_threads is None:
+      del os.environ['OMP_NUM_THREADS']
+    else:
+      os.environ['OMP_NUM_THREADS'] = omp_num_threads
+
+  if shard_paths:
+    if not all(verified.values()):
+      _remove_verified_caches(cache_paths, False)
+      return
+    bf_getter.merge_bottleneck_features(shard_paths, file_path)
+    merged_verified = bf_getter.verify_bottleneck_features(
+        file_path, n_imgs, bf_params['pooling'])
+    if merged_verified:
+      for shard_path in shard_paths:
+        os.remove(shard_path)
+        os.remove(utils.get_bf_manifest_path(shard_path))
+    _remove_verified_caches(cache_paths, merged_verified)
+  else:
+    for cache_path, task in zip(cache_paths, tasks):
+      _remove_verified_caches([cache_path], verified[task[4]])
+
+
 def get_and_save_bf(config,
                     dir_path,
                     cache_file_name,
                     file_name,
-                    bf_batch_size=128,
+                    bf_batch_size=None,
                     pooling='avg',
                     data_type=np.float32):
   utils.thin_line()
   print('Calculating bottleneck features of {}...'.format(file_name))
 
+  bf_params = dict(batch_size=bf_batch_size or config.BF_BATCH_SIZE,
+                   pooling=pooling,
+                   data_type=data_type,
+                   n_workers=config.BF_PREPROCESS_WORKERS,
+                   n_prefetch=config.BF_PREFETCH_BATCHES,
+                   writer_queue_size=config.BF_WRITER_QUEUE_SIZE,
+                   storage_dtype=config.BF_STORAGE_DTYPE)
+
   indices = []
   for f_name in listdir(dir_path):
     m = re.match(cache_file_name + '_(\d*).p', f_name)
     if m:
       indices.append(int(m.group(1)))
+  indices = np.sort(indices).tolist()
+
+  # Caches are removed after their features are verified
+  if not indices and not isfile(join(dir_path, cache_file_name + '.p')):
+    print('No cache found, skip {}.'.format(file_name))
+    return
+
+  if config.BF_NUM_PROCESSES:
+    _get_bf_in_processes(config, dir_path, cache_file_name,
+                         file_name, indices, bf_params)
+    return
+
+  # The model is built once and reused by all parts
+  bf_getter = GetBottleneckFeatures(config.TL_MODEL)
+
   if indices:
-    for i in np.sort(indices).tolist():
+    for i in indices:
       part_path = join(dir_path, cache_file_name + '_{}.p'.format(i))
       print('Get bottleneck features of {}_{}.p'.format(cache_file_name, i))
       with open(part_path, 'rb') as f:
         data_part = pickle.load(f)
         print('Data cache shape: ', data_part.shape)
-        GetBottleneckFeatures(
-            config.TL_MODEL).save_bottleneck_features(
+        verified = _get_bf_part(
+            bf_getter,
             data_part,
-            file_path=join(dir_path, '{}_{}.p'.format(file_name, i)),
-            batch_size=bf_batch_size,
-            pooling=pooling,
-            data_type=data_type)
+            join(dir_path, '{}_{}.p'.format(file_name, i)),
+            bf_params)
         del data_part
         gc.collect()
-      os.remove(part_path)
+      _remove_verified_caches([part_path], verified)
   else:
     part_path = join(dir_path, cache_file_name + '.p')
     print('Get bottleneck features of {}.p'.format(cache_file_name))
     with open(part_path, 'rb') as f:
       data_part = pickle.load(f)
-      GetBottleneckFeatures(
-          config.TL_MODEL).save_bottleneck_features(
+      verified = _get_bf_part(
+          bf_getter,
           data_part,
-          file_path=join(dir_path, '{}.p'.format(file_name)),
-          batch_size=bf_batch_size,
-          pooling=pooling,
-          data_type=data_type)
-    os.remove(part_path)
+          join(dir_path, '{}.p'.format(file_name)),
+          bf_params)
+    _remove_verified_caches([part_path], verified)
 
 
 def save_bottleneck_features(config,
@@ -769,23 +958,27 @@ def save_bottleneck_features(config,
 
   pooling = config.BF_POOLING
   dir_path = join(config.DPP_DATA_PATH, data_base_name)
-  get_and_save_bf(config, dir_path, 'x_train_cache',
-                  'x_train', pooling=pooling)
-  get_and_save_bf(config, dir_path, 'x_valid_cache',
-                  'x_valid', pooling=pooling)
-  get_and_save_bf(config, dir_path, 'x_test_cache',
-                  'x_test', pooling=pooling)
-
-  if mul_imgs:
-    get_and_save_bf(config, dir_path,
-                    'x_test_multi_obj_cache',
-                    'x_test_multi_obj',
-                    pooling=pooling)
-  if oracle:
-    get_and_save_bf(config, dir_path,
-                    'x_test_oracle_cache',
-                    'x_test_oracle',
-                    pooling=pooling)
+  try:
+    get_and_save_bf(config, dir_path, 'x_train_cache',
+                    'x_train', pooling=pooling)
+    get_and_save_bf(config, dir_path, 'x_valid_cache',
+                    'x_valid', pooling=pooling)
+    get_and_save_bf(config, dir_path, 'x_test_cache',
+                    'x_test', pooling=pooling)
+
+    if mul_imgs:
+      get_and_save_bf(config, dir_path,
+                      'x_test_multi_obj_cache',
+                      'x_test_multi_obj',
+                      pooling=pooling)
+    if oracle:
+      get_and_save_bf(config, dir_path,
+                      'x_test_oracle_cache',
+                      'x_test_oracle',
+                      pooling=pooling)
+  finally:
+    # Release memory of the transfer learning model
+    clear_model_cache()
 
   utils.thick_line()
   print('Done! Using {:.4}s'.format(time.time() - start_time))
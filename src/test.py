@@ -19,6 +19,48 @@ from baseline_config import config as basel_cfg
 from models import utils
 
 
+def load_test_data(cfg, append_info='', mmap=False):
+  """Load a test set.
+
+  Args:
+    cfg: configuration
+    append_info: name suffix of the test set,
+                 '' (single-object), '_multi_obj' or '_oracle'
+    mmap: load arrays as read-only memmaps instead of into memory
+
+  Returns:
+    tuple of (x_test, y_test, imgs_test)
+  """
+  utils.thick_line()
+  print('Loading data...')
+  utils.thin_line()
+
+  if cfg.DATABASE_MODE is not None:
+    preprocessed_path_ = join(
+        '../data/{}'.format(cfg.DATABASE_MODE), cfg.DATABASE_NAME)
+  else:
+    preprocessed_path_ = join(cfg.DPP_DATA_PATH, cfg.DATABASE_NAME)
+  load_fn = utils.load_pkls_mmap if mmap else utils.load_pkls
+
+  x = load_fn(
+      preprocessed_path_, 'x_test' + append_info,
+      tl=cfg.TRANSFER_LEARNING == 'encode', add_n_batch=1)
+  y = load_fn(
+      preprocessed_path_, 'y_test' + append_info)
+  imgs = load_fn(
+      preprocessed_path_, 'imgs_test' + append_info)
+
+  utils.thin_line()
+  print('Data info:')
+  utils.thin_line()
+  print('x_test: {}\ny_test: {}\nimgs_test: {}'.format(
+      x.shape,
+      y.shape,
+      imgs.shape))
+
+  return x, y, imgs
+
+
 class Test(object):
 
   def __init__(self,
@@ -30,7 +72,9 @@ class Test(object):
                epoch_train=None,
                step_train=None,
                clf_arch_info=None,
-               rec_arch_info=None):
+               rec_arch_info=None,
+               image_saver=None,
+               test_data=None):
 
     # Config
     self.cfg = cfg
@@ -42,6 +86,9 @@ class Test(object):
     self.step_train = step_train
     self.append_info = self.info[0]
 
+    # Background worker for saving images, shared with training if given
+    self.image_saver = image_saver
+
     # Use encode transfer learning
     if self.cfg.TRANSFER_LEARNING == 'encode':
       self.tl_encode = True
@@ -56,8 +103,11 @@ class Test(object):
     utils.save_config_log(
         self.test_log_path, self.cfg, clf_arch_info, rec_arch_info)
 
-    # Load data
-    self.x_test, self.y_test, self.imgs_test = self._load_data()
+    # Load data, unless a loaded test set is given
+    if test_data is not None:
+      self.x_test, self.y_test, self.imgs_test = test_data
+    else:
+      self.x_test, self.y_test, self.imgs_test = self._load_data()
 
   @property
   def info(self):
@@ -126,33 +176,7 @@ class Test(object):
     return checkpoint_path, test_log_path, test_image_path
 
   def _load_data(self):
-    utils.thick_line()
-    print('Loading data...')
-    utils.thin_line()
-
-    if self.cfg.DATABASE_MODE is not None:
-      preprocessed_path_ = join(
-          '../data/{}'.format(self.cfg.DATABASE_MODE), self.cfg.DATABASE_NAME)
-    else:
-      preprocessed_path_ = join(self.cfg.DPP_DATA_PATH, self.cfg.DATABASE_NAME)
-
-    x = utils.load_pkls(
-        preprocessed_path_, 'x_test' + self.append_info,
-        tl=self.tl_encode, add_n_batch=1)
-    y = utils.load_pkls(
-        preprocessed_path_, 'y_test' + self.append_info)
-    imgs = utils.load_pkls(
-        preprocessed_path_, 'imgs_test' + self.append_info)
-
-    utils.thin_line()
-    print('Data info:')
-    utils.thin_line()
-    print('x_test: {}\ny_test: {}\nimgs_test: {}'.format(
-        x.shape,
-        y.shape,
-        imgs.shape))
-
-    return x, y, imgs
+    return load_test_data(self.cfg, self.append_info)
 
   def _get_tensors(self, loaded_graph):
     """Get inputs, labels, loss, and accuracy tensor from <loaded_graph>."""
@@ -244,7 +268,8 @@ class Test(object):
     rec_images_ = sess.run(
         rec_images, feed_dict={inputs: x, labels: y, is_training: False})
 
-    utils.save_imgs(
+    self.image_saver.submit(
+        utils.save_imgs,
         real_imgs=imgs,
         rec_imgs=rec_images_,
         img_path=self.test_image_path,
@@ -254,6 +279,21 @@ class Test(object):
         silent=True,
         test_flag=True)
 
+  def _get_pad_size(self, inputs, len_batch):
+    """Get the size a batch should be padded to, None if it needs no padding.
+
+    Graphs saved with a fixed batch size only take full batches, and
+    multi-gpu graphs need batches which can be split equally into towers.
+    """
+    graph_batch_size = inputs.get_shape().as_list()[0]
+    if graph_batch_size:
+      return graph_batch_size if len_batch != graph_batch_size else None
+    if self.multi_gpu:
+      n_splits = self.cfg.GPU_NUMBER * self.cfg.TASK_NUMBER
+      if len_batch % n_splits != 0:
+        return (len_batch // n_splits + 1) * n_splits
+    return None
+
   def _eval_on_batches(self,
                        sess,
                        inputs,
@@ -266,13 +306,20 @@ class Test(object):
                        clf_loss,
                        rec_loss,
                        rec_images):
-    """Calculate losses and accuracies of full train set."""
+    """Calculate losses and accuracies of full test set.
+
+    Metrics are averaged over batches weighted by their sizes. If the graph
+    splits batches into towers, the examples of a batch which can not be
+    split equally are fed to every tower, see utils.split_for_towers. Graphs
+    saved with a fixed batch size only give predictions of the last batch.
+    """
     pred_all = []
-    loss_all = []
-    acc_all = []
-    clf_loss_all = []
-    rec_loss_all = []
+    metrics_all = []
+    n_examples_all = []
     step = 0
+    graph_batch_size = inputs.get_shape().as_list()[0]
+    n_splits = self.cfg.GPU_NUMBER * self.cfg.TASK_NUMBER \
+        if self.multi_gpu else 1
     batch_generator = utils.get_batches(
         x=self.x_test,
         y=self.y_test,
@@ -280,82 +327,59 @@ class Test(object):
         batch_size=self.cfg.TEST_BATCH_SIZE,
         keep_last=True)
 
+    if self.cfg.TEST_WITH_REC:
+      metric_tensors = [loss, clf_loss, rec_loss, acc]
+    else:
+      metric_tensors = [loss, acc]
+
     if len(self.x_test) % self.cfg.TEST_BATCH_SIZE == 0:
       n_batch = (len(self.x_test) // self.cfg.TEST_BATCH_SIZE)
     else:
       n_batch = (len(self.x_test) // self.cfg.TEST_BATCH_SIZE) + 1
 
-    if self.cfg.TEST_WITH_REC:
-      for _ in tqdm(range(n_batch), total=n_batch,
-                    ncols=100, unit=' batch'):
-        step += 1
-        x_batch, y_batch, imgs_batch = next(batch_generator)
-        len_batch = len(x_batch)
-
-        if len_batch == self.cfg.TEST_BATCH_SIZE:
-          pred_i, loss_i, clf_loss_i, rec_loss_i, acc_i = \
-              sess.run([preds, loss, clf_loss, rec_loss, acc],
-                       feed_dict={inputs: x_batch,
-                                  labels: y_batch,
-                                  input_imgs: imgs_batch,
-                                  is_training: False})
-          loss_all.append(loss_i)
-          clf_loss_all.append(clf_loss_i)
-          rec_loss_all.append(rec_loss_i)
-          acc_all.append(acc_i)
-
-          # Save reconstruct images
-          if self.cfg.TEST_SAVE_IMAGE_STEP:
-            if step % self.cfg.TEST_SAVE_IMAGE_STEP == 0:
-              self._save_images(sess, rec_images, inputs, labels, is_training,
-                                x_batch, y_batch, imgs_batch, step=step)
-        else:
-          # The last batch which has less examples
-          for i in range(self.cfg.TEST_BATCH_SIZE - len_batch):
-            x_batch = np.append(x_batch, np.expand_dims(
-                np.zeros_like(x_batch[0]), axis=0), axis=0)
-          assert len(x_batch) == self.cfg.TEST_BATCH_SIZE
-          pred_i = sess.run(preds, feed_dict={inputs: x_batch,
-                                              is_training: False})
-          pred_i = pred_i[:len_batch]
-
-        pred_all.extend(list(pred_i))
+    for _ in tqdm(range(n_batch), total=n_batch,
+                  ncols=100, unit=' batches'):
+      step += 1
+      x_batch, y_batch, imgs_batch = next(batch_generator)
+      len_batch = len(x_batch)
 
-      clf_loss_ = sum(clf_loss_all) / len(clf_loss_all)
-      rec_loss_ = sum(rec_loss_all) / len(rec_loss_all)
+      if graph_batch_size and len_batch != graph_batch_size:
+        x_batch = utils.pad_batch(x_batch, graph_batch_size)
+        pred_i = sess.run(
+            preds, feed_dict={inputs: x_batch, is_training: False})
+        pred_all.extend(list(pred_i[:len_batch]))
+        continue
+
+      parts = utils.split_for_towers(len_batch, n_splits)
+      for idx, n_examples in parts:
+        pred_i, *metrics_i = \
+            sess.run([preds, *metric_tensors],
+                     feed_dict={inputs: x_batch[idx],
+                                labels: y_batch[idx],
+                                input_imgs: imgs_batch[idx],
+                                is_training: False})
+        pred_all.extend(list(pred_i[:n_examples]))
+        metrics_all.append(metrics_i)
+        n_examples_all.append(n_examples)
+
+      # Save reconstruct images
+      if self.cfg.TEST_WITH_REC and self.cfg.TEST_SAVE_IMAGE_STEP:
+        if step % self.cfg.TEST_SAVE_IMAGE_STEP == 0 and len(parts) == 1:
+          self._save_images(sess, rec_images, inputs, labels, is_training,
+                            x_batch, y_batch, imgs_batch, step=step)
+
+    if not metrics_all:
+      raise ValueError(
+          'The test set has fewer examples ({}) than the fixed batch size '
+          '({}) of the graph!'.format(len(self.x_test), graph_batch_size))
 
+    metrics_ = np.average(metrics_all, axis=0, weights=n_examples_all)
+    if self.cfg.TEST_WITH_REC:
+      loss_, clf_loss_, rec_loss_, acc_ = metrics_
     else:
-      for _ in tqdm(range(n_batch), total=n_batch,
-                    ncols=100, unit=' batches'):
-        x_batch, y_batch, imgs_batch = next(batch_generator)
-        len_batch = len(x_batch)
-
-        if len_batch == self.cfg.TEST_BATCH_SIZE:
-          pred_i, loss_i, acc_i = \
-              sess.run([preds, loss, acc],
-                       feed_dict={inputs: x_batch,
-                                  labels: y_batch,
-                                  input_imgs: imgs_batch,
-                                  is_training: False})
-          loss_all.append(loss_i)
-          acc_all.append(acc_i)
-        else:
-          # The last batch which has less examples
-          for i in range(self.cfg.TEST_BATCH_SIZE - len_batch):
-            x_batch = np.append(x_batch, np.expand_dims(
-                np.zeros_like(x_batch[0]), axis=0), axis=0)
-          assert len(x_batch) == self.cfg.TEST_BATCH_SIZE
-          pred_i = sess.run(preds, feed_dict={inputs: x_batch,
-                                              is_training: False})
-          pred_i = pred_i[:len_batch]
-
-        pred_all.extend(list(pred_i))
-
+      loss_, acc_ = metrics_
       clf_loss_, rec_loss_ = None, None
 
-    loss_ = sum(loss_all) / len(loss_all)
-    acc_ = sum(acc_all) / len(acc_all)
-
     assert len(pred_all) == len(self.x_test), (len(pred_all), len(self.x_test))
     preds_vec = np.array(pred_all)
 
@@ -413,6 +437,19 @@ class Test(object):
           .format(time.time() - start_time))
     utils.thick_line()
 
+  def _run_tester(self, *args, **kwargs):
+    """Run tester, and wait for images to be saved if not training."""
+    if self.image_saver is not None:
+      self.tester(*args, **kwargs)
+    else:
+      self.image_saver = utils.BackgroundWorker(
+          max_queue_size=self.cfg.IMAGE_SAVER_QUEUE_SIZE, name='image_saver')
+      try:
+        self.tester(*args, **kwargs)
+      finally:
+        self.image_saver.close()
+        self.image_saver = None
+
   def test(self):
     """Test models."""
     start_time = time.time()
@@ -438,9 +475,9 @@ class Test(object):
             self._get_tensors(loaded_graph)
         clf_loss, rec_loss, rec_images = None, None, None
 
-      self.tester(sess, inputs, labels, input_imgs, is_training, preds,
-                  rec_images, start_time, loss=loss, acc=acc,
-                  clf_loss=clf_loss, rec_loss=rec_loss)
+      self._run_tester(sess, inputs, labels, input_imgs, is_training, preds,
+                       rec_images, start_time, loss=loss, acc=acc,
+                       clf_loss=clf_loss, rec_loss=rec_loss)
 
 
 class TestMultiObjects(Test):
@@ -454,7 +491,9 @@ class TestMultiObjects(Test):
                epoch_train=None,
                step_train=None,
                clf_arch_info=None,
-               rec_arch_info=None):
+               rec_arch_info=None,
+               image_saver=None,
+               test_data=None):
     super(TestMultiObjects, self).__init__(cfg,
                                            multi_gpu=multi_gpu,
                                            version=version,
@@ -463,7 +502,9 @@ class TestMultiObjects(Test):
                                            epoch_train=epoch_train,
                                            step_train=step_train,
                                            clf_arch_info=clf_arch_info,
-                                           rec_arch_info=rec_arch_info)
+                                           rec_arch_info=rec_arch_info,
+                                           image_saver=image_saver,
+                                           test_data=test_data)
 
   @property
   def info(self):
@@ -518,18 +559,14 @@ class TestMultiObjects(Test):
                   ncols=100, unit=' batch'):
       x_batch = next(_batch_generator)
 
-      # The last batch which has less examples
+      # Only pad the batch if the graph can not take it as it is
       len_batch = len(x_batch)
-      if len_batch != self.cfg.TEST_BATCH_SIZE:
-        for i in range(self.cfg.TEST_BATCH_SIZE - len_batch):
-          x_batch = np.append(x_batch, np.expand_dims(
-              np.zeros_like(x_batch[0]), axis=0), axis=0)
-        assert len(x_batch) == self.cfg.TEST_BATCH_SIZE
+      pad_size = self._get_pad_size(inputs, len_batch)
+      if pad_size is not None:
+        x_batch = utils.pad_batch(x_batch, pad_size)
 
       pred_i = sess.run(preds, feed_dict={inputs: x_batch, is_training: False})
-      if len_batch != self.cfg.TEST_BATCH_SIZE:
-        pred_i = pred_i[:len_batch]
-      pred_all.extend(list(pred_i))
+      pred_all.extend(list(pred_i[:len_batch]))
 
     assert len(pred_all) == len(self.x_test), (len(pred_all), len(self.x_test))
     return np.array(pred_all)
@@ -761,9 +798,15 @@ class TestMultiObjects(Test):
                                  is_training: False})
       rec_images_.append(y_rec_imgs_[:n_y])
 
+    # Compose and save images in background
+    self.image_saver.submit(
+        self._save_images_mo_grid,
+        self.imgs_test[test_img_idx], rec_images_, preds_vec_)
+
+  def _save_images_mo_grid(self, real_imgs, rec_images_, preds_vec_):
+    """Compose and save reconstructed images of multi-objects detection."""
     # Get colorful overlapped images
-    real_imgs_ = utils.img_black_to_color(
-        self.imgs_test[test_img_idx], same=True)
+    real_imgs_ = utils.img_black_to_color(real_imgs, same=True)
     rec_imgs_overlap = []
     rec_imgs_no_overlap = []
     for idx, imgs in enumerate(rec_images_):
@@ -859,8 +902,8 @@ class TestMultiObjects(Test):
             self._get_tensors(loaded_graph)
         rec_images = None
 
-      self.tester(sess, inputs, labels, input_imgs, is_training,
-                  preds, rec_images, start_time)
+      self._run_tester(sess, inputs, labels, input_imgs, is_training,
+                       preds, rec_images, start_time)
 
 
 class TestOracle(TestMultiObjects):
@@ -874,7 +917,9 @@ class TestOracle(TestMultiObjects):
                epoch_train=None,
                step_train=None,
                clf_arch_info=None,
-               rec_arch_info=None):
+               rec_arch_info=None,
+               image_saver=None,
+               test_data=None):
     super(TestMultiObjects, self).__init__(cfg,
                                            multi_gpu=multi_gpu,
                                            version=version,
@@ -883,7 +928,9 @@ class TestOracle(TestMultiObjects):
                                            epoch_train=epoch_train,
                                            step_train=step_train,
                                            clf_arch_info=clf_arch_info,
-                                           rec_arch_info=rec_arch_info)
+                                           rec_arch_info=rec_arch_info,
+                                           image_saver=image_saver,
+                                           test_data=test_data)
 
   @property
   def info(self):
@@ -0,0 +1,57 @@
+import pytest
+
+from models import utils
+
+
+def test_jobs_run_in_order():
+  results = []
+  with utils.BackgroundWorker(max_queue_size=2) as worker:
+    for i in range(10):
+      worker.submit(results.append, i)
+    worker.join()
+    assert results == list(range(10))
+
+
+def test_synchronous_worker():
+  results = []
+  worker = utils.BackgroundWorker(max_queue_size=None)
+  worker.submit(results.append, 1)
+  assert results == [1]
+  worker.close()
+
+
+def _fail():
+  raise RuntimeError('failed job')
+
+
+def _noop():
+  pass
+
+
+def test_error_is_raised_in_join_and_later_jobs_are_skipped():
+  results = []
+  worker = utils.BackgroundWorker()
+  worker.submit(_fail)
+  worker.submit(results.append, 1)
+  with pytest.raises(RuntimeError, match='failed job'):
+    worker.join()
+  assert results == []
+
+  # The error is raised only once
+  worker.submit(results.append, 2)
+  worker.close()
+  assert results == [2]
+
+
+def test_error_is_raised_in_submit_and_close():
+  worker = utils.BackgroundWorker(max_queue_size=1)
+  worker.submit(_fail)
+  # The second submit() blocks until the failed job is done
+  with pytest.raises(RuntimeError):
+    for _ in range(3):
+      worker.submit(_noop)
+
+  worker = utils.BackgroundWorker()
+  worker.submit(_fail)
+  with pytest.raises(RuntimeError):
+    worker.close()
@@ -0,0 +1,58 @@
+import numpy as np
+
+from models import utils
+
+
+def _one_hot(classes, n_classes):
+  return np.eye(n_classes, dtype=np.float32)[classes]
+
+
+def test_batches_cover_the_epoch():
+  x = np.arange(103)
+  sampler = utils.EpochSampler(len(x), 10, seed=0)
+  batches = list(sampler.get_batches(x))
+  assert len(batches) == 10
+  assert all(np.all(np.diff(b) > 0) for b in batches)
+  seen = np.concatenate(batches)
+  assert len(np.unique(seen)) == 100
+
+  # A new permutation in every epoch
+  next_batches = list(sampler.get_batches(x))
+  assert not np.array_equal(np.concatenate(next_batches), seen)
+
+
+def test_stratified_batches():
+  # 3 classes with proportions 1:2:5
+  classes = np.repeat([0, 1, 2], [40, 80, 200])
+  rng = np.random.RandomState(0)
+  rng.shuffle(classes)
+  y = _one_hot(classes, 3)
+  x = np.arange(len(classes))
+
+  sampler = utils.EpochSampler(len(x), 32, y=y, seed=1)
+  for x_batch, y_batch in sampler.get_batches(x, y):
+    np.testing.assert_array_equal(y_batch, y[x_batch])
+    counts = y_batch.sum(axis=0)
+    np.testing.assert_allclose(counts, [4, 8, 20], atol=1)
+
+
+def test_get_and_set_state_resume_an_epoch():
+  x = np.arange(50)
+  y = _one_hot(np.arange(50) % 5, 5)
+  imgs = x * 10
+
+  sampler = utils.EpochSampler(len(x), 8, y=y, seed=2)
+  state = sampler.get_state()
+  batches = list(sampler.get_batches(x, y, imgs))
+
+  resumed = utils.EpochSampler(len(x), 8, y=y, seed=3)
+  resumed.set_state(state)
+  resumed_batches = list(resumed.get_batches(x, y, imgs, start_batch=2))
+  assert len(resumed_batches) == len(batches) - 2
+  for (x_a, y_a, imgs_a), (x_b, y_b, imgs_b) in zip(
+        batches[2:], resumed_batches):
+    np.testing.assert_array_equal(x_a, x_b)
+    np.testing.assert_array_equal(y_a, y_b)
+    np.testing.assert_array_equal(imgs_a, imgs_b)
+  # The state after the epoch is the same as without resuming
+  np.testing.assert_array_equal(sampler.permutation(), resumed.permutation())
@@ -0,0 +1,56 @@
+import time
+import pytest
+
+from models import utils
+
+
+def test_stats_of_phases(monkeypatch):
+  now = [0.]
+  monkeypatch.setattr(time, 'perf_counter', lambda: now[0])
+
+  timer = utils.StepTimer(('batch', 'optimizer'), batch_size=32, window=2)
+  for batch_time, optimizer_time in [(9., 9.), (1., 2.), (3., 4.)]:
+    with timer.phase('batch'):
+      now[0] += batch_time
+    with timer.phase('optimizer'):
+      now[0] += optimizer_time
+    # Time out of phases
+    now[0] += 1.
+    timer.end_step()
+
+  # Only the last 2 steps are in the window
+  stats = timer.get_stats()
+  assert stats['images_per_sec'] == pytest.approx(64 / 12.)
+  assert stats['optimizer_fraction'] == pytest.approx(6 / 12.)
+  assert stats['batch_ms'] == pytest.approx(2000.)
+  assert stats['optimizer_ms'] == pytest.approx(3000.)
+  assert stats['other_ms'] == pytest.approx(1000.)
+
+
+def test_phase_is_timed_on_errors(monkeypatch):
+  now = [0.]
+  monkeypatch.setattr(time, 'perf_counter', lambda: now[0])
+
+  timer = utils.StepTimer(('logs',), batch_size=1, main_phase='logs')
+  with pytest.raises(KeyError):
+    with timer.phase('logs'):
+      now[0] += 2.
+      raise KeyError
+  timer.end_step()
+  assert timer.get_stats()['logs_ms'] == pytest.approx(2000.)
+
+
+def test_null_step_timer():
+  timer = utils.NullStepTimer()
+  with timer.phase('batch'):
+    pass
+  timer.end_step()
+
+
+def test_no_stats_before_a_step_ends(monkeypatch):
+  monkeypatch.setattr(time, 'perf_counter', lambda: 0.)
+  timer = utils.StepTimer(('batch',), batch_size=8, main_phase='batch')
+  assert timer.get_stats() == {}
+  # A step taking no time
+  timer.end_step()
+  assert timer.get_stats() == {}
@@ -0,0 +1,74 @@
+import os
+import shutil
+import numpy as np
+from PIL import Image
+
+from models.thumbnail_cache import ThumbnailCache
+
+
+def _save_img(file_path, size=(40, 20), value=0):
+  img = np.full(size[::-1], value, dtype=np.uint8)
+  img[:, :size[0] // 2] = 255 - value
+  Image.fromarray(img, 'L').save(file_path)
+  return file_path
+
+
+def test_get_flush_and_reopen(tmp_path):
+  cache_dir = str(tmp_path / 'cache')
+  img_paths = [_save_img(str(tmp_path / '{}.png'.format(i)), value=i * 50)
+               for i in range(3)]
+
+  with ThumbnailCache(cache_dir, (16, 16)) as cache:
+    thumbs = cache.get_many(img_paths)
+    assert thumbs.shape == (3, 16, 16)
+    assert len(cache) == 3
+
+  cache = ThumbnailCache(cache_dir, (16, 16))
+  assert len(cache) == 3
+  for img_path, thumb in zip(img_paths, thumbs):
+    np.testing.assert_array_equal(cache.get(img_path), thumb)
+  assert len(cache) == 3
+
+
+def test_same_content_shares_a_row(tmp_path):
+  img_path = _save_img(str(tmp_path / 'a.png'))
+  copy_path = str(tmp_path / 'b.png')
+  shutil.copy(img_path, copy_path)
+
+  cache = ThumbnailCache(str(tmp_path / 'cache'), (16, 16))
+  np.testing.assert_array_equal(cache.get(img_path), cache.get(copy_path))
+  assert len(cache) == 1
+
+
+def test_grow_keeps_rows(tmp_path):
+  img_paths = [_save_img(str(tmp_path / '{}.png'.format(i)), value=i * 20)
+               for i in range(5)]
+  cache = ThumbnailCache(str(tmp_path / 'cache'), (8, 8), init_capacity=2)
+  first = cache.get(img_paths[0])
+  cache.get_many(img_paths)
+  assert cache.capacity >= 5
+  np.testing.assert_array_equal(cache.get(img_paths[0]), first)
+
+
+def test_unflushed_rows_are_not_indexed(tmp_path):
+  cache_dir = str(tmp_path / 'cache')
+  img_path = _save_img(str(tmp_path / 'a.png'))
+  ThumbnailCache(cache_dir, (16, 16)).get_many([img_path])
+  assert len(ThumbnailCache(cache_dir, (16, 16))) == 0
+
+
+def test_read_only_does_not_insert(tmp_path):
+  cache_dir = str(tmp_path / 'cache')
+  cached_path = _save_img(str(tmp_path / 'a.png'))
+  missing_path = _save_img(str(tmp_path / 'b.png'), value=100)
+  with ThumbnailCache(cache_dir, (16, 16)) as cache:
+    cached_thumb = cache.get(cached_path)
+    missing_thumb = cache._decode(missing_path)
+  index_mtime = os.path.getmtime(cache.index_path)
+
+  with ThumbnailCache(cache_dir, (16, 16), read_only=True) as cache:
+    np.testing.assert_array_equal(cache.get(cached_path), cached_thumb)
+    np.testing.assert_array_equal(cache.get(missing_path), missing_thumb)
+    assert len(cache) == 1
+  assert os.path.getmtime(cache.index_path) == index_mtime
+  assert len(ThumbnailCache(cache_dir, (16, 16))) == 1
@@ -0,0 +1,77 @@
+import os
+import pickle
+import numpy as np
+from PIL import Image
+
+import transform_imgs
+from transform_imgs import transform_dir, MANIFEST_NAME
+
+
+def _make_source_dir(source_dir, n_classes=2, n_imgs=3):
+  for c in range(n_classes):
+    class_dir = os.path.join(source_dir, str(c))
+    os.makedirs(class_dir)
+    for i in range(n_imgs):
+      img = np.full((12, 20), 40 * i + c, dtype=np.uint8)
+      Image.fromarray(img, 'L').save(
+          os.path.join(class_dir, '{}.png'.format(i)))
+
+
+def _load_manifest(save_dir):
+  with open(os.path.join(save_dir, MANIFEST_NAME), 'rb') as f:
+    return pickle.load(f)
+
+
+def test_transform_and_skip_up_to_date(tmp_path):
+  source_dir, save_dir = str(tmp_path / 'src'), str(tmp_path / 'dst')
+  _make_source_dir(source_dir)
+  ops = ['invert', 'resize:8,8']
+
+  assert transform_dir(source_dir, save_dir, ops, n_workers=2) == 6
+  img = Image.open(os.path.join(save_dir, '1', '2.png'))
+  assert img.size == (8, 8)
+  np.testing.assert_array_equal(np.array(img), 255 - (40 * 2 + 1))
+  assert sorted(_load_manifest(save_dir)) == sorted(
+      os.path.join(str(c), '{}.png'.format(i))
+      for c in range(2) for i in range(3))
+
+  assert transform_dir(source_dir, save_dir, ops, n_workers=2) == 0
+  # Changed ops transform all images again
+  assert transform_dir(source_dir, save_dir, ['resize:8,8'], n_workers=2) == 6
+
+
+def test_resume_only_missing_and_modified(tmp_path):
+  source_dir, save_dir = str(tmp_path / 'src'), str(tmp_path / 'dst')
+  _make_source_dir(source_dir)
+  ops = ['resize:8,8']
+  transform_dir(source_dir, save_dir, ops, n_workers=2, use_hash=True)
+
+  # An interrupted run leaves outputs without manifest entries
+  manifest = _load_manifest(save_dir)
+  del manifest[os.path.join('0', '0.png')]
+  transform_imgs._save_manifest(
+      manifest, os.path.join(save_dir, MANIFEST_NAME))
+  os.remove(os.path.join(save_dir, '1', '0.png'))
+  Image.fromarray(np.zeros((12, 20), dtype=np.uint8), 'L').save(
+      os.path.join(source_dir, '1', '1.png'))
+
+  assert transform_dir(
+      source_dir, save_dir, ops, n_workers=2, use_hash=True) == 3
+  assert transform_dir(
+      source_dir, save_dir, ops, n_workers=2, use_hash=True) == 0
+  assert not [f for f in os.listdir(os.path.join(save_dir, '1'))
+              if f.endswith('.tmp')]
+
+
+def test_transform_from_thumbnail_cache(tmp_path):
+  source_dir, save_dir = str(tmp_path / 'src'), str(tmp_path / 'dst')
+  _make_source_dir(source_dir)
+  cache_path = str(tmp_path / 'cache')
+
+  assert transform_dir(source_dir, save_dir, ['invert'], n_workers=2,
+                       thumbnail_size=(10, 10),
+                       thumbnail_cache_path=cache_path) == 6
+  assert Image.open(os.path.join(save_dir, '0', '0.png')).size == (10, 10)
+  assert transform_dir(source_dir, save_dir, ['invert'], n_workers=2,
+                       thumbnail_size=(10, 10),
+                       thumbnail_cache_path=cache_path) == 0
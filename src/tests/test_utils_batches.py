@@ -0,0 +1,21 @@
+import numpy as np
+
+from models import utils
+
+
+def test_split_for_towers():
+  x = np.arange(11) * 10
+  parts = utils.split_for_towers(len(x), 4)
+  assert [n for _, n in parts] == [8, 3]
+  np.testing.assert_array_equal(x[parts[0][0]], x[:8])
+  # Every tower gets all remaining examples
+  for tower in np.split(x[parts[1][0]], 4):
+    np.testing.assert_array_equal(tower, x[8:])
+
+
+def test_split_for_towers_without_remainder():
+  assert utils.split_for_towers(8, 4) == [(slice(0, 8), 8)]
+  assert utils.split_for_towers(5, 1) == [(slice(0, 5), 5)]
+  parts = utils.split_for_towers(3, 4)
+  assert len(parts) == 1 and parts[0][1] == 3
+  assert len(parts[0][0]) == 12
@@ -0,0 +1,85 @@
+import pickle
+import numpy as np
+import pytest
+
+from models import utils
+
+
+def _features(shape=(16, 3, 3, 8), seed=0):
+  rng = np.random.RandomState(seed)
+  # Channels with very different ranges, and an all-zero channel
+  features = rng.randn(*shape).astype(np.float32) * np.logspace(
+      -3, 2, shape[-1], dtype=np.float32)
+  features[..., 0] = 0.
+  return features
+
+
+def test_int8_round_trip_error():
+  features = _features()
+  stored, scales = utils.quantize_features(features, 'int8')
+  assert stored.dtype == np.int8 and scales.shape == (8,)
+  assert np.all(scales > 0)
+
+  restored = utils.dequantize_features(stored, scales)
+  assert restored.dtype == np.float32
+  # Error of each channel is at most half of its quantization step
+  np.testing.assert_array_less(
+      np.abs(restored - features).max(axis=(0, 1, 2)), scales / 2 + 1e-7)
+  np.testing.assert_array_equal(restored[..., 0], 0.)
+
+
+def test_float_round_trip_error():
+  features = _features()
+  stored, scales = utils.quantize_features(features, 'float32')
+  assert scales is None
+  np.testing.assert_array_equal(utils.dequantize_features(stored), features)
+
+  stored, scales = utils.quantize_features(features, 'float16')
+  assert stored.dtype == np.float16 and scales is None
+  np.testing.assert_allclose(
+      utils.dequantize_features(stored), features, rtol=1e-3, atol=1e-7)
+
+
+def test_dequantize_into_out():
+  features = _features((4, 8))
+  stored, scales = utils.quantize_features(features, 'int8')
+  out = np.empty((6, 8), dtype=np.float32)
+  utils.dequantize_features(stored, scales, out=out[1:5])
+  np.testing.assert_array_equal(
+      out[1:5], utils.dequantize_features(stored, scales))
+
+
+def test_wrong_storage_dtype():
+  with pytest.raises(ValueError):
+    utils.quantize_features(_features(), 'int4')
+
+
+def _save_features(file_path, features, storage_dtype, batch_size=3):
+  scales_all = []
+  with open(file_path, 'wb') as f:
+    for start in range(0, len(features), batch_size):
+      stored, scales = utils.quantize_features(
+          features[start:start + batch_size], storage_dtype)
+      pickle.dump(stored, f)
+      scales_all.append(scales)
+  manifest = dict(n_imgs=len(features),
+                  feature_shape=features.shape[1:],
+                  storage_dtype=storage_dtype,
+                  n_batches=len(scales_all),
+                  scales=None if storage_dtype != 'int8' else scales_all)
+  with open(utils.get_bf_manifest_path(file_path), 'wb') as f:
+    pickle.dump(manifest, f)
+
+
+def test_load_parts_with_manifests(tmp_path):
+  parts = [_features((5, 4), seed=i) for i in range(2)]
+  for i, part in enumerate(parts):
+    _save_features(str(tmp_path / 'x_train_{}.p'.format(i)), part, 'float16')
+  # Leftovers of an interrupted extraction
+  (tmp_path / 'x_train_1.p.journal').write_text('')
+  (tmp_path / 'x_train_2.p.shard_0-3').write_bytes(b'')
+
+  features = utils.load_pkls(str(tmp_path), 'x_train', tl=True)
+  assert features.shape == (10, 4)
+  np.testing.assert_allclose(
+      features, np.concatenate(parts), rtol=1e-3, atol=1e-7)
@@ -0,0 +1,44 @@
+import numpy as np
+
+from models import utils
+
+
+def _reference_scale(imgs, scale):
+  imgs = imgs.astype(np.float64)
+  axes = tuple(range(1, imgs.ndim))
+  mins = imgs.min(axis=axes, keepdims=True)
+  ranges = imgs.max(axis=axes, keepdims=True) - mins
+  ranges[ranges == 0] = np.inf
+  return (imgs - mins) * scale / ranges
+
+
+def test_min_max_scale_into_out():
+  rng = np.random.RandomState(0)
+  imgs = rng.randint(0, 256, size=(7, 5, 5, 1)).astype(np.uint8)
+  imgs[3] = 9
+  out = np.full(imgs.shape, -1., dtype=np.float32)
+
+  # A small chunk size splits the batch into several chunks
+  scaled = utils.imgs_min_max_scale(imgs, out=out, max_chunk_bytes=256)
+  assert scaled is out
+  np.testing.assert_allclose(out, _reference_scale(imgs, 1.), atol=1e-6)
+  np.testing.assert_array_equal(out[3], 0.)
+
+
+def test_scale_to_255_into_out():
+  rng = np.random.RandomState(1)
+  imgs = rng.rand(4, 6, 6).astype(np.float32) * 3 - 1
+  out = np.zeros(imgs.shape, dtype=np.uint8)
+
+  scaled = utils.imgs_scale_to_255(imgs, out=out)
+  assert scaled is out
+  # Same as scaling each image by itself in its own dtype
+  expected = np.array([np.divide((i - i.min()) * 255, i.max() - i.min())
+                       for i in imgs]).astype(int)
+  np.testing.assert_array_equal(out, expected)
+  assert out.reshape(4, -1).min(axis=1).tolist() == [0] * 4
+
+
+def test_scale_empty_batch():
+  out = utils.imgs_scale_to_255(np.empty((0, 3, 3)))
+  assert out.shape == (0, 3, 3) and out.dtype == np.uint8
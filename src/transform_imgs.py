@@ -0,0 +1,277 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import os
+import time
+import pickle
+import hashlib
+import argparse
+import numpy as np
+from tqdm import tqdm
+from PIL import Image
+from multiprocessing import Pool, cpu_count
+from os.path import join, isfile, splitext, relpath, dirname, basename
+
+from models import utils
+from models.thumbnail_cache import ThumbnailCache, letterbox_img
+
+
+IMG_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.bmp')
+MANIFEST_NAME = '.transform_manifest.p'
+
+# Registered operations: {name: function(img, *args) -> img}
+_OPS = {}
+
+
+def register_op(name):
+  """Register a function as an operation of the transform chain.
+
+  The function takes a PIL image and the arguments parsed from the op spec
+  (e.g. 'resize:28,28' -> fn(img, 28, 28)), and returns a PIL image.
+  """
+  def _register(fn):
+    _OPS[name] = fn
+    return fn
+  return _register
+
+
+@register_op('gray')
+def _op_gray(img):
+  return img.convert('L')
+
+
+@register_op('invert')
+def _op_invert(img):
+  if img.mode not in ('L', 'RGB'):
+    img = img.convert('L')
+  return Image.fromarray((255 - np.array(img)).astype('uint8'), img.mode)
+
+
+@register_op('binarize')
+def _op_binarize(img, threshold=128):
+  return img.convert('L').point(lambda p: 255 if p >= threshold else 0)
+
+
+@register_op('resize')
+def _op_resize(img, width, height):
+  return img.resize((width, height), Image.LANCZOS)
+
+
+@register_op('letterbox')
+def _op_letterbox(img, width, height):
+  if img.mode not in ('L', 'RGB'):
+    img = img.convert('L')
+  return letterbox_img(img, (width, height), img.mode, 'white')
+
+
+def parse_ops(op_specs):
+  """Parse op specs like ['invert', 'resize:28,28'] to [(name, args)]."""
+  ops = []
+  for spec in op_specs:
+    name, _, args = spec.partition(':')
+    if name not in _OPS:
+      raise ValueError('Wrong op name: {}! Choose from: {}'.format(
+          name, sorted(_OPS.keys())))
+    args = tuple(int(a) for a in args.split(',')) if args else ()
+    ops.append((name, args))
+  return ops
+
+
+def _apply_ops(img, ops):
+  for name, args in ops:
+    img = _OPS[name](img, *args)
+  return img
+
+
+def _file_signature(file_path, use_hash=False):
+  """Get signature of a source file to check if outputs are up to date."""
+  if use_hash:
+    with open(file_path, 'rb') as f:
+      return hashlib.sha1(f.read()).hexdigest()
+  else:
+    return os.path.getmtime(file_path), os.path.getsize(file_path)
+
+
+def _save_atomic(img, file_path):
+  """Save an image to a temporary file and rename it to file_path."""
+  utils.check_dir([dirname(file_path)])
+  img_format = Image.registered_extensions()[splitext(file_path)[1].lower()]
+  tmp_path = join(dirname(file_path),
+                  '.{}.{}.tmp'.format(basename(file_path), os.getpid()))
+  try:
+    img.save(tmp_path, format=img_format)
+    os.replace(tmp_path, file_path)
+  finally:
+    if isfile(tmp_path):
+      os.remove(tmp_path)
+
+
+def _save_manifest(manifest, manifest_path):
+  tmp_path = manifest_path + '.tmp'
+  with open(tmp_path, 'wb') as f:
+    pickle.dump(manifest, f)
+  os.replace(tmp_path, manifest_path)
+
+
+# Thumbnail cache of a worker process
+_worker_cache = None
+
+
+def _init_worker(thumbnail_cache_path, thumbnail_size):
+  # Only the parent process writes to the cache
+  global _worker_cache
+  if thumbnail_size:
+    _worker_cache = ThumbnailCache(
+        thumbnail_cache_path, thumbnail_size, read_only=True)
+
+
+def _transform_file(task):
+  """Transform a single image, run in worker processes."""
+  src_path, dst_path, ops = task
+  if _worker_cache is not None:
+    img = Image.fromarray(_worker_cache.get(src_path), 'L')
+  else:
+    img = Image.open(src_path)
+    img.load()
+  _save_atomic(_apply_ops(img, ops), dst_path)
+  return src_path
+
+
+def _list_images(source_dir, first_only=False):
+  """List images in source_dir recursively."""
+  img_paths = []
+  for dir_path, dir_names, file_names in os.walk(source_dir):
+    dir_names.sort()
+    file_names = sorted(
+        f for f in file_names if splitext(f)[1].lower() in IMG_EXTENSIONS)
+    if first_only:
+      file_names = file_names[:1]
+    img_paths.extend(join(dir_path, f) for f in file_names)
+  return img_paths
+
+
+def transform_dir(source_dir,
+                  save_dir,
+                  ops,
+                  n_workers=None,
+                  use_hash=False,
+                  first_only=False,
+                  force=False,
+                  thumbnail_size=None,
+                  thumbnail_cache_path='../data/thumbnail_cache',
+                  chunk_size=64):
+  """Apply a chain of ops to all images in source_dir in parallel.
+
+  The directory structure of source_dir is kept in save_dir. Images whose
+  outputs are up to date (same source signature and same ops as the last run)
+  are skipped.
+
+  Args:
+    source_dir: directory of source images
+    save_dir: directory to save transformed images
+    ops: list of op specs, e.g. ['invert', 'resize:28,28']
+    n_workers: number of worker processes, use all cpus if None
+    use_hash: check sources by content hash instead of mtime and size
+    first_only: only transform the first image of each directory
+    force: transform all images even if they are up to date
+    thumbnail_size: if set, read sources from the thumbnail cache
+    thumbnail_cache_path: path of the thumbnail cache
+    chunk_size: number of images sent to a worker at a time
+
+  Returns:
+    number of transformed images
+  """
+  start_time = time.time()
+  utils.thick_line()
+  print('Transforming images in {}...'.format(source_dir))
+  print('Ops: {}'.format(' -> '.join(ops)))
+
+  parsed_ops = parse_ops(ops)
+  ops_key = (tuple(parsed_ops), thumbnail_size and tuple(thumbnail_size))
+  utils.check_dir([save_dir])
+
+  manifest_path = join(save_dir, MANIFEST_NAME)
+  if isfile(manifest_path) and not force:
+    with open(manifest_path, 'rb') as f:
+      manifest = pickle.load(f)
+  else:
+    manifest = {}
+
+  # Find images which are not up to date
+  tasks = []
+  signatures = {}
+  n_skipped = 0
+  for src_path in _list_images(source_dir, first_only=first_only):
+    rel_path = relpath(src_path, source_dir)
+    dst_path = join(save_dir, rel_path)
+    signature = _file_signature(src_path, use_hash=use_hash)
+    if isfile(dst_path) and manifest.get(rel_path) == (signature, ops_key):
+      n_skipped += 1
+      continue
+    signatures[src_path] = (rel_path, signature)
+    tasks.append((src_path, dst_path, parsed_ops))
+
+  utils.thin_line()
+  print('Images to transform: {} | Up to date: {}'.format(
+      len(tasks), n_skipped))
+  if not tasks:
+    return 0
+
+  # Decode missing thumbnails once before workers read the cache
+  if thumbnail_size:
+    with ThumbnailCache(thumbnail_cache_path, thumbnail_size) as cache:
+      cache.get_many([t[0] for t in tasks])
+
+  n_workers = n_workers or cpu_count()
+  with Pool(processes=n_workers,
+            initializer=_init_worker,
+            initargs=(thumbnail_cache_path, thumbnail_size)) as pool:
+    for i, src_path in enumerate(tqdm(
+          pool.imap_unordered(_transform_file, tasks, chunksize=chunk_size),
+          total=len(tasks), ncols=100, unit=' images')):
+      rel_path, signature = signatures[src_path]
+      manifest[rel_path] = (signature, ops_key)
+      # Save progress in case of interruption
+      if (i + 1) % (chunk_size * n_workers * 8) == 0:
+        _save_manifest(manifest, manifest_path)
+
+  _save_manifest(manifest, manifest_path)
+
+  utils.thin_line()
+  print('Done! Using {:.4}s'.format(time.time() - start_time))
+  utils.thick_line()
+  return len(tasks)
+
+
+if __name__ == '__main__':
+
+  parser = argparse.ArgumentParser(
+      description='Apply a chain of ops to all images of a directory.'
+  )
+  parser.add_argument('source_dir', help='Directory of source images.')
+  parser.add_argument('save_dir', help='Directory to save images.')
+  parser.add_argument('-op', '--ops', nargs='+', required=True,
+                      help='Chain of ops, choose from: {}. '
+                           'Arguments follow a colon, e.g. resize:28,28'
+                           .format(sorted(_OPS.keys())))
+  parser.add_argument('-w', '--workers', type=int, metavar='',
+                      help='Number of worker processes.')
+  parser.add_argument('-hs', '--hash', action='store_true',
+                      help='Check sources by content hash instead of mtime.')
+  parser.add_argument('-f', '--force', action='store_true',
+                      help='Transform all images even if up to date.')
+  parser.add_argument('-fo', '--first_only', action='store_true',
+                      help='Only transform the first image of each directory.')
+  parser.add_argument('-ts', '--thumbnail_size', nargs=2, type=int,
+                      metavar='', help='Read sources from thumbnail cache.')
+  args = parser.parse_args()
+
+  transform_dir(args.source_dir,
+                args.save_dir,
+                args.ops,
+                n_workers=args.workers,
+                use_hash=args.hash,
+                first_only=args.first_only,
+                force=args.force,
+                thumbnail_size=args.thumbnail_size)